@@ -0,0 +1,447 @@
+"""Offline benchmarks for ingestion, retrieval and chat.
+
+Runs against the fake providers (hash embeddings + echo LLM) so results are
+deterministic and need no API key. Run from `backend/`:
+
+    python -m benchmarks.run all --output bench.json
+    python -m benchmarks.run retrieval --sizes 1000,10000 --queries 300
+    python -m benchmarks.run predict --clients 1,8,32 --llm-latency-ms 300
+    python -m benchmarks.run memory --page-counts 50,200,800
+
+Results are printed (or written) as JSON to compare between releases.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger("benchmarks")
+logging.basicConfig(level=logging.INFO)
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Chroma rechaza upserts muy grandes
+INSERT_BATCH = 1000
+
+
+def summarize(samples_ms, elapsed=None):
+    """Latency percentiles (ms) and, with the wall time, throughput"""
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    if not len(samples):
+        return {"count": 0}
+    stats = {
+        "count": int(len(samples)),
+        "mean_ms": round(float(samples.mean()), 3),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+        "max_ms": round(float(samples.max()), 3),
+    }
+    if elapsed:
+        stats["throughput_per_s"] = round(len(samples) / elapsed, 3)
+    return stats
+
+
+def configure_env(args, workdir):
+    """Fake providers and throwaway storage; must run before importing src.*"""
+    os.environ["LLM_PROVIDER"] = "fake"
+    os.environ["EMBEDDING_PROVIDER"] = "fake"
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.llm_latency_ms)
+    os.environ["FAKE_EMBEDDING_LATENCY_MS"] = str(args.embedding_latency_ms)
+    os.environ["INGEST_CACHE_PATH"] = os.path.join(workdir, "ingest_cache.sqlite")
+    os.environ.setdefault("MAX_TOKENS", "100000")
+    return {
+        "LLM_PROVIDER": "fake",
+        "EMBEDDING_PROVIDER": "fake",
+        "FAKE_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "FAKE_EMBEDDING_LATENCY_MS": str(args.embedding_latency_ms),
+        "INGEST_CACHE_PATH": os.environ["INGEST_CACHE_PATH"],
+        "MAX_TOKENS": os.environ["MAX_TOKENS"],
+    }
+
+
+def open_stores(directory):
+    """Chroma + docstore + lexical index laid out like main.py does"""
+    from langchain_chroma import Chroma
+    from src.docstore import SQLiteDocStore
+    from src.embeddings import CachedEmbeddings
+    from src.lexical import BM25Index
+    from src.pdf_parser import make_multivector_retriever
+    from src.providers import get_embeddings
+
+    vectorstore = Chroma(
+        collection_name="multivector_chunks",
+        embedding_function=CachedEmbeddings(get_embeddings()),
+        persist_directory=directory,
+    )
+    retriever = make_multivector_retriever(vectorstore, SQLiteDocStore(os.path.join(directory, "docstore.sqlite")))
+    return retriever, BM25Index(os.path.join(directory, "lexical.sqlite"))
+
+
+def populate(retriever, lexical_index, count, seed=0):
+    from src.pdf_parser import save_to_multivectorstore
+    from benchmarks.synthetic import synthetic_chunks
+
+    docs = synthetic_chunks(count, seed=seed)
+    for i in range(0, len(docs), INSERT_BATCH):
+        batch = docs[i:i + INSERT_BATCH]
+        save_to_multivectorstore(batch, batch, retriever, lexical_index)
+    return docs
+
+
+# ---- Ingesta ----
+
+# process_pdf reporta el inicio de cada etapa; tras "enriched" solo queda armar los documentos
+STAGE_NAMES = {"enriched": "documents"}
+
+def bench_ingest(args, workdir):
+    """Per-stage timings of process_pdf (+ saving) over the synthetic PDF set"""
+    from benchmarks.synthetic import build_pdf_set
+    from src.pdf_parser import process_pdf, save_to_multivectorstore
+
+    pdfs = build_pdf_set(os.path.join(workdir, "pdfs"), names=args.pdfs)
+    retriever, lexical_index = open_stores(os.path.join(workdir, "ingest_db"))
+
+    stages = {}
+    per_file = {}
+    for run in range(args.repeat):
+        # La primera corrida es en frío; las siguientes reusan la caché de ingesta
+        label = "cold" if run == 0 else "warm"
+        for filename, (path, pages) in pdfs.items():
+            marks = []
+            start = time.perf_counter()
+            children, parents = process_pdf(
+                path, filename=filename,
+                on_progress=lambda stage, _: marks.append((STAGE_NAMES.get(stage, stage), time.perf_counter()))
+            )
+            marks.append(("saving", time.perf_counter()))
+            save_to_multivectorstore(children, parents, retriever, lexical_index)
+            end = time.perf_counter()
+            marks.append(("done", end))
+
+            # Cada etapa dura hasta la marca siguiente
+            for (stage, t0), (_, t1) in zip(marks, marks[1:]):
+                stages.setdefault(label, {}).setdefault(stage, []).append((t1 - t0) * 1000)
+            stages[label].setdefault("total", []).append((end - start) * 1000)
+            per_file.setdefault(label, {})[filename] = {
+                "pages": pages,
+                "chunks": len(parents),
+                "seconds": round(end - start, 3),
+                "pages_per_s": round(pages / (end - start), 3),
+            }
+
+    total_pages = sum(pages for _, pages in pdfs.values())
+    return {
+        "files": {filename: pages for filename, (_, pages) in pdfs.items()},
+        "stages": {
+            label: {stage: summarize(samples) for stage, samples in by_stage.items()}
+            for label, by_stage in stages.items()
+        },
+        "per_file": per_file,
+        # Páginas por segundo de punta a punta (partición + enriquecimiento + guardado)
+        "pages_per_s": {
+            label: round(total_pages * len(by_stage["total"]) / len(pdfs) / (sum(by_stage["total"]) / 1000), 3)
+            for label, by_stage in stages.items()
+        },
+    }
+
+
+# ---- Memoria de la ingesta ----
+
+# Mezcla de páginas de los PDFs sintéticos grandes
+MEMORY_PAGE_KINDS = ("text", "text", "table", "image")
+
+
+def _rss_mib(who=resource.RUSAGE_SELF):
+    # ru_maxrss está en KiB en Linux y en bytes en macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def _ingest_peak_rss(path, filename, window_pages, directory, results):
+    """Runs in a fresh process: ingest one PDF window by window and report its peak RSS"""
+    sys.path.insert(0, BACKEND_DIR)
+    from src.pdf_parser import iter_pdf_windows, save_to_multivectorstore
+
+    retriever, lexical_index = open_stores(directory)
+    baseline = _rss_mib()
+    start = time.perf_counter()
+    chunks = 0
+    for children, parents in iter_pdf_windows(path, filename=filename, window_pages=window_pages):
+        save_to_multivectorstore(children, parents, retriever, lexical_index)
+        chunks += len(children)
+    results.put({
+        "chunks": chunks,
+        "seconds": round(time.perf_counter() - start, 3),
+        # Pico del proceso de ingesta y cuánto creció sobre lo que ocupan los módulos cargados
+        "baseline_rss_mib": baseline,
+        "peak_rss_mib": _rss_mib(),
+        "ingest_rss_mib": round(_rss_mib() - baseline, 1),
+        # Procesos de partición (el mayor de ellos)
+        "partition_peak_rss_mib": _rss_mib(resource.RUSAGE_CHILDREN),
+    })
+
+
+def bench_memory(args, workdir):
+    """Peak RSS of the ingestion process as the PDF grows, by page windows vs the whole file at once"""
+    from benchmarks.synthetic import build_pdf
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for pages in args.page_counts:
+        kinds = [MEMORY_PAGE_KINDS[i % len(MEMORY_PAGE_KINDS)] for i in range(pages)]
+        path = build_pdf(os.path.join(workdir, f"memory_{pages}.pdf"), kinds, seed=pages)
+        results[str(pages)] = {"file_mib": round(os.path.getsize(path) / 2**20, 2)}
+        for mode, window_pages in (("windowed", args.window_pages), ("whole", pages)):
+            # Un proceso nuevo por corrida: ru_maxrss es el pico de toda la vida del proceso
+            queue = ctx.Queue()
+            process = ctx.Process(
+                target=_ingest_peak_rss,
+                args=(path, f"memory_{pages}.pdf", window_pages, os.path.join(workdir, f"memory_{mode}_{pages}"), queue),
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"Memory probe for {pages} pages ({mode}) exited with {process.exitcode}")
+            results[str(pages)][mode] = queue.get()
+            logger.info(f"{pages} pages ({mode}): peak RSS {results[str(pages)][mode]['peak_rss_mib']} MiB")
+
+    smallest, largest = str(args.page_counts[0]), str(args.page_counts[-1])
+    return {
+        "window_pages": args.window_pages,
+        "pages": results,
+        # Con ventanas, el pico no debería crecer con el tamaño del archivo
+        "growth_mib": {
+            mode: round(results[largest][mode]["ingest_rss_mib"] - results[smallest][mode]["ingest_rss_mib"], 1)
+            for mode in ("windowed", "whole")
+        },
+    }
+
+
+# ---- Recuperación ----
+
+async def _time_queries(search, questions):
+    samples = []
+    start = time.perf_counter()
+    for question in questions:
+        t0 = time.perf_counter()
+        await search(question)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return summarize(samples, time.perf_counter() - start)
+
+
+async def _retrieval_modes(retriever, lexical_index, questions, warmup, k):
+    from src.retrieval import ahybrid_search
+
+    results = {}
+    modes = {"hybrid": (1.0, 1.0), "dense": (1.0, 0.0), "lexical": (0.0, 1.0)}
+    for mode, (dense_weight, lexical_weight) in modes.items():
+        async def search(question):
+            return await ahybrid_search(
+                retriever, lexical_index, question, k=k,
+                dense_weight=dense_weight, lexical_weight=lexical_weight,
+            )
+        # Calentar con otras preguntas (carga de índices) antes de medir
+        await _time_queries(search, warmup)
+        results[mode] = await _time_queries(search, questions)
+    return results
+
+
+def bench_retrieval(args, workdir):
+    """Hybrid / dense / lexical search latency as the collection grows"""
+    from benchmarks.synthetic import synthetic_questions
+
+    questions = synthetic_questions(args.queries)
+    warmup = synthetic_questions(10, seed=99)
+    results = {}
+    for size in args.sizes:
+        retriever, lexical_index = open_stores(os.path.join(workdir, f"retrieval_{size}"))
+        start = time.perf_counter()
+        populate(retriever, lexical_index, size)
+        build_seconds = time.perf_counter() - start
+
+        results[str(size)] = {
+            "build_seconds": round(build_seconds, 3),
+            **asyncio.run(_retrieval_modes(retriever, lexical_index, questions, warmup, args.k)),
+        }
+        logger.info(f"Retrieval over {size} chunks: p50 {results[str(size)]['hybrid']['p50_ms']} ms (hybrid)")
+    return results
+
+
+# ---- /predict de punta a punta ----
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _post(url, payload, timeout=120):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, TimeoutError):
+        return 0
+
+
+def _wait_ready(base_url, server, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            with urllib.request.urlopen(f"{base_url}/stats", timeout=2):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+    raise RuntimeError("Server did not start in time")
+
+
+def bench_predict(args, workdir, env):
+    """N concurrent clients against a real uvicorn server running the app with fake providers"""
+    from benchmarks.synthetic import synthetic_questions
+
+    db_dir = os.path.join(workdir, "predict_db")
+    retriever, lexical_index = open_stores(db_dir)
+    populate(retriever, lexical_index, args.docs)
+    del retriever, lexical_index
+
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server_env = {
+        **os.environ, **env,
+        "CHROMA_PERSIST_DIR": db_dir,
+        # Cada request tiene que recorrer el grafo completo
+        "ANSWER_CACHE_ENABLED": "0",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=server_env,
+    )
+    results = {}
+    try:
+        _wait_ready(base_url, server)
+        for clients in args.clients:
+            questions = synthetic_questions(clients * args.requests_per_client, seed=clients)
+            samples, statuses = [], {}
+            lock = threading.Lock()
+
+            def client(i):
+                for question in questions[i::clients]:
+                    t0 = time.perf_counter()
+                    status = _post(f"{base_url}/predict", {"question": question})
+                    elapsed = (time.perf_counter() - t0) * 1000
+                    with lock:
+                        statuses[str(status)] = statuses.get(str(status), 0) + 1
+                        if status == 200:
+                            samples.append(elapsed)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                list(pool.map(client, range(clients)))
+            results[str(clients)] = {**summarize(samples, time.perf_counter() - start), "statuses": statuses}
+            logger.info(f"/predict with {clients} clients: {results[str(clients)]}")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    ints = lambda value: [int(v) for v in value.split(",") if v]
+    names = lambda value: [v for v in value.split(",") if v]
+    parser = argparse.ArgumentParser(description="Offline benchmarks (fake providers)")
+    parser.add_argument("suite", choices=["ingest", "retrieval", "predict", "memory", "all"],
+                        help="`all` runs ingest, retrieval and predict (memory is slow: run it on its own)")
+    parser.add_argument("--output", help="JSON file (default: stdout)")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated LLM latency")
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0, help="simulated embedding latency")
+    parser.add_argument("--repeat", type=int, default=2, help="ingest: runs per PDF (first is cold)")
+    parser.add_argument("--pdfs", type=names, help="ingest: subset of the synthetic PDFs (default: all)")
+    parser.add_argument("--page-counts", type=ints, default=[50, 200, 800], help="memory: PDF sizes in pages")
+    parser.add_argument("--window-pages", type=int, default=50, help="memory: pages per ingestion window")
+    parser.add_argument("--sizes", type=ints, default=[1000, 5000, 20000], help="retrieval: collection sizes")
+    parser.add_argument("--queries", type=int, default=200, help="retrieval: queries per size")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--docs", type=int, default=2000, help="predict: chunks in the collection")
+    parser.add_argument("--clients", type=ints, default=[1, 8, 32], help="predict: concurrent clients")
+    parser.add_argument("--requests-per-client", type=int, default=10)
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="rag_bench_")
+    env = configure_env(args, workdir)
+    sys.path.insert(0, BACKEND_DIR)
+
+    suites = ["ingest", "retrieval", "predict"] if args.suite == "all" else [args.suite]
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+        "results": {},
+    }
+    try:
+        for suite in suites:
+            logger.info(f"Running {suite} benchmark...")
+            start = time.perf_counter()
+            if suite == "ingest":
+                report["results"]["ingest"] = bench_ingest(args, workdir)
+            elif suite == "retrieval":
+                report["results"]["retrieval"] = bench_retrieval(args, workdir)
+            elif suite == "memory":
+                report["results"]["memory"] = bench_memory(args, workdir)
+            else:
+                report["results"]["predict"] = bench_predict(args, workdir, env)
+            logger.info(f"{suite} done in {time.perf_counter() - start:.1f}s")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        logger.info(f"Results written to {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import random
+import fitz  # PyMuPDF
+from langchain.schema import Document
+
+# Vocabulario fijo: mismas palabras => mismos documentos y consultas en cada corrida
+WORDS = (
+    "bomba valvula presion caudal motor sensor filtro manual seccion tabla mantenimiento "
+    "temperatura rotor eje sello junta tornillo torque ajuste calibracion alarma error codigo "
+    "instalacion garantia modelo serie potencia voltaje corriente frecuencia aceite nivel "
+    "limpieza inspeccion reemplazo pieza diagrama figura capitulo norma seguridad operador "
+    "arranque parada ciclo carga descarga tanque tuberia conexion brida reductor cojinete"
+).split()
+
+PAGE_SIZE = (595, 842)  # A4 en puntos
+
+
+def sentence(rng, min_words=8, max_words=20):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    if rng.random() < 0.3:
+        words.append(f"E-{rng.randint(1, 999):03d}")
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng, sentences=5):
+    return " ".join(sentence(rng) for _ in range(sentences))
+
+
+def _text_page(page, rng):
+    page.insert_text((50, 60), f"Seccion {rng.randint(1, 20)}", fontsize=16)
+    page.insert_textbox(fitz.Rect(50, 80, 545, 800), "\n\n".join(paragraph(rng) for _ in range(6)), fontsize=10)
+
+
+def _table_page(page, rng, rows=12, cols=5):
+    page.insert_text((50, 60), f"Tabla {rng.randint(1, 50)}: {sentence(rng, 3, 6)}", fontsize=12)
+    x0, y0, width, height = 50, 80, 99, 22
+    for r in range(rows + 1):
+        page.draw_line((x0, y0 + r * height), (x0 + cols * width, y0 + r * height))
+    for c in range(cols + 1):
+        page.draw_line((x0 + c * width, y0), (x0 + c * width, y0 + rows * height))
+    for r in range(rows):
+        for c in range(cols):
+            text = rng.choice(WORDS) if r == 0 or c == 0 else f"{rng.uniform(0, 1000):.1f}"
+            page.insert_text((x0 + c * width + 4, y0 + r * height + 15), text, fontsize=9)
+
+
+def _image_page(page, rng):
+    page.insert_text((50, 60), f"Figura {rng.randint(1, 50)}: {sentence(rng, 3, 6)}", fontsize=12)
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 320, 240), False)
+    pix.set_rect(pix.irect, (240, 240, 240))
+    # Bloques de colores: una "imagen" distinta por página
+    for _ in range(12):
+        x, y = rng.randint(0, 280), rng.randint(0, 200)
+        pix.set_rect(fitz.IRect(x, y, x + rng.randint(10, 80), y + rng.randint(10, 60)),
+                     tuple(rng.randint(0, 255) for _ in range(3)))
+    page.insert_image(fitz.Rect(100, 100, 495, 396), pixmap=pix)
+    page.insert_textbox(fitz.Rect(50, 420, 545, 800), paragraph(rng, 3), fontsize=10)
+
+
+PAGE_BUILDERS = {"text": _text_page, "table": _table_page, "image": _image_page}
+
+# Conjunto fijo de PDFs: (nombre, tipos de página)
+PDF_SET = {
+    "text_10p.pdf": ["text"] * 10,
+    "tables_6p.pdf": ["table", "text"] * 3,
+    "images_6p.pdf": ["image", "text"] * 3,
+    "mixed_20p.pdf": ["text", "table", "text", "image"] * 5,
+}
+
+
+def build_pdf(path, page_kinds, seed=0):
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for kind in page_kinds:
+        PAGE_BUILDERS[kind](doc.new_page(width=PAGE_SIZE[0], height=PAGE_SIZE[1]), rng)
+    doc.save(path, deflate=True)
+    doc.close()
+    return path
+
+
+def build_pdf_set(directory, seed=0, names=None):
+    """Write the synthetic PDF set (or the `names` subset) into `directory`. Returns {filename: (path, pages)}."""
+    os.makedirs(directory, exist_ok=True)
+    pdfs = {}
+    for i, (filename, kinds) in enumerate(PDF_SET.items()):
+        if names and filename not in names:
+            continue
+        pdfs[filename] = (build_pdf(os.path.join(directory, filename), kinds, seed=seed + i), len(kinds))
+    return pdfs
+
+
+def synthetic_chunks(count, seed=0, files=50):
+    """Deterministic chunk documents with the metadata save_to_multivectorstore expects"""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(count):
+        docs.append(Document(
+            page_content=paragraph(rng, rng.randint(2, 5)),
+            metadata={
+                "doc_id": f"bench-{seed}-{i}",
+                "content_type": "text",
+                "filename": f"manual_{i % files:03d}.pdf",
+                "page_number": i // files + 1,
+            },
+        ))
+    return docs
+
+
+def synthetic_questions(count, seed=1):
+    rng = random.Random(seed)
+    return [
+        f"{rng.choice(['Que', 'Como', 'Cuando', 'Donde'])} {sentence(rng, 4, 9).lower().rstrip('.')}?"
+        for _ in range(count)
+    ]
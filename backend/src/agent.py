@@ -1,14 +1,25 @@
 import os
 from langgraph.graph import StateGraph, MessagesState, END
-from langchain_core.messages import HumanMessage, RemoveMessage, SystemMessage
-from langgraph.prebuilt import ToolNode, tools_condition
+from langchain_core.messages import HumanMessage, AIMessage, RemoveMessage, SystemMessage, AIMessageChunk, ToolMessage
+from langgraph.prebuilt import tools_condition
 from langchain_core.messages import SystemMessage
-from langchain_core.tools import tool, Tool
+from langchain_core.tools import tool, Tool, InjectedToolCallId
+from langchain_core.runnables import RunnableConfig
 from langchain_experimental.utilities import PythonREPL
-from langchain_openai import ChatOpenAI
 from langchain_core.messages.utils import count_tokens_approximately
 from pydantic import BaseModel
+from typing import Annotated, List, Literal, Optional
+from src.providers import get_chat_model
+from src.metrics import span, timed_node
+from src.context import pack_context, format_source, compact_table_html, CONTEXT_TOKEN_BUDGET
+from src.retrieval import (
+    ahybrid_search, merge_filters, aembed_queries, needs_query_vector, dedupe_across,
+    DEFAULT_K, DENSE_WEIGHT, LEXICAL_WEIGHT, RETRIEVAL_CANDIDATES, MMR_LAMBDA
+)
+import asyncio
 import logging
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -16,18 +27,33 @@ logging.basicConfig(level=logging.INFO)
 # Load API key from env
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 MAX_TOKENS = os.environ.get("MAX_TOKENS")
+# Con sesiones el resumen corre en segundo plano; solo se resume en línea por encima de este techo
+MAX_TOKENS_HARD = os.environ.get("MAX_TOKENS_HARD")
+# Mensajes que quedan sin resumir después de resumir
+SUMMARY_KEEP_LAST = 2
+
+# Timeout por herramienta (segundos); las llamadas de un turno corren en paralelo
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", 30))
+TOOL_TIMEOUTS = {
+    "retrieve": float(os.environ.get("RETRIEVE_TIMEOUT", TOOL_TIMEOUT)),
+    "python_repl": float(os.environ.get("PYTHON_REPL_TIMEOUT", TOOL_TIMEOUT)),
+}
 
 # LLM setup
-llm = ChatOpenAI(model="gpt-4", temperature=0, api_key=OPENAI_API_KEY)
+llm = get_chat_model("gpt-4", temperature=0)
 
 
 class State(MessagesState):
     summary: str
+    context_tokens: int
+    history_tokens: int
 
-def summarize_conversation(state: State):
-    summary_so_far = state.get("summary", "")
-    messages = state["messages"]
+def hard_token_limit():
+    return int(MAX_TOKENS_HARD) if MAX_TOKENS_HARD else 2 * int(MAX_TOKENS)
 
+
+async def summarize_messages(summary_so_far, messages):
+    """Extend `summary_so_far` with `messages` (only the ones not yet summarized)"""
     prompt = (
         f"This is summary of the conversation to date: {summary_so_far}\n\n"
         "Extend the summary by taking into account the new messages above:"
@@ -35,34 +61,118 @@ def summarize_conversation(state: State):
         else "Create a summary of the conversation above:"
     )
 
-    messages_for_summary = messages + [HumanMessage(content=prompt)]
-    response = llm.invoke(messages_for_summary)
+    response = await llm.ainvoke(messages + [HumanMessage(content=prompt)])
+    return response.content
 
-    # Mantener solo los últimos 2 mensajes relevantes
-    new_messages = messages[-2:] 
 
-    return {"summary": response.content, "messages": new_messages}
+async def summarize_conversation(state: State):
+    messages = state["messages"]
+    with span("summarize", mode="inline"):
+        summary = await summarize_messages(state.get("summary", ""), messages[:-SUMMARY_KEEP_LAST])
 
+    # Mantener solo los últimos mensajes (add_messages necesita RemoveMessage para borrar)
+    removed = [RemoveMessage(id=msg.id) for msg in messages[:-SUMMARY_KEEP_LAST]]
+
+    return {"summary": summary, "messages": removed}
 
-def memory_check_and_summarize(state: State):
-    messages = state["messages"]
-    total_tokens = count_tokens_approximately(messages)
 
-    if total_tokens > int(MAX_TOKENS):
-        logger.info("Resumiendo conversación por exceso de tokens...")
-        return summarize_conversation(state)
+async def memory_check_and_summarize(state: State):
+    messages = state["messages"]
+    history_tokens = state.get("history_tokens")
+    if history_tokens is None:
+        total_tokens = count_tokens_approximately(messages)
+        limit = int(MAX_TOKENS)
+    else:
+        # Sesión del servidor: el historial ya viene contado, solo se cuenta la pregunta nueva.
+        # El resumen normal lo hace el BackgroundSummarizer después de responder.
+        total_tokens = history_tokens + count_tokens_approximately(messages[-1:])
+        limit = hard_token_limit()
+
+    if total_tokens > limit:
+        logger.info("Resumiendo conversación en línea por exceso de tokens...")
+        return await summarize_conversation(state)
     
-    return {"messages": messages, "summary": state.get("summary", "")}
+    return {"summary": state.get("summary", "")}
+
+# Payloads que quedan en el docstore pero no se mandan al LLM
+PAYLOAD_KEYS = ("image_base64",)
+
+def source_metadata(doc):
+    return {k: v for k, v in doc.metadata.items() if k not in PAYLOAD_KEYS}
+
+def retrieval_options(config):
+    """Per-request retrieval options passed as config["configurable"]["retrieval"]"""
+    return ((config or {}).get("configurable") or {}).get("retrieval") or {}
+
+def make_search(retriever, lexical_index):
+    """Hybrid search with the request options; shared by the retrieve tool and speculative retrieval"""
+    async def search(query, config, tool_filters=None, query_vector=None):
+        options = retrieval_options(config)
+        # Búsqueda densa + léxica (BM25) fusionadas con RRF; los padres se resuelven con un solo mget
+        return await ahybrid_search(
+            retriever,
+            lexical_index,
+            query,
+            k=options.get("k") or retriever.search_kwargs.get("k", DEFAULT_K),
+            dense_weight=options.get("dense_weight", DENSE_WEIGHT),
+            lexical_weight=options.get("lexical_weight", LEXICAL_WEIGHT),
+            candidates=options.get("candidates", RETRIEVAL_CANDIDATES),
+            mmr_lambda=options.get("mmr_lambda", MMR_LAMBDA),
+            # Los filtros del request/sesión acotan; los del LLM solo pueden restringir más
+            filters=merge_filters(options.get("filters"), tool_filters),
+            query_vector=query_vector,
+        )
+    return search
+
+
+def retrieve_filters(filenames=None, content_type=None, page_from=None, page_to=None, **_):
+    """Filters from the retrieve tool arguments"""
+    return {
+        "filenames": filenames,
+        "content_types": [content_type] if content_type else None,
+        "page_from": page_from,
+        "page_to": page_to,
+    }
+
+
+def serialize_docs(docs):
+    return "\n\n".join(
+        f"{format_source(doc.metadata)}\n{compact_table_html(doc.page_content)}" for doc in docs
+    )
 
-def make_retrieve_tool(retriever):
+
+async def claim_speculation(router, tool_call_id):
+    """Docs of the speculative retrieval bound to this call, or None"""
+    speculative = router.take(tool_call_id)
+    if speculative is None:
+        return None
+    try:
+        return await speculative
+    except Exception as e:
+        logger.warning(f"Discarding failed speculative retrieval: {str(e)}")
+        return None
+
+
+def make_retrieve_tool(router):
     @tool(response_format="content_and_artifact")
-    def retrieve(query: str):
-        """Retrieve information related to a query."""
-        docs = retriever.get_relevant_documents(query)
-        serialized = "\n\n".join(
-            f"Source: {doc.metadata}\nContent: {doc.page_content}" for doc in docs
-        )
-        return serialized, docs
+    async def retrieve(
+        query: str,
+        config: RunnableConfig,
+        tool_call_id: Annotated[str, InjectedToolCallId],
+        filenames: Optional[List[str]] = None,
+        content_type: Optional[Literal["text", "table", "image"]] = None,
+        page_from: Optional[int] = None,
+        page_to: Optional[int] = None,
+    ):
+        """Retrieve information related to a query.
+
+        Optionally restrict the search to some documents (`filenames`), to one
+        `content_type` (text, table or image) or to a page range (`page_from`, `page_to`).
+        """
+        docs = await claim_speculation(router, tool_call_id)
+        if docs is None:
+            docs = await router.search(query, config, retrieve_filters(filenames, content_type, page_from, page_to))
+        return serialize_docs(docs), docs
 
     return retrieve
 
@@ -76,18 +186,31 @@ repl_tool = Tool(
 
 
 # Decide tool or respond
-def make_query_or_respond(retrieve_tool):
-    def query_or_respond(state: State):  
+def make_query_or_respond(retrieve_tool, router):
+    async def query_or_respond(state: State, config: RunnableConfig):
         summary = state.get("summary", "")
         messages = state["messages"]
+        question = messages[-1].content if isinstance(messages[-1], HumanMessage) else ""
 
+        # Pregunta obvia sobre los documentos: directo a retrieve, sin llamada de ruteo
+        if question and router.route_locally(question, has_history=len(messages) > 1):
+            call = {"name": retrieve_tool.name, "args": {"query": question}, "id": f"call_local_{uuid.uuid4().hex}"}
+            logger.info("Local router: retrieving without a routing call.")
+            return {"messages": [AIMessage(content="", tool_calls=[call])]}
 
+        # El historial ya llega recortado: el resumen reemplaza a los mensajes resumidos
         if summary:
-            relevant_messages = state["messages"][-2:]  
-            relevant_messages = [SystemMessage(content=f"Summary of previous conversation:\n{summary}")] + relevant_messages
+            messages = [SystemMessage(content=f"Summary of previous conversation:\n{summary}")] + messages
+
+        # Buscar la pregunta en paralelo mientras el LLM decide
+        speculation = router.speculate(question, config)
 
+        started = time.perf_counter()
         llm_with_tools = llm.bind_tools([retrieve_tool, repl_tool])
-        response = llm_with_tools.invoke(messages)
+        response = await llm_with_tools.ainvoke(messages)
+        routing_ms = (time.perf_counter() - started) * 1000
+        router.observe_routing(routing_ms)
+        router.resolve(speculation, response.tool_calls, retrieve_tool.name, routing_ms)
 
         # Log tools
         if hasattr(response, "tool_calls") and response.tool_calls:
@@ -100,18 +223,120 @@ def make_query_or_respond(retrieve_tool):
     return query_or_respond
 
 
+def tool_error(call, error):
+    return ToolMessage(
+        content=f"Error: {error}\n Please fix your mistakes.",
+        name=call["name"],
+        tool_call_id=call["id"],
+        status="error",
+    )
+
+
+def make_tools_node(retrieve_tool, tools, router, retriever):
+    """Run all tool calls of a turn concurrently, each with its own timeout.
+
+    The `retrieve` calls share one batched query-embedding request, search
+    concurrently and are de-duplicated across calls before reaching generate().
+    """
+    tools_by_name = {t.name: t for t in tools}
+
+    async def with_timeout(call, coro):
+        timeout = TOOL_TIMEOUTS.get(call["name"], TOOL_TIMEOUT)
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool {call['name']} timed out after {timeout}s")
+            return tool_error(call, f"{call['name']} timed out after {timeout}s")
+        except Exception as e:
+            logger.error(f"Tool {call['name']} failed: {str(e)}")
+            return tool_error(call, repr(e))
+
+    async def retrieve_batch(calls, config):
+        options = retrieval_options(config)
+        speculative = await asyncio.gather(*(claim_speculation(router, call["id"]) for call in calls))
+
+        # Una sola request de embeddings para todas las consultas que lo necesitan
+        # Una llamada sin query válida no entra al batch: falla sola, con su tool_error, dentro de search()
+        queries = list(dict.fromkeys(
+            query for query in (call["args"].get("query") for call, docs in zip(calls, speculative) if docs is None)
+            if isinstance(query, str) and needs_query_vector(
+                query,
+                options.get("dense_weight", DENSE_WEIGHT),
+                options.get("lexical_weight", LEXICAL_WEIGHT),
+            )
+        ))
+        embedding = asyncio.ensure_future(aembed_queries(retriever, queries)) if queries else None
+
+        async def search(call, docs):
+            if docs is not None:
+                return docs
+            query = call["args"].get("query")
+            if not isinstance(query, str):
+                raise ValueError("retrieve needs a `query` string")
+            vector = None
+            if query in queries:
+                # shield: si esta búsqueda vence su timeout no cancela el batch de las demás
+                vector = (await asyncio.shield(embedding))[queries.index(query)]
+            return await router.search(query, config, retrieve_filters(**call["args"]), query_vector=vector)
+
+        results = await asyncio.gather(*(
+            with_timeout(call, search(call, docs)) for call, docs in zip(calls, speculative)
+        ))
+        if embedding is not None and not embedding.done():
+            embedding.cancel()
+
+        # Deduplicar entre llamadas: cada chunk queda en la llamada donde rankea mejor
+        found = [i for i, result in enumerate(results) if isinstance(result, list)]
+        for i, docs in zip(found, dedupe_across([results[i] for i in found])):
+            results[i] = docs
+
+        return [
+            result if isinstance(result, ToolMessage) else ToolMessage(
+                content=serialize_docs(result), artifact=result, name=call["name"], tool_call_id=call["id"]
+            )
+            for call, result in zip(calls, results)
+        ]
+
+    async def run_other(call, config):
+        tool_ = tools_by_name.get(call["name"])
+        if tool_ is None:
+            return tool_error(call, f"{call['name']} is not a valid tool")
+        return await with_timeout(call, tool_.ainvoke({**call, "type": "tool_call"}, config))
+
+    async def run_tools(state: State, config: RunnableConfig):
+        calls = state["messages"][-1].tool_calls
+        retrieve_calls = [call for call in calls if call["name"] == retrieve_tool.name]
+        other_calls = [call for call in calls if call["name"] != retrieve_tool.name]
+
+        retrieved, *others = await asyncio.gather(
+            retrieve_batch(retrieve_calls, config) if retrieve_calls else asyncio.sleep(0, []),
+            *(run_other(call, config) for call in other_calls)
+        )
+        by_id = {msg.tool_call_id: msg for msg in [*retrieved, *others]}
+        if len(retrieve_calls) > 1:
+            logger.info(f"Ran {len(retrieve_calls)} retrieve calls with one embedding batch")
+        return {"messages": [by_id[call["id"]] for call in calls]}
+
+    return run_tools
+
+
 # Generate final answer
-def generate(state: State):
+async def generate(state: State, config: RunnableConfig):
     summary = state.get("summary", "")
     messages = state["messages"]
 
-    # tomar outputs de herramientas recientes
-    recent_tool_messages = [
-        msg for msg in reversed(messages) if msg.type == "tool"
-    ][::-1]
+    # tomar outputs de herramientas del turno actual (después del último mensaje del usuario)
+    recent_tool_messages = []
+    for msg in reversed(messages):
+        if msg.type == "human":
+            break
+        if msg.type == "tool":
+            recent_tool_messages.append(msg)
+    recent_tool_messages.reverse()
 
-    context_blocks = [f"Tool output:\n{msg.content}" for msg in recent_tool_messages]
-    tool_context = "\n\n".join(context_blocks)
+    # Empaquetar el contexto dentro del presupuesto de tokens
+    budget = retrieval_options(config).get("context_budget", CONTEXT_TOKEN_BUDGET)
+    tool_context, usage = pack_context(recent_tool_messages, budget=budget)
 
     # Inyectar resumen si existe
     system_prompts = []
@@ -133,21 +358,21 @@ def generate(state: State):
     ]
 
     prompt = system_prompts + history
-    response = llm.invoke(prompt)
+    response = await llm.ainvoke(prompt)
 
-    return {"messages": [response]}
+    return {"messages": [response], "context_tokens": usage["tokens"]}
 
 
-def get_graph(retrieve_tool):
-    query_or_respond = make_query_or_respond(retrieve_tool)
-    tools = ToolNode([retrieve_tool, repl_tool])
+def get_graph(retrieve_tool, router, retriever):
+    query_or_respond = make_query_or_respond(retrieve_tool, router)
+    tools = make_tools_node(retrieve_tool, [retrieve_tool, repl_tool], router, retriever)
 
     graph_builder = StateGraph(State)
 
-    graph_builder.add_node("memory_check", memory_check_and_summarize)
-    graph_builder.add_node("query_or_respond", query_or_respond)
-    graph_builder.add_node("tools", tools)
-    graph_builder.add_node("generate", generate)
+    graph_builder.add_node("memory_check", timed_node("memory_check", memory_check_and_summarize))
+    graph_builder.add_node("query_or_respond", timed_node("query_or_respond", query_or_respond))
+    graph_builder.add_node("tools", timed_node("tools", tools))
+    graph_builder.add_node("generate", timed_node("generate", generate))
 
     graph_builder.set_entry_point("memory_check")
     graph_builder.add_edge("memory_check", "query_or_respond")
@@ -159,4 +384,41 @@ def get_graph(retrieve_tool):
     graph_builder.add_edge("tools", "generate")
     graph_builder.add_edge("generate", END)
 
-    return graph_builder.compile()
\ No newline at end of file
+    return graph_builder.compile()
+
+
+# Nodos cuyos tokens se envían al cliente (memory_check también llama al LLM al resumir)
+STREAMED_NODES = ("query_or_respond", "generate")
+
+async def stream_graph(graph, state, config=None):
+    """Run the graph yielding (event, data) pairs as it executes.
+
+    Events: `node` when a node finishes, `sources` with the retrieved documents,
+    `token` for each LLM token of the answer, and a last `final` with the final state.
+    """
+    final_state = state
+    async for mode, chunk in graph.astream(state, config=config, stream_mode=["updates", "messages", "values"]):
+        if mode == "messages":
+            message, metadata = chunk
+            node = metadata.get("langgraph_node")
+            if node in STREAMED_NODES and isinstance(message, AIMessageChunk) and message.content:
+                yield "token", {"node": node, "text": message.content}
+
+        elif mode == "updates":
+            for node, update in chunk.items():
+                yield "node", {"node": node}
+                if node != "tools" or not update:
+                    continue
+                sources = [
+                    source_metadata(doc)
+                    for msg in update.get("messages", [])
+                    for doc in (getattr(msg, "artifact", None) or [])
+                    if hasattr(doc, "metadata")
+                ]
+                if sources:
+                    yield "sources", {"sources": sources}
+
+        elif mode == "values":
+            final_state = chunk
+
+    yield "final", final_state
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from langchain_core.messages import HumanMessage, ToolMessage
+import numpy as np
+import logging
+import os
+import re
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1024))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 3600))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+
+
+def normalize_question(text):
+    """Lowercase, strip accents/punctuation and collapse whitespace"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def retrieved_doc_ids(messages):
+    """doc_ids returned by retrieve calls in the last turn (after the last human message)"""
+    doc_ids = set()
+    for msg in reversed(messages):
+        if isinstance(msg, HumanMessage):
+            break
+        if isinstance(msg, ToolMessage) and msg.name == "retrieve":
+            doc_ids.update(doc.metadata.get("doc_id") for doc in (msg.artifact or []))
+    return doc_ids
+
+
+@dataclass
+class CacheContext:
+    """What a lookup computed for a question, reused to store the answer on a miss"""
+    key: str
+    vector: np.ndarray
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    vector: np.ndarray
+    doc_ids: frozenset
+    created_at: float = field(default_factory=time.time)
+
+
+class AnswerCache:
+    """Semantic answer cache keyed on the question and validated against retrieval.
+
+    A candidate needs either the same normalized question or an embedding similarity
+    above `threshold`. It is a hit only if the question, run through `search` (the
+    retrieve tool's search), still finds every `doc_id` the cached answer was based on.
+    """
+
+    def __init__(self, search, embeddings, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                 threshold=ANSWER_CACHE_SIMILARITY):
+        self.search = search
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0, "validations": 0}
+
+    def _expired(self, entry):
+        return time.time() - entry.created_at > self.ttl
+
+    def _nearest(self, key, vector):
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+
+        entries = list(self._entries.values())
+        if not entries:
+            return None
+        matrix = np.stack([e.vector for e in entries])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return entries[best] if scores[best] >= self.threshold else None
+
+    async def lookup(self, question, config=None):
+        """Return (CachedAnswer or None, CacheContext)"""
+        key = normalize_question(question)
+        query_vector = await self.embeddings.aembed_query(question)
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        context = CacheContext(key, vector)
+
+        entry = self._nearest(key, vector)
+        if entry is not None and self._expired(entry):
+            self._entries.pop(normalize_question(entry.question), None)
+            entry = None
+        if entry is None:
+            self.counters["misses"] += 1
+            return None, context
+
+        # Solo se valida si hay candidato; el vector ya calculado evita otro embedding
+        self.counters["validations"] += 1
+        docs = await self.search(question, config, query_vector=query_vector)
+        if not entry.doc_ids <= {doc.metadata.get("doc_id") for doc in docs}:
+            self.counters["misses"] += 1
+            return None, context
+
+        self._entries.move_to_end(normalize_question(entry.question))
+        self.counters["hits"] += 1
+        logger.info(f"Answer cache hit for: {question!r}")
+        return entry, context
+
+    def store(self, question, context, answer, doc_ids):
+        """Cache `answer`, based on the retrieved chunks `doc_ids`"""
+        if not doc_ids:
+            return
+        self._entries[context.key] = CachedAnswer(question, answer, context.vector, frozenset(doc_ids))
+        self._entries.move_to_end(context.key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self.counters["stores"] += 1
+
+    def clear(self):
+        """Drop every entry (called when new documents are ingested)"""
+        if self._entries:
+            self.counters["invalidations"] += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), **self.counters}
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+INGEST_CACHE_PATH = os.environ.get("INGEST_CACHE_PATH", "./ingest_cache.sqlite")
+# Las particiones guardan los elementos completos (imágenes en base64 incluidas): se acotan por
+# tamaño total y por tiempo sin uso, descartando primero las usadas hace más tiempo
+PARTITION_CACHE_MAX_BYTES = int(os.environ.get("PARTITION_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+PARTITION_CACHE_TTL = float(os.environ.get("PARTITION_CACHE_TTL", 30 * 24 * 3600))
+# namespace -> (bytes máximos, segundos sin uso); el resto de los namespaces no se poda
+CACHE_LIMITS = {"partitions": (PARTITION_CACHE_MAX_BYTES, PARTITION_CACHE_TTL)}
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def content_hash(data):
+    """sha256 hex digest of a str or bytes payload"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    """sha256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestionCache:
+    """Content-addressed key/value cache persisted in SQLite.
+
+    Entries live in namespaces (partitions, image descriptions, table summaries...)
+    and values are stored as JSON. Safe to share between the ingestion worker processes.
+    Namespaces in `limits` ({namespace: (max bytes, ttl seconds)}) are pruned on
+    every write: expired entries first, then the least recently used ones.
+    """
+
+    def __init__(self, path=INGEST_CACHE_PATH, limits=CACHE_LIMITS):
+        self.path = path
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL DEFAULT 0,"
+            " accessed_at REAL NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        # Migración de cachés creadas antes de registrar tamaño y último uso
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(cache)")}
+        if "size" not in columns:
+            self._conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("ALTER TABLE cache ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            self._conn.execute("UPDATE cache SET size = LENGTH(value), accessed_at = ?", (time.time(),))
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed_at)")
+        self._conn.commit()
+
+    def get(self, namespace, key):
+        return self.get_many(namespace, [key]).get(key)
+
+    def get_many(self, namespace, keys):
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            # SQLite limita la cantidad de parámetros por consulta
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM cache WHERE namespace = ? AND key IN ({','.join('?' * len(batch))})",
+                    [namespace, *batch],
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            if found and namespace in self.limits:
+                self._conn.executemany(
+                    "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    [(time.time(), namespace, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def set(self, namespace, key, value):
+        self.set_many(namespace, {key: value})
+
+    def set_many(self, namespace, items):
+        now = time.time()
+        rows = [(namespace, key, value, len(value), now) for key, value in
+                ((key, json.dumps(value)) for key, value in items.items())]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, size, accessed_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            if namespace in self.limits:
+                self._prune(namespace, *self.limits[namespace])
+            self._conn.commit()
+
+    def _prune(self, namespace, max_bytes, ttl):
+        removed = self._conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND accessed_at < ?", (namespace, time.time() - ttl)
+        ).rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?", (namespace,)).fetchone()[0]
+        if total > max_bytes:
+            evict = []
+            for key, size in self._conn.execute(
+                "SELECT key, size FROM cache WHERE namespace = ? ORDER BY accessed_at", (namespace,)
+            ).fetchall():
+                if total <= max_bytes:
+                    break
+                evict.append((namespace, key))
+                total -= size
+            self._conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", evict)
+            removed += len(evict)
+        if removed:
+            logger.info(f"Pruned {removed} entries from the {namespace} cache")
+
+
+_cache = None
+
+
+def get_cache():
+    """Per-process cache instance (SQLite connections can't cross process boundaries)"""
+    global _cache
+    if _cache is None:
+        _cache = IngestionCache()
+    return _cache
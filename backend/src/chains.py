@@ -1,10 +1,11 @@
-from langchain_openai import ChatOpenAI
+from src.providers import get_chat_model
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 import os
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
+# Sin reintentos del cliente: los 429 los maneja el EnrichmentScheduler (backoff y concurrencia)
 def get_image_chain():
     prompt_template = """Describe the image in detail"""
     messages = [
@@ -22,7 +23,7 @@ def get_image_chain():
 
     prompt = ChatPromptTemplate.from_messages(messages)
 
-    image_chain = prompt | ChatOpenAI(model="gpt-4o-mini", api_key=OPENAI_API_KEY, max_tokens=300) | StrOutputParser()
+    image_chain = prompt | get_chat_model("gpt-4o-mini", max_tokens=300, max_retries=0) | StrOutputParser()
     return image_chain
 
 def get_text_chain():
@@ -39,5 +40,5 @@ def get_text_chain():
     """
     prompt = ChatPromptTemplate.from_template(prompt_text)
 
-    text_chain = prompt | ChatOpenAI(model="gpt-4o-mini", api_key=OPENAI_API_KEY, max_tokens=150) | StrOutputParser()
+    text_chain = prompt | get_chat_model("gpt-4o-mini", max_tokens=150, max_retries=0) | StrOutputParser()
     return text_chain
\ No newline at end of file
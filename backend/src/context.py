@@ -0,0 +1,108 @@
+import logging
+import math
+import os
+import re
+from html import unescape
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 3000))
+# Misma aproximación que count_tokens_approximately de langchain
+CHARS_PER_TOKEN = 4.0
+# No vale la pena agregar un bloque recortado a menos de esto
+MIN_BLOCK_TOKENS = 50
+
+
+def approx_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def compact_table_html(text):
+    """Turn table HTML into pipe-separated rows (much fewer tokens, same cell values)"""
+    if "<t" not in text:
+        return text
+    text = re.sub(r"</t[dh]\s*>", " | ", text, flags=re.IGNORECASE)
+    text = re.sub(r"</tr\s*>", "\n", text, flags=re.IGNORECASE)
+    text = re.sub(r"<[^>]+>", "", text)
+    text = unescape(text)
+    lines = [re.sub(r"[ \t]+", " ", line).strip(" |") for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+def format_source(metadata):
+    """Short source header: filename, page and content type only"""
+    filename = metadata.get("filename", "unknown")
+    page = metadata.get("page_number", "?")
+    content_type = metadata.get("content_type", "text")
+    return f"[{filename} p.{page} {content_type}]"
+
+
+def _ranked_docs(tool_messages):
+    """Interleave documents of several retrieve calls by rank so each call gets its share"""
+    lists = [msg.artifact for msg in tool_messages if isinstance(getattr(msg, "artifact", None), list)]
+    ranked = []
+    for rank in range(max((len(docs) for docs in lists), default=0)):
+        ranked.extend(docs[rank] for docs in lists if rank < len(docs))
+    return ranked
+
+
+def _blocks(tool_messages):
+    """(header, text) blocks in priority order; same-page text chunks are merged into one block"""
+    blocks = []
+    page_blocks = {}
+    seen = set()
+    for doc in _ranked_docs(tool_messages):
+        doc_id = doc.metadata.get("doc_id")
+        if doc_id is not None and doc_id in seen:
+            continue
+        seen.add(doc_id)
+
+        text = compact_table_html(doc.page_content) if doc.metadata.get("content_type") == "table" else doc.page_content
+        if doc.metadata.get("content_type", "text") == "text":
+            key = (doc.metadata.get("filename"), doc.metadata.get("page_number"))
+            if key in page_blocks:
+                page_blocks[key][1].append(text)
+                continue
+            page_blocks[key] = [format_source(doc.metadata), [text]]
+            blocks.append(page_blocks[key])
+        else:
+            blocks.append([format_source(doc.metadata), [text]])
+
+    # Salidas de otras herramientas (python_repl...) van después de los documentos
+    for msg in tool_messages:
+        if not isinstance(getattr(msg, "artifact", None), list) and msg.content:
+            blocks.append([f"[{msg.name or 'tool'} output]", [str(msg.content)]])
+
+    return [(header, "\n".join(texts)) for header, texts in blocks]
+
+
+def pack_context(tool_messages, budget=CONTEXT_TOKEN_BUDGET):
+    """Build the generate() context from tool outputs without exceeding `budget` tokens.
+
+    Returns (context, usage) where usage reports tokens used and blocks kept/dropped.
+    """
+    parts = []
+    used = 0
+    blocks = _blocks(tool_messages)
+    dropped = 0
+    for header, text in blocks:
+        block = f"{header}\n{text}"
+        cost = approx_tokens(block) + 1
+        if used + cost <= budget:
+            parts.append(block)
+            used += cost
+            continue
+
+        # Recortar el bloque al espacio que queda, si vale la pena
+        remaining = budget - used - approx_tokens(header) - 2
+        if remaining >= MIN_BLOCK_TOKENS:
+            block = f"{header}\n{text[:int(remaining * CHARS_PER_TOKEN)]}…"
+            parts.append(block)
+            used += approx_tokens(block) + 1
+        dropped = len(blocks) - len(parts)
+        break
+
+    usage = {"tokens": used, "budget": budget, "blocks": len(parts), "dropped": dropped}
+    logger.info(f"Context packed: {used}/{budget} tokens, {len(parts)} blocks ({dropped} dropped)")
+    return "\n\n".join(parts), usage
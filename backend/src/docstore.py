@@ -0,0 +1,82 @@
+from langchain_core.stores import BaseStore
+from langchain.schema import Document
+import json
+import os
+import sqlite3
+import threading
+
+
+class SQLiteDocStore(BaseStore[str, Document]):
+    """Disk-backed parent document store for MultiVectorRetriever.
+
+    Holds the full chunks (table HTML, image base64...) keyed by `doc_id`, while only
+    the compact child documents are embedded in the vectorstore.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " doc_id TEXT PRIMARY KEY,"
+            " page_content TEXT NOT NULL,"
+            " metadata TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def mget(self, keys):
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # SQLite limita la cantidad de parámetros por consulta
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT doc_id, page_content, metadata FROM documents WHERE doc_id IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for doc_id, page_content, metadata in rows:
+                    found[doc_id] = Document(page_content=page_content, metadata=json.loads(metadata))
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO documents (doc_id, page_content, metadata) VALUES (?, ?, ?)",
+                [(key, doc.page_content, json.dumps(doc.metadata)) for key, doc in key_value_pairs],
+            )
+            self._conn.commit()
+
+    def mdelete(self, keys):
+        keys = list(keys)
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                self._conn.execute(
+                    f"DELETE FROM documents WHERE doc_id IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+            self._conn.commit()
+
+    def yield_keys(self, prefix=None):
+        with self._lock:
+            if prefix:
+                rows = self._conn.execute(
+                    "SELECT doc_id FROM documents WHERE doc_id LIKE ?", (f"{prefix}%",)
+                ).fetchall()
+            else:
+                rows = self._conn.execute("SELECT doc_id FROM documents").fetchall()
+        for (doc_id,) in rows:
+            yield doc_id
+
+    def vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,481 @@
+from src.pdf_parser import save_to_multivectorstore, with_page
+from src.metrics import span
+from langchain.schema import Document
+from contextlib import asynccontextmanager
+import asyncio
+import fitz  # PyMuPDF
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Cada cuánto (segundos) compactar las bases SQLite propias si hubo borrados
+COMPACT_INTERVAL = int(os.environ.get("COMPACT_INTERVAL", 24 * 3600))
+CHROMA_BATCH_SIZE = 5000
+
+
+def page_hashes(pdf_path):
+    """Content fingerprint of each page: its content stream plus the images and forms it draws"""
+    hashes = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            digest = hashlib.sha256(page.read_contents())
+            for xref, *_ in page.get_images(full=True) + page.get_xobjects():
+                digest.update(doc.xref_stream_raw(xref) or b"")
+            hashes.append(digest.hexdigest())
+    return hashes
+
+
+def diff_pages(old_pages, new_hashes, spans=()):
+    """Match a new version's pages against the stored ones by content hash.
+
+    `old_pages` is {page_number: hash}. Returns (keep, changed): `keep` maps an
+    old page to the new page with the same content (it may have moved) and
+    `changed` lists the new pages that have to be processed. `spans` lists the
+    (first, last) old pages of stored chunks that run over several pages: if
+    any of their pages changes, their kept pages are processed again too.
+    """
+    available = {}
+    for page, digest in sorted(old_pages.items()):
+        available.setdefault(digest, []).append(page)
+
+    keep, changed = {}, []
+    for page, digest in enumerate(new_hashes, start=1):
+        candidates = available.get(digest)
+        if candidates:
+            # Preferir la página en la misma posición
+            old = page if page in candidates else candidates[0]
+            candidates.remove(old)
+            keep[old] = page
+        else:
+            changed.append(page)
+
+    # Un chunk de una sección multipágina con alguna página cambiada (o que ya no queda contigua) tiene
+    # texto viejo: se rearma procesando también sus páginas conservadas, lo que puede alcanzar a otros
+    stale = True
+    while stale:
+        stale = False
+        for first, last in spans:
+            pages = range(first, last + 1)
+            kept = [page for page in pages if page in keep]
+            if kept and (len(kept) < len(pages) or len({keep[page] - page for page in kept}) > 1):
+                changed.extend(keep.pop(page) for page in kept)
+                stale = True
+    return keep, sorted(changed)
+
+
+def sqlite_size(paths):
+    """Bytes on disk of SQLite databases, WAL and shared-memory files included"""
+    total = 0
+    for path in paths:
+        for name in (path, f"{path}-wal", f"{path}-shm"):
+            try:
+                total += os.path.getsize(name)
+            except OSError:
+                pass
+    return total
+
+
+class AmbiguousDocumentError(Exception):
+    """Raised when a document id matches several stored filenames (the same PDF under two names)"""
+
+    def __init__(self, document_id, filenames):
+        super().__init__(f"Document id {document_id} matches several files: {', '.join(filenames)}")
+        self.filenames = filenames
+        self.detail = str(self)
+
+
+def moved_metadata(metadata, page):
+    """Chunk metadata moved to start on `page` (its last page shifts by the same amount)"""
+    metadata = dict(metadata or {})
+    if isinstance(metadata.get("last_page"), int) and isinstance(metadata.get("page_number"), int):
+        metadata["last_page"] += page - metadata["page_number"]
+    metadata["page_number"] = page
+    return metadata
+
+
+class DocumentCatalog:
+    """Ingested files, their page hashes and the chunks stored for each page (SQLite).
+
+    A document is identified by its filename; `document_id` is the hash of the
+    version currently stored.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " filename TEXT PRIMARY KEY,"
+            " document_id TEXT NOT NULL,"
+            " pages INTEGER,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " filename TEXT NOT NULL,"
+            " page_number INTEGER NOT NULL,"
+            " page_hash TEXT NOT NULL,"
+            " PRIMARY KEY (filename, page_number)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " doc_id TEXT PRIMARY KEY,"
+            " filename TEXT NOT NULL,"
+            " page_number INTEGER,"
+            " last_page INTEGER)"
+        )
+        # Migración de catálogos creados antes de registrar la última página de cada chunk
+        if "last_page" not in {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}:
+            self._conn.execute("ALTER TABLE chunks ADD COLUMN last_page INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_filename ON chunks (filename, page_number)")
+        self._conn.commit()
+
+    def list(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT d.filename, d.document_id, d.pages, d.created_at, d.updated_at, COUNT(c.doc_id)"
+                " FROM documents d LEFT JOIN chunks c ON c.filename = d.filename"
+                " GROUP BY d.filename ORDER BY d.filename"
+            ).fetchall()
+        return [
+            {"filename": filename, "document_id": document_id, "pages": pages,
+             "chunks": chunks, "created_at": created_at, "updated_at": updated_at}
+            for filename, document_id, pages, created_at, updated_at, chunks in rows
+        ]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def resolve(self, filename=None, document_id=None):
+        """Filename of the document matching `filename` or `document_id`, or None.
+        Raises AmbiguousDocumentError if `document_id` is stored under several filenames."""
+        with self._lock:
+            if filename is not None:
+                row = self._conn.execute("SELECT filename FROM documents WHERE filename = ?", (filename,)).fetchone()
+                if row:
+                    return row[0]
+            filenames = [row[0] for row in self._conn.execute(
+                "SELECT filename FROM documents WHERE document_id = ? ORDER BY filename", (document_id,)
+            )]
+        if len(filenames) > 1:
+            raise AmbiguousDocumentError(document_id, filenames)
+        return filenames[0] if filenames else None
+
+    def page_hashes(self, filename):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page_number, page_hash FROM pages WHERE filename = ?", (filename,)
+            ).fetchall()
+        return dict(rows)
+
+    def chunks(self, filename):
+        """[(doc_id, page_number)] stored for `filename`"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT doc_id, page_number FROM chunks WHERE filename = ?", (filename,)
+            ).fetchall()
+
+    def spans(self, filename):
+        """[(first page, last page)] of the stored chunks of `filename` that run over several pages"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT page_number, last_page FROM chunks WHERE filename = ? AND last_page > page_number",
+                (filename,),
+            ).fetchall()
+
+    def add_chunks(self, filename, chunks):
+        """Register stored chunks [(doc_id, page, last page)] of `filename` (as each page window is written)"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (doc_id, filename, page_number, last_page) VALUES (?, ?, ?, ?)",
+                [(doc_id, filename, page, last_page) for doc_id, page, last_page in chunks],
+            )
+            self._conn.commit()
+
+    def remove_chunks(self, doc_ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM chunks WHERE doc_id = ?", [(doc_id,) for doc_id in doc_ids])
+            self._conn.commit()
+
+    def save_version(self, filename, document_id, hashes, removed, moved):
+        """Record a new version: page hashes, removed doc ids and moved {doc_id: page}.
+        Its chunks were registered with add_chunks while they were written."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO documents (filename, document_id, pages, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (filename) DO UPDATE SET"
+                " document_id = excluded.document_id, pages = excluded.pages, updated_at = excluded.updated_at",
+                (filename, document_id, len(hashes), now, now),
+            )
+            self._conn.execute("DELETE FROM pages WHERE filename = ?", (filename,))
+            self._conn.executemany(
+                "INSERT INTO pages (filename, page_number, page_hash) VALUES (?, ?, ?)",
+                [(filename, page, digest) for page, digest in enumerate(hashes, start=1)],
+            )
+            self._conn.executemany("DELETE FROM chunks WHERE doc_id = ?", [(doc_id,) for doc_id in removed])
+            # Un chunk conservado se mueve entero: la última página se corre lo mismo que la primera
+            self._conn.executemany(
+                "UPDATE chunks SET last_page = last_page + ? - page_number, page_number = ? WHERE doc_id = ?",
+                [(page, page, doc_id) for doc_id, page in moved.items()],
+            )
+            self._conn.commit()
+
+    def remove(self, filename):
+        with self._lock:
+            for table in ("documents", "pages", "chunks"):
+                self._conn.execute(f"DELETE FROM {table} WHERE filename = ?", (filename,))
+            self._conn.commit()
+
+    def backfill(self, vectorstore):
+        """Register chunks ingested before the catalog existed (without page hashes: their
+        first upsert re-processes every page)"""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM documents LIMIT 1").fetchone():
+                return 0
+        chunks, documents = [], {}
+        offset = 0
+        while True:
+            batch = vectorstore.get(include=["metadatas"], limit=CHROMA_BATCH_SIZE, offset=offset)
+            for doc_id, metadata in zip(batch["ids"], batch["metadatas"]):
+                filename = (metadata or {}).get("filename", "unknown")
+                chunks.append((doc_id, filename, (metadata or {}).get("page_number"), (metadata or {}).get("last_page")))
+                documents.setdefault(filename, (metadata or {}).get("file_hash", ""))
+            if len(batch["ids"]) < CHROMA_BATCH_SIZE:
+                break
+            offset += CHROMA_BATCH_SIZE
+        if not chunks:
+            return 0
+
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO documents (filename, document_id, pages, created_at, updated_at)"
+                " VALUES (?, ?, NULL, ?, ?)",
+                [(filename, document_id, now, now) for filename, document_id in documents.items()],
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunks (doc_id, filename, page_number, last_page) VALUES (?, ?, ?, ?)", chunks
+            )
+            self._conn.commit()
+        logger.info(f"Document catalog backfilled: {len(documents)} documents, {len(chunks)} chunks")
+        return len(documents)
+
+    def vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DocumentManager:
+    """Document-level operations over the vectorstore, docstore and lexical index.
+
+    Writes for the same filename are serialized with `lock(filename)`; the
+    lock is dropped once nobody holds or waits for it.
+    `on_changed()` is called whenever stored chunks change (e.g. to clear the
+    answer cache).
+    """
+
+    def __init__(self, retriever, lexical_index, catalog, on_changed=None):
+        self.retriever = retriever
+        self.lexical_index = lexical_index
+        self.catalog = catalog
+        self.on_changed = on_changed
+        # filename -> [lock, tareas que lo tienen o lo esperan]
+        self._locks = {}
+        self.deleted_since_compaction = 0
+        self.last_compaction = None
+
+    @asynccontextmanager
+    async def lock(self, filename):
+        entry = self._locks.setdefault(filename, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[filename]
+
+    def _changed(self):
+        if self.on_changed:
+            self.on_changed()
+
+    def _delete_chunks(self, doc_ids):
+        if not doc_ids:
+            return
+        with span("ingest", stage="delete"):
+            for i in range(0, len(doc_ids), CHROMA_BATCH_SIZE):
+                self.retriever.vectorstore.delete(ids=doc_ids[i:i + CHROMA_BATCH_SIZE])
+            self.retriever.docstore.mdelete(doc_ids)
+            if self.lexical_index is not None:
+                self.lexical_index.delete(doc_ids)
+        self.deleted_since_compaction += len(doc_ids)
+
+    def _relabel(self, moved):
+        """Move kept chunks to their new page: metadata, plus the "Table/Image from page N"
+        prefix of their text. Unchanged texts hit the embedding cache when re-written."""
+        ids = list(moved)
+        vectorstore = self.retriever.vectorstore
+        for i in range(0, len(ids), CHROMA_BATCH_SIZE):
+            current = vectorstore.get(ids=ids[i:i + CHROMA_BATCH_SIZE], include=["metadatas", "documents"])
+            vectorstore.update_documents(current["ids"], [
+                Document(page_content=with_page(text, moved[doc_id]), metadata=moved_metadata(metadata, moved[doc_id]))
+                for doc_id, metadata, text in zip(current["ids"], current["metadatas"], current["documents"])
+            ])
+        parents, retexted = [], []
+        for doc_id, parent in zip(ids, self.retriever.docstore.mget(ids)):
+            if parent is not None:
+                text = with_page(parent.page_content, moved[doc_id])
+                if text != parent.page_content:
+                    retexted.append(parent)
+                parent.page_content = text
+                parent.metadata = moved_metadata(parent.metadata, moved[doc_id])
+                parents.append((doc_id, parent))
+        self.retriever.docstore.mset(parents)
+        if self.lexical_index is not None:
+            self.lexical_index.update_pages(moved)
+            if retexted:
+                # El número de página del prefijo también está indexado
+                self.lexical_index.delete([parent.metadata["doc_id"] for parent in retexted])
+                self.lexical_index.add_documents(retexted)
+
+    def delete(self, filename):
+        """Remove every chunk of `filename`. Returns how many chunks were deleted."""
+        doc_ids = [doc_id for doc_id, _ in self.catalog.chunks(filename)]
+        self._delete_chunks(doc_ids)
+        self.catalog.remove(filename)
+        self._changed()
+        logger.info(f"Deleted {filename} ({len(doc_ids)} chunks)")
+        return len(doc_ids)
+
+    def writer(self, filename):
+        """VersionWriter to store a new version of `filename` window by window (hold `lock(filename)`)"""
+        return VersionWriter(self, filename)
+
+    def apply(self, filename, children, parents, version):
+        """Store a processed version of `filename` in one go and drop the chunks it replaces"""
+        writer = self.writer(filename)
+        try:
+            writer.write(children, parents)
+            return writer.commit(version)
+        except Exception:
+            writer.rollback()
+            raise
+
+    def compact(self):
+        """VACUUM the docstore, lexical index and catalog and report the bytes reclaimed.
+
+        Chroma's own files are left to Chroma: its database is held open by the
+        client and its HNSW segments are not SQLite.
+        """
+        stores = [self.retriever.docstore, self.catalog]
+        if self.lexical_index is not None:
+            stores.append(self.lexical_index)
+        paths = [store.path for store in stores]
+        before = sqlite_size(paths)
+        with span("ingest", stage="compaction"):
+            for store in stores:
+                store.vacuum()
+        after = sqlite_size(paths)
+        self.deleted_since_compaction = 0
+        self.last_compaction = time.time()
+        logger.info(f"Compacted {len(paths)} stores: {before / 2**20:.1f} MiB -> {after / 2**20:.1f} MiB")
+        return {"bytes_before": before, "bytes_after": after, "bytes_reclaimed": before - after}
+
+    def stats(self):
+        return {
+            "documents": self.catalog.count(),
+            "deleted_since_compaction": self.deleted_since_compaction,
+            "last_compaction": self.last_compaction,
+        }
+
+
+class VersionWriter:
+    """Writes a new version of one document as its page windows arrive.
+
+    The chunks stored before the first write are snapshotted so commit() can
+    tell which old ones the version replaces. Every window is registered in the
+    catalog as it is written, so a crash never leaves untracked chunks; on a
+    failure, rollback() deletes the chunks this version added.
+    """
+
+    def __init__(self, manager, filename):
+        self.manager = manager
+        self.filename = filename
+        self.stored = manager.catalog.chunks(filename)
+        self.written = set()
+        self.added = 0
+
+    def write(self, children, parents):
+        """Store one window of (children, parents). Returns how many new chunks were embedded."""
+        if not children:
+            return 0
+        manager = self.manager
+        added = save_to_multivectorstore(children, parents, manager.retriever, manager.lexical_index)
+        manager.catalog.add_chunks(self.filename, [
+            (doc.metadata["doc_id"], doc.metadata["page_number"], doc.metadata.get("last_page")) for doc in children
+        ])
+        self.written.update(doc.metadata["doc_id"] for doc in children)
+        self.added += added
+        if added:
+            manager._changed()
+        return added
+
+    def commit(self, version):
+        """Finish the version and drop the chunks it replaces.
+
+        `version` comes from the ingestion worker: the new `document_id`, the
+        page `hashes`, `keep` ({old page: new page} with unchanged content) and
+        the `changed` pages that were processed into the written windows.
+        """
+        manager = self.manager
+        keep = version["keep"]
+        # Los ids nuevos pueden coincidir con los viejos (mismo archivo sin hashes de página registrados)
+        removed = [doc_id for doc_id, page in self.stored if page not in keep and doc_id not in self.written]
+        moved = {doc_id: keep[page] for doc_id, page in self.stored if page in keep and keep[page] != page}
+
+        if moved:
+            manager._relabel(moved)
+        manager._delete_chunks(removed)
+        manager.catalog.save_version(self.filename, version["document_id"], version["hashes"], removed, moved)
+        if removed or moved:
+            manager._changed()
+
+        report = {
+            "pages": len(version["hashes"]),
+            "reprocessed": len(version["changed"]),
+            "kept": len(keep),
+            "moved": len({page for page, new_page in keep.items() if page != new_page}),
+            "chunks_added": self.added,
+            "chunks_removed": len(removed),
+        }
+        logger.info(f"{self.filename}: {report}")
+        return report
+
+    def rollback(self):
+        """Delete the chunks written by this version that the stored one didn't have"""
+        previous = {doc_id for doc_id, _ in self.stored}
+        doc_ids = [doc_id for doc_id in self.written if doc_id not in previous]
+        if not doc_ids:
+            return
+        self.manager._delete_chunks(doc_ids)
+        self.manager.catalog.remove_chunks(doc_ids)
+        self.manager._changed()
+        logger.warning(f"{self.filename}: rolled back {len(doc_ids)} chunks of a failed version")
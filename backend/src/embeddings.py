@@ -0,0 +1,154 @@
+from langchain_core.embeddings import Embeddings
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from src.cache import get_cache, content_hash
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_QUERY_LRU_SIZE = int(os.environ.get("EMBEDDING_QUERY_LRU_SIZE", 2048))
+
+
+class CachedEmbeddings(Embeddings):
+    """Embedding layer in front of the provider.
+
+    - persistent cache keyed by content hash (shared with the ingestion cache)
+    - in-memory LRU for hot query strings
+    - request batching with bounded concurrency
+    """
+
+    def __init__(self, provider, batch_size=EMBEDDING_BATCH_SIZE,
+                 max_concurrency=EMBEDDING_MAX_CONCURRENCY, lru_size=EMBEDDING_QUERY_LRU_SIZE):
+        self.provider = provider
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.lru_size = lru_size
+        self.namespace = f"embedding:{getattr(provider, 'model', type(provider).__name__)}"
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+        self.counters = {
+            "lru_hits": 0,
+            "cache_hits": 0,
+            "misses": 0,
+            "batches": 0,
+            "batched_texts": 0,
+            "max_batch_size": 0,
+            "provider_seconds": 0.0,
+        }
+
+    # ---- LRU de queries ----
+
+    def _lru_get(self, text):
+        with self._lock:
+            vector = self._lru.get(text)
+            if vector is not None:
+                self._lru.move_to_end(text)
+                self.counters["lru_hits"] += 1
+            return vector
+
+    def _lru_put(self, text, vector):
+        with self._lock:
+            self._lru[text] = vector
+            self._lru.move_to_end(text)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    # ---- Caché persistente + batching ----
+
+    def _lookup(self, texts):
+        """Return (vectors by hash, {hash: text} still missing)"""
+        keys = [content_hash(text) for text in texts]
+        found = get_cache().get_many(self.namespace, keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        with self._lock:
+            self.counters["cache_hits"] += len(texts) - len(missing)
+            self.counters["misses"] += len(missing)
+        return keys, found, missing
+
+    def _record_batch(self, size, elapsed):
+        with self._lock:
+            self.counters["batches"] += 1
+            self.counters["batched_texts"] += size
+            self.counters["max_batch_size"] = max(self.counters["max_batch_size"], size)
+            self.counters["provider_seconds"] += elapsed
+
+    def _embed_batch(self, texts):
+        start = time.perf_counter()
+        vectors = self.provider.embed_documents(texts)
+        self._record_batch(len(texts), time.perf_counter() - start)
+        return vectors
+
+    async def _aembed_batch(self, texts):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            start = time.perf_counter()
+            vectors = await self.provider.aembed_documents(texts)
+        self._record_batch(len(texts), time.perf_counter() - start)
+        return vectors
+
+    def _batches(self, missing):
+        items = list(missing.items())
+        return [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+
+    def _store(self, batches, results, found):
+        computed = {}
+        for batch, vectors in zip(batches, results):
+            computed.update((key, vector) for (key, _), vector in zip(batch, vectors))
+        if computed:
+            get_cache().set_many(self.namespace, computed)
+        found.update(computed)
+
+    def embed_documents(self, texts):
+        keys, found, missing = self._lookup(texts)
+        batches = self._batches(missing)
+        results = list(self._pool.map(lambda batch: self._embed_batch([text for _, text in batch]), batches))
+        self._store(batches, results, found)
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts):
+        keys, found, missing = await asyncio.to_thread(self._lookup, texts)
+        batches = self._batches(missing)
+        results = await asyncio.gather(*(self._aembed_batch([text for _, text in batch]) for batch in batches))
+        await asyncio.to_thread(self._store, batches, results, found)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        vector = self._lru_get(text)
+        if vector is None:
+            vector = self.embed_documents([text])[0]
+            self._lru_put(text, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        vector = self._lru_get(text)
+        if vector is None:
+            vector = (await self.aembed_documents([text]))[0]
+            self._lru_put(text, vector)
+        return vector
+
+    async def aembed_queries(self, texts):
+        """Several queries at once: LRU first, then a single batched request for the misses"""
+        vectors = {text: self._lru_get(text) for text in dict.fromkeys(texts)}
+        missing = [text for text, vector in vectors.items() if vector is None]
+        if missing:
+            for text, vector in zip(missing, await self.aembed_documents(missing)):
+                vectors[text] = vector
+                self._lru_put(text, vector)
+        return [vectors[text] for text in texts]
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        counters["avg_batch_size"] = counters["batched_texts"] / counters["batches"] if counters["batches"] else 0.0
+        counters["avg_batch_seconds"] = counters["provider_seconds"] / counters["batches"] if counters["batches"] else 0.0
+        return counters
@@ -0,0 +1,222 @@
+from src.cache import get_cache, content_hash
+from src.metrics import span, count, set_gauge
+import asyncio
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Límite de requests al proveedor por proceso de ingesta (token bucket)
+ENRICH_REQUESTS_PER_MINUTE = float(os.environ.get("ENRICH_REQUESTS_PER_MINUTE", 300))
+ENRICH_BURST = int(os.environ.get("ENRICH_BURST", 10))
+# Concurrencia adaptativa: arranca en INITIAL, sube de a uno mientras no haya 429 y se divide a la mitad con cada 429
+ENRICH_INITIAL_CONCURRENCY = int(os.environ.get("ENRICH_INITIAL_CONCURRENCY", 4))
+ENRICH_MAX_CONCURRENCY = int(os.environ.get("ENRICH_MAX_CONCURRENCY", 16))
+ENRICH_MAX_RETRIES = int(os.environ.get("ENRICH_MAX_RETRIES", 6))
+# Backoff exponencial con jitter (segundos) cuando el error no trae Retry-After
+ENRICH_BACKOFF_BASE = float(os.environ.get("ENRICH_BACKOFF_BASE", 1.0))
+ENRICH_BACKOFF_MAX = 60.0
+
+
+def is_rate_limit(error):
+    """True for provider rate-limit errors (HTTP 429)"""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error):
+    """Seconds the provider asked to wait, if the error carries a Retry-After header"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    return random.uniform(0, min(ENRICH_BACKOFF_MAX, ENRICH_BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+    """Requests-per-second limiter: `capacity` requests of burst, refilled at `rate` per second"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def drain(self):
+        """Drop the accumulated burst (after a 429 the provider's window is already full)"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit: +1 per window of successes, halved on a rate limit.
+
+    A 429 also pauses every request until the provider's Retry-After (or the
+    backoff) has passed. Requests started before the last decrease don't halve
+    the limit again, so one burst of 429s counts once.
+    """
+
+    def __init__(self, initial=ENRICH_INITIAL_CONCURRENCY, minimum=1, maximum=ENRICH_MAX_CONCURRENCY):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait for a slot. Returns the start time to pass back to release()"""
+        async with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.active < int(self.limit):
+                    break
+                else:
+                    await self._cond.wait()
+            self.active += 1
+            return time.monotonic()
+
+    async def release(self, started, rate_limited=False, pause=0.0):
+        async with self._cond:
+            self.active -= 1
+            if rate_limited:
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+                if started >= self.decreased_at:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.decreased_at = time.monotonic()
+                    logger.warning(f"Enrichment rate limited: concurrency -> {int(self.limit)}, pausing {pause:.1f}s")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class EnrichmentScheduler:
+    """Runs the image-description and table-summary calls of a document as one pipeline.
+
+    Every task shares the token bucket and the adaptive limiter (same provider),
+    so images and tables are enriched concurrently. Results are checkpointed in
+    the ingestion cache as they complete: after a failure, re-ingesting the PDF
+    only calls the model for what is still missing.
+    """
+
+    def __init__(self, requests_per_minute=ENRICH_REQUESTS_PER_MINUTE, burst=ENRICH_BURST,
+                 limiter=None, max_retries=ENRICH_MAX_RETRIES, cache=None, on_progress=None):
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.limiter = limiter or AdaptiveLimiter()
+        self.max_retries = max_retries
+        self.cache = cache or get_cache()
+        # on_progress(done, total) a medida que se completan ítems
+        self.on_progress = on_progress
+        self._total = 0
+        self._done = 0
+
+    def _advance(self, items=1):
+        self._done += items
+        if self.on_progress and self._total:
+            self.on_progress(self._done, self._total)
+
+    async def _call(self, task, chain, payload):
+        for attempt in range(self.max_retries + 1):
+            waited = time.perf_counter()
+            started = await self.limiter.acquire()
+            await self.bucket.acquire()
+            count("enrichment_throttled", time.perf_counter() - waited, task=task)
+            try:
+                result = await chain.ainvoke(payload)
+            except Exception as e:
+                limited = is_rate_limit(e)
+                pause = retry_after(e) or backoff(attempt)
+                await self.limiter.release(started, rate_limited=limited, pause=pause)
+                count("enrichment_requests", task=task, outcome="rate_limited" if limited else "error")
+                if attempt == self.max_retries:
+                    raise
+                if limited:
+                    self.bucket.drain()
+                else:
+                    logger.warning(f"{task} failed (attempt {attempt + 1}), retrying in {pause:.1f}s: {e}")
+                    await asyncio.sleep(pause)
+            else:
+                await self.limiter.release(started)
+                count("enrichment_requests", task=task, outcome="ok")
+                return result
+
+    async def _generate(self, task, chain, key, payload):
+        result = await self._call(task, chain, payload)
+        # Checkpoint: cada resultado queda en la caché apenas llega
+        await asyncio.to_thread(self.cache.set, task, key, result)
+        self._advance()
+        return result
+
+    async def _run_task(self, task, chain, inputs):
+        keys = [content_hash(payload) for payload in inputs]
+        results = await asyncio.to_thread(self.cache.get_many, task, keys)
+        # Dedup de payloads idénticos dentro del mismo documento
+        missing = {key: payload for key, payload in zip(keys, inputs) if key not in results}
+        count("enrichment_items", len(inputs) - len(missing), task=task, source="cache")
+        self._advance(len(inputs) - len(missing))
+
+        with span("ingest", stage=task):
+            outputs = await asyncio.gather(
+                *(self._generate(task, chain, key, payload) for key, payload in missing.items()),
+                return_exceptions=True,
+            )
+        errors = [output for output in outputs if isinstance(output, BaseException)]
+        results.update((key, output) for key, output in zip(missing, outputs) if not isinstance(output, BaseException))
+        count("enrichment_items", len(missing) - len(errors), task=task, source="generated")
+
+        logger.info(f"{task}: {len(inputs) - len(missing)} reused | {len(missing) - len(errors)} generated"
+                    f" | {len(errors)} failed")
+        return [results.get(key) for key in keys], errors, len(missing) - len(errors)
+
+    async def run(self, jobs):
+        """`jobs` maps a task name (cache namespace) to (chain, inputs). Returns {task: outputs}.
+
+        Raises the first error after every task has finished, once all the
+        successful results are checkpointed.
+        """
+        jobs = {task: (chain, inputs) for task, (chain, inputs) in jobs.items() if chain and inputs}
+        self._total = sum(len(inputs) for _, inputs in jobs.values())
+        # El mismo scheduler se reutiliza entre ventanas de páginas: el progreso es por corrida
+        self._done = 0
+        started = time.perf_counter()
+        runs = await asyncio.gather(*(self._run_task(task, chain, inputs) for task, (chain, inputs) in jobs.items()))
+
+        generated = sum(run[2] for run in runs)
+        elapsed = time.perf_counter() - started
+        set_gauge("enrichment_concurrency", int(self.limiter.limit))
+        if generated:
+            set_gauge("enrichment_throughput", round(generated / elapsed, 3))
+            logger.info(f"Enrichment: {generated} items in {elapsed:.1f}s ({generated / elapsed:.2f}/s),"
+                        f" concurrency {int(self.limiter.limit)}")
+
+        errors = [error for run in runs for error in run[1]]
+        if errors:
+            raise RuntimeError(f"Enrichment failed for {len(errors)} items (completed ones are cached): {errors[0]}")
+        return {task: run[0] for task, run in zip(jobs, runs)}
@@ -1,11 +1,16 @@
 import fitz  # PyMuPDF
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
+from src.providers import get_chat_model
+from src.lexical import tokenize
+from src.metrics import count
 from pydantic import BaseModel, Field
 from typing import Optional
+from datetime import date
+from functools import lru_cache
+import asyncio
 import os
-import json
+import re
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
@@ -16,40 +21,172 @@ class FormularioPersona(BaseModel):
     direccion: Optional[str] = Field(description="Dirección de residencia")
     telefono: Optional[str] = Field(description="Número de teléfono")
 
-def extraer_texto_pdf(pdf_bytes: bytes) -> str:
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+# Procesos para leer formularios en lote (/upload_forms)
+FORM_WORKERS = int(os.environ.get("FORM_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+# Llamadas al LLM simultáneas para completar campos faltantes
+FORM_LLM_CONCURRENCY = int(os.environ.get("FORM_LLM_CONCURRENCY", 8))
+
+CAMPOS = list(FormularioPersona.model_fields)
+_llm_slots = asyncio.Semaphore(FORM_LLM_CONCURRENCY)
+
+# Etiquetas (normalizadas con tokenize) con las que aparece cada campo en widgets o en el texto
+ALIAS = {
+    "nombre": ["nombre", "nombres", "primer nombre", "name", "first name", "given name"],
+    "apellidos": ["apellido", "apellidos", "last name", "surname", "family name"],
+    "fecha_nacimiento": ["fecha de nacimiento", "fecha nacimiento", "fecha nac", "f nacimiento", "nacimiento",
+                         "date of birth", "birth date", "birthdate", "dob"],
+    "direccion": ["direccion", "domicilio", "direccion de residencia", "address", "home address"],
+    "telefono": ["telefono", "tel", "celular", "movil", "telefono de contacto", "phone", "telephone", "mobile"],
+}
+ETIQUETAS = {alias: campo for campo, alias_campo in ALIAS.items() for alias in alias_campo}
+# Prefijos habituales en nombres de widgets (txtNombre, fld_telefono...)
+PREFIJOS_WIDGET = {"txt", "fld", "field", "campo", "input", "tb"}
+
+CLAVE_VALOR_RE = re.compile(r"^\s*([^:\n]{2,40}?)\s*:\s*(\S.*?)\s*$")
+FECHA_RE = [
+    (re.compile(r"^(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})$"), ("y", "m", "d")),
+    (re.compile(r"^(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})$"), ("d", "m", "y")),
+]
+
+
+def normalizar_etiqueta(texto):
+    # txtFechaNacimiento -> "fecha nacimiento"
+    texto = re.sub(r"([a-z])([A-Z])", r"\1 \2", texto)
+    tokens = [t for t in tokenize(texto.replace("_", " ")) if not t.isdigit()]
+    if len(tokens) > 1 and tokens[0] in PREFIJOS_WIDGET:
+        tokens = tokens[1:]
+    return " ".join(tokens)
+
+
+def normalizar_fecha(valor):
+    """YYYY-MM-DD, or None if the value isn't a recognizable date"""
+    for patron, orden in FECHA_RE:
+        match = patron.match(valor.strip())
+        if match:
+            partes = dict(zip(orden, map(int, match.groups())))
+            try:
+                return date(partes["y"], partes["m"], partes["d"]).isoformat()
+            except ValueError:
+                return None
+    return None
+
+
+def asignar(campos, fuentes, etiqueta, valor, fuente):
+    campo = ETIQUETAS.get(normalizar_etiqueta(etiqueta))
+    valor = (valor or "").strip()
+    if campo is None or not valor or campos.get(campo):
+        return
+    if campo == "fecha_nacimiento":
+        valor = normalizar_fecha(valor)
+        if valor is None:
+            return  # queda para el LLM
+    campos[campo] = valor
+    fuentes[campo] = fuente
+
+
+def extraer_texto_pdf(doc) -> str:
     texto = "\n".join([page.get_text() for page in doc][:5])  # Limita a 5 primeras páginas
-    doc.close()
     return texto[:15000]  # corta caracteres
 
+
+def abrir_pdf(pdf):
+    """PyMuPDF document from bytes or a file path"""
+    return fitz.open(stream=pdf, filetype="pdf") if isinstance(pdf, bytes) else fitz.open(pdf)
+
+
+def analizar_pdf(pdf):
+    """Tiers without LLM: AcroForm widget values, then "Label: value" lines of the text.
+
+    `pdf` is the file's bytes or path. Returns (campos, fuentes, texto); `texto`
+    is only extracted when some field is still missing. Runs in the form process pool.
+    """
+    campos, fuentes = {}, {}
+    with abrir_pdf(pdf) as doc:
+        for page in doc:
+            for widget in page.widgets() or []:
+                if widget.field_type in (fitz.PDF_WIDGET_TYPE_TEXT, fitz.PDF_WIDGET_TYPE_COMBOBOX):
+                    asignar(campos, fuentes, widget.field_label or widget.field_name or "",
+                            str(widget.field_value or ""), "acroform")
+                    asignar(campos, fuentes, widget.field_name or "", str(widget.field_value or ""), "acroform")
+
+        texto = None
+        if any(not campos.get(campo) for campo in CAMPOS):
+            texto = extraer_texto_pdf(doc)
+            for linea in texto.splitlines():
+                match = CLAVE_VALOR_RE.match(linea)
+                if match:
+                    asignar(campos, fuentes, match.group(1), match.group(2), "clave_valor")
+    return campos, fuentes, texto
+
+
+@lru_cache(maxsize=1)
 def get_extraction_chain():
-    model = ChatOpenAI(temperature=0, api_key=OPENAI_API_KEY)
+    """Chain built once and reused: extracts only the `campos` still missing"""
+    model = get_chat_model(temperature=0)
     parser = JsonOutputParser(pydantic_object=FormularioPersona)
 
     prompt = PromptTemplate(
         template=(
             "Extrae la siguiente información de una persona a partir del texto. "
-            "Devuelve solo JSON con esta estructura:\n"
+            "Solo hacen falta estos campos: {campos}. "
+            "Devuelve solo JSON con esta estructura (null en los campos que no estén):\n"
             "{format_instructions}\n\n"
             "Texto del documento:\n{query}\n"
         ),
-        input_variables=["query"],
+        input_variables=["query", "campos"],
         partial_variables={"format_instructions": parser.get_format_instructions()},
     )
 
     chain = prompt | model | parser
     return chain
 
+
+def faltantes(campos):
+    return [campo for campo in CAMPOS if not campos.get(campo)]
+
+
+def combinar(campos, fuentes, salida, pedidos):
+    """Merge the LLM output for the `pedidos` fields; returns the full FormularioPersona dict"""
+    for campo in pedidos:
+        valor = (salida or {}).get(campo)
+        if valor:
+            campos[campo] = valor
+            fuentes[campo] = "llm"
+    for campo in CAMPOS:
+        if not campos.get(campo):
+            campos[campo] = None
+            fuentes[campo] = None
+        count("form_fields", source=fuentes[campo] or "missing")
+    return {campo: campos[campo] for campo in CAMPOS}
+
+
 def extraer_campos_formulario(pdf_bytes: bytes) -> dict:
-    chain = get_extraction_chain()
-    texto = extraer_texto_pdf(pdf_bytes)
-
-    try:
-        salida = chain.invoke(texto)
-        return salida  
-    except Exception as e:
-        return {"error": f"No se pudo extraer o estructurar los datos: {str(e)}",
-                "raw_output": str(salida)}
+    campos, fuentes, texto = analizar_pdf(pdf_bytes)
+    pedidos = faltantes(campos)
+    salida = None
+    if pedidos and texto and texto.strip():
+        try:
+            salida = get_extraction_chain().invoke({"query": texto, "campos": ", ".join(pedidos)})
+        except Exception as e:
+            return {"error": f"No se pudo extraer o estructurar los datos: {str(e)}",
+                    "raw_output": str(salida)}
+    return combinar(campos, fuentes, salida, pedidos)
+
+
+async def aextraer_formulario(pdf, executor=None):
+    """Async tiered extraction of a PDF (bytes or path): the file is read in `executor`
+    (a process pool) or a thread, the LLM is called only for missing fields.
+    Returns (data, fuentes)."""
+    loop = asyncio.get_running_loop()
+    campos, fuentes, texto = await loop.run_in_executor(executor, analizar_pdf, pdf)
+    pedidos = faltantes(campos)
+    salida = None
+    if pedidos and texto and texto.strip():
+        async with _llm_slots:
+            salida = await get_extraction_chain().ainvoke({"query": texto, "campos": ", ".join(pedidos)})
+    data = combinar(campos, fuentes, salida, pedidos)
+    return data, {campo: fuentes[campo] for campo in CAMPOS}
+
 
 # def clasificar_pagina(self, texto: str) -> str:
 #     prompt = f"""
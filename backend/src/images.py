@@ -0,0 +1,175 @@
+from PIL import Image, UnidentifiedImageError
+import base64
+import binascii
+import io
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Preprocesamiento de imágenes antes de la llamada de visión
+IMAGE_PREPROCESS = os.environ.get("IMAGE_PREPROCESS", "1") == "1"
+# Imágenes más chicas que esto (lado menor, px) se consideran íconos/decoración
+IMAGE_MIN_SIDE = int(os.environ.get("IMAGE_MIN_SIDE", 48))
+# Entropía mínima (bits) del histograma en grises: separadores, fondos y bloques lisos quedan debajo
+IMAGE_MIN_ENTROPY = float(os.environ.get("IMAGE_MIN_ENTROPY", 1.5))
+# Distancia de Hamming máxima entre dHashes de 64 bits para considerar dos imágenes iguales
+IMAGE_HASH_DISTANCE = int(os.environ.get("IMAGE_HASH_DISTANCE", 5))
+# El modelo de visión reescala a ~768 px de lado menor: enviar más es pagar bytes de más
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", 1024))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 80))
+
+
+def decode(payload):
+    """PIL image from a base64 payload, or None if it isn't a readable image"""
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(payload, validate=True)))
+        image.load()
+        return image
+    except (binascii.Error, UnidentifiedImageError, OSError, ValueError):
+        return None
+
+
+def entropy(image):
+    """Shannon entropy (bits) of the grayscale histogram"""
+    histogram = image.convert("L").histogram()
+    total = sum(histogram)
+    return -sum(n / total * math.log2(n / total) for n in histogram if n)
+
+
+def dhash(image, size=8):
+    """64-bit difference hash: robust to rescaling and recompression"""
+    pixels = list(image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def compress(image, payload, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY):
+    """Downscaled JPEG re-encoding of the image, or the original payload if that isn't smaller"""
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode in ("RGBA", "LA", "P"):
+        # Transparencia sobre blanco (JPEG no tiene canal alfa)
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.split()[-1])
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    compressed = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return compressed if len(compressed) < len(payload) else payload
+
+
+class ImageIndex:
+    """dHashes of the images already described in a document, with their descriptions.
+
+    Kept across the page windows of one document so a logo or diagram repeated
+    on many pages is described once for the whole file.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def find(self, digest, max_distance=IMAGE_HASH_DISTANCE):
+        return next((description for h, description in self.entries if hamming(h, digest) <= max_distance), None)
+
+    def add(self, plan, descriptions):
+        """Record the groups of `plan` described in `descriptions` (aligned with plan.payloads)"""
+        for digest, description in zip(plan.digests, descriptions):
+            if digest is not None and description:
+                self.entries.append((digest, description))
+
+
+class ImagePlan:
+    """Which vision calls a document's images need.
+
+    `payloads` are the (compressed) images to describe, one per group of
+    duplicates, and `digests` their dHashes; `groups[i]` is the index in
+    `payloads` for image i, or None if it was filtered out (`skipped[i]` says
+    why) or matches an image described in an earlier window (`reused[i]` is its
+    description).
+    """
+
+    def __init__(self, count):
+        self.payloads = []
+        self.digests = []
+        self.groups = [None] * count
+        self.skipped = {}
+        self.reused = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def report(self):
+        reasons = list(self.skipped.values())
+        images = len(self.groups)
+        return {
+            "images": images,
+            "vision_calls": len(self.payloads),
+            "vision_calls_saved": images - len(self.payloads),
+            "skipped_small": reasons.count("small"),
+            "skipped_low_entropy": reasons.count("low_entropy"),
+            "duplicates": images - len(reasons) - len(self.payloads),
+            "duplicates_of_earlier_pages": len(self.reused),
+            "base64_bytes_in": self.bytes_in,
+            "base64_bytes_sent": self.bytes_out,
+            "base64_bytes_saved": self.bytes_in - self.bytes_out,
+        }
+
+
+def plan_images(payloads, min_side=IMAGE_MIN_SIDE, min_entropy=IMAGE_MIN_ENTROPY,
+                max_distance=IMAGE_HASH_DISTANCE, index=None):
+    """Filter decorative images, group near-duplicates by dHash and compress one image per group.
+    Images matching one already described in `index` (an ImageIndex) reuse its description."""
+    plan = ImagePlan(len(payloads))
+    # Por grupo: (hash, área, imagen, payload original) del representante
+    representatives = []
+
+    for i, payload in enumerate(payloads):
+        plan.bytes_in += len(payload)
+        image = decode(payload)
+        if image is None:
+            # No es una imagen decodificable (p. ej. el texto de respaldo): se manda tal cual
+            plan.groups[i] = len(representatives)
+            representatives.append((None, 0, None, payload))
+            continue
+        if min(image.size) < min_side:
+            plan.skipped[i] = "small"
+            continue
+        if entropy(image) < min_entropy:
+            plan.skipped[i] = "low_entropy"
+            continue
+
+        digest = dhash(image)
+        described = index.find(digest, max_distance) if index is not None else None
+        if described is not None:
+            plan.reused[i] = described
+            continue
+        area = image.size[0] * image.size[1]
+        match = next((g for g, (h, _, _, _) in enumerate(representatives)
+                      if h is not None and hamming(h, digest) <= max_distance), None)
+        if match is None:
+            plan.groups[i] = len(representatives)
+            representatives.append((digest, area, image, payload))
+        else:
+            plan.groups[i] = match
+            # El grupo se describe con su versión de mayor resolución
+            if area > representatives[match][1]:
+                representatives[match] = (representatives[match][0], area, image, payload)
+
+    for digest, _, image, payload in representatives:
+        plan.payloads.append(payload if image is None else compress(image, payload))
+        plan.digests.append(digest)
+    plan.bytes_out = sum(len(payload) for payload in plan.payloads)
+    return plan
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from src.pdf_parser import iter_pdf_windows
+from src.partitioning import INGEST_MAX_WORKERS
+from src.documents import page_hashes, diff_pages
+from src.cache import file_hash
+from src.metrics import tracing, replay
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Prioridad (nice) de los procesos de ingesta
+INGEST_NICE = int(os.environ.get("INGEST_NICE", 10))
+INGEST_TMP_DIR = os.environ.get("INGEST_TMP_DIR", tempfile.gettempdir())
+JOBS_MAX_HISTORY = int(os.environ.get("JOBS_MAX_HISTORY", 200))
+# Ventanas de páginas ya procesadas que un worker puede adelantar antes de que se guarden
+INGEST_QUEUE_WINDOWS = int(os.environ.get("INGEST_QUEUE_WINDOWS", 2))
+
+# Los uploads se copian a disco de a bloques, sin cargarlos enteros en memoria
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Tamaño máximo por archivo subido (bytes)
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 512 * 1024 * 1024))
+# Tamaño máximo de un request de upload completo: se rechaza por Content-Length antes de leer el cuerpo
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get("UPLOAD_MAX_REQUEST_BYTES", 2 * 1024 * 1024 * 1024))
+
+PENDING_STAGES = ("queued", "partitioning", "categorizing", "chunking", "enriching", "enriched", "saving")
+
+
+def _init_worker(nice):
+    try:
+        os.nice(nice)
+    except OSError:
+        pass
+
+
+def _run_ingestion(progress, key, pdf_path, filename, old_pages, spans, batches):
+    """Runs inside a worker process: parse the pages of the PDF that changed since the stored
+    version (`old_pages`, {page_number: hash}; `spans` as in diff_pages) and put each page window's (children, parents)
+    documents on `batches` as soon as it is ready, then None. Returns the new version info, its
+    per-document stats and the timing/LLM events recorded, to be replayed into the parent's metrics"""
+
+    def on_progress(stage, value):
+        progress[key] = {"stage": stage, "progress": value}
+
+    try:
+        hashes = page_hashes(pdf_path)
+        keep, changed = diff_pages(old_pages or {}, hashes, spans or ())
+        version = {"document_id": file_hash(pdf_path), "hashes": hashes, "keep": keep, "changed": changed}
+
+        stats = {}
+        with tracing() as trace:
+            if changed:
+                # Documento nuevo: se procesa completo (y usa la partición cacheada del archivo)
+                pages = changed if keep else None
+                for window in iter_pdf_windows(
+                    pdf_path, filename=filename, on_progress=on_progress, stats=stats, pages=pages
+                ):
+                    # Cola acotada: si el guardado va atrás, el worker espera en vez de acumular ventanas
+                    batches.put(window)
+        return version, stats, trace.events
+    finally:
+        batches.put(None)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload goes over the size limit"""
+
+    def __init__(self, limit):
+        super().__init__(f"File too large (limit {limit} bytes)")
+        self.limit = limit
+        self.detail = str(self)
+
+
+def spool_to_disk(pdf, max_bytes=None):
+    """Copy an upload (bytes or a file object) to its own temp file, in chunks, so concurrent
+    uploads never collide and large files never sit whole in memory. Raises UploadTooLargeError
+    past `max_bytes`."""
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf", dir=INGEST_TMP_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if not hasattr(pdf, "read"):
+                if max_bytes is not None and len(pdf) > max_bytes:
+                    raise UploadTooLargeError(max_bytes)
+                f.write(pdf)
+                return pdf_path
+            written = 0
+            while chunk := pdf.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise UploadTooLargeError(max_bytes)
+                f.write(chunk)
+        return pdf_path
+    except BaseException:
+        os.remove(pdf_path)
+        raise
+
+
+async def _next_batch(batches, future, executor=None):
+    """Next window from a worker, or None once it finished (or died without sending the end).
+    The blocking reads run on `executor` (the loop's default one if None)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return await loop.run_in_executor(executor, partial(batches.get, timeout=1.0))
+        except queue.Empty:
+            if future.done():
+                break
+    # El worker pudo poner sus últimas ventanas entre el timeout y done(): vaciar la cola hasta el final
+    try:
+        return batches.get_nowait()
+    except queue.Empty:
+        return None
+
+
+class IngestionJobs:
+    """Background ingestion queue backed by a bounded process pool.
+
+    Every file is an upsert through the DocumentManager of its tenant: if its
+    filename is already stored, only the pages whose content changed are
+    re-processed.
+    """
+
+    def __init__(self, max_workers=INGEST_MAX_WORKERS):
+        ctx = multiprocessing.get_context("spawn")
+        self.max_workers = max_workers
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(INGEST_NICE,),
+        )
+        # Un hilo por worker para leer sus ventanas: no ocupan el threadpool por defecto que usa /predict
+        self._pollers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest-poller")
+        # Solo se envían al pool tantos archivos como workers: cada lector espera a un worker que ya corre
+        self._slots = asyncio.Semaphore(max_workers)
+        self._manager = ctx.Manager()
+        self._progress = self._manager.dict()
+        self._jobs = OrderedDict()
+        self._tasks = set()
+
+    def submit(self, files, documents, on_done=None):
+        """`files` is a list of (filename, pdf_path) to store through `documents` (a DocumentManager).
+        `on_done()` is called once every file has finished. Returns the job id."""
+        job_id = uuid.uuid4().hex
+        self._jobs[job_id] = {
+            "job_id": job_id,
+            "created_at": time.time(),
+            "files": [
+                {"filename": filename, "stage": "queued", "progress": 0.0, "error": None, "images": None, "pages": None}
+                for filename, _ in files
+            ],
+        }
+        self._evict()
+
+        async def run():
+            try:
+                await asyncio.gather(*(
+                    self._run_file(job_id, index, documents, filename, pdf_path)
+                    for index, (filename, pdf_path) in enumerate(files)
+                ))
+            finally:
+                if on_done:
+                    on_done()
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        logger.info(f"Ingestion job {job_id} queued with {len(files)} files")
+        return job_id
+
+    async def _run_file(self, job_id, index, documents, filename, pdf_path):
+        entry = self._jobs[job_id]["files"][index]
+        key = f"{job_id}:{index}"
+        loop = asyncio.get_running_loop()
+        try:
+            # Una versión a la vez por archivo: el diff de páginas es contra la versión guardada
+            async with documents.lock(filename):
+                old_pages = await asyncio.to_thread(documents.catalog.page_hashes, filename)
+                spans = await asyncio.to_thread(documents.catalog.spans, filename)
+                writer = await asyncio.to_thread(documents.writer, filename)
+                batches = self._manager.Queue(maxsize=INGEST_QUEUE_WINDOWS)
+                try:
+                    async with self._slots:
+                        future = loop.run_in_executor(
+                            self._pool, _run_ingestion, self._progress, key, pdf_path, filename, old_pages, spans,
+                            batches,
+                        )
+                        # Cada ventana se guarda apenas llega, mientras el worker procesa la siguiente
+                        chunks, error = 0, None
+                        while (batch := await _next_batch(batches, future, self._pollers)) is not None:
+                            if error is not None:
+                                continue  # seguir vaciando la cola para que el worker pueda terminar
+                            try:
+                                await asyncio.to_thread(writer.write, *batch)
+                                chunks += len(batch[0])
+                            except Exception as e:
+                                error = e
+                        version, stats, events = await future
+                    replay(events)
+                    entry.update(stats)
+                    if error is not None:
+                        raise error
+
+                    self._progress.pop(key, None)
+                    entry.update(stage="saving", progress=0.95)
+                    report = await asyncio.to_thread(writer.commit, version)
+                except Exception:
+                    # La versión anterior queda como estaba
+                    await asyncio.to_thread(writer.rollback)
+                    raise
+            entry.update(stage="done", progress=1.0, pages=report)
+            logger.info(f"[{job_id}] {filename} ingested ({chunks} chunks)")
+        except Exception as e:
+            self._progress.pop(key, None)
+            entry.update(stage="error", error=str(e))
+            logger.error(f"[{job_id}] Error processing {filename}: {str(e)}")
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+
+    def _evict(self):
+        while len(self._jobs) > JOBS_MAX_HISTORY:
+            oldest = next(iter(self._jobs.values()))
+            if any(f["stage"] in PENDING_STAGES for f in oldest["files"]):
+                break
+            self._jobs.popitem(last=False)
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        files = []
+        for index, entry in enumerate(job["files"]):
+            live = self._progress.get(f"{job_id}:{index}")
+            if live and entry["stage"] == "queued":
+                entry = {**entry, **live}
+            files.append(entry)
+
+        stages = [f["stage"] for f in files]
+        if all(stage == "queued" for stage in stages):
+            status = "queued"
+        elif any(stage in PENDING_STAGES for stage in stages):
+            status = "running"
+        elif all(stage == "error" for stage in stages):
+            status = "failed"
+        else:
+            status = "completed"
+
+        return {
+            "job_id": job_id,
+            "status": status,
+            "created_at": job["created_at"],
+            "progress": sum(f["progress"] for f in files) / len(files) if files else 1.0,
+            "files": files,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pollers.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
@@ -0,0 +1,236 @@
+from collections import Counter
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Términos presentes en más de esta fracción de los chunks no aportan al ranking y sus postings son las más largas
+LEXICAL_MAX_DF_RATIO = float(os.environ.get("LEXICAL_MAX_DF_RATIO", "0.5"))
+
+# Conserva códigos tipo "AB-123", "E.04", "v2/3" como un solo token
+TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return TOKEN_RE.findall(text)
+
+
+def is_code(token):
+    """Part numbers, error codes... tokens mixing digits with letters or separators"""
+    return any(c.isdigit() for c in token) and (any(c.isalpha() for c in token) or any(c in "-./" for c in token))
+
+
+def is_exact_query(query, max_tokens=3):
+    """Short queries made only of code-like tokens can be answered by the lexical index alone"""
+    tokens = tokenize(query)
+    return 0 < len(tokens) <= max_tokens and all(is_code(token) for token in tokens)
+
+
+def filter_sql(filters):
+    """SQL conditions on the `docs` table for the retrieval filters"""
+    clauses, params = [], []
+    for key, column in (("filenames", "filename"), ("content_types", "content_type")):
+        if filters.get(key) is not None:
+            clauses.append(f"d.{column} IN ({','.join('?' * len(filters[key]))})")
+            params.extend(filters[key])
+    # Alcanza con que el chunk termine dentro del rango (last_page falta en docs indexados antes de guardarlo)
+    if filters.get("page_from") is not None:
+        clauses.append("COALESCE(d.last_page, d.page_number) >= ?")
+        params.append(filters["page_from"])
+    if filters.get("page_to") is not None:
+        clauses.append("d.page_number <= ?")
+        params.append(filters["page_to"])
+    return "".join(f" AND {clause}" for clause in clauses), params
+
+
+class BM25Index:
+    """Incremental BM25 inverted index persisted in SQLite, keyed by `doc_id`"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # Conexiones de lectura por hilo: con WAL las búsquedas no esperan a las escrituras ni entre sí
+        self._local = threading.local()
+        self._readers = []
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            " doc_id TEXT PRIMARY KEY,"
+            " length INTEGER NOT NULL,"
+            " filename TEXT,"
+            " content_type TEXT,"
+            " page_number INTEGER,"
+            " last_page INTEGER)"
+        )
+        # Migración de índices creados antes de guardar metadatos
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(docs)")}
+        for column, column_type in (("filename", "TEXT"), ("content_type", "TEXT"), ("page_number", "INTEGER"),
+                                    ("last_page", "INTEGER")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE docs ADD COLUMN {column} {column_type}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS docs_filename ON docs (filename, page_number)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS docs_content_type ON docs (content_type)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL,"
+            " doc_id TEXT NOT NULL,"
+            " tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, doc_id)) WITHOUT ROWID"
+        )
+        # Para borrar documentos sin recorrer todas las postings
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_doc_id ON postings (doc_id)")
+        # df por término, mantenido al indexar y borrar: la búsqueda no cuenta postings
+        self._conn.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+        if self._conn.execute("SELECT NOT EXISTS (SELECT 1 FROM terms) AND EXISTS (SELECT 1 FROM postings)").fetchone()[0]:
+            # Migración de índices creados antes de la tabla terms
+            self._conn.execute("INSERT INTO terms (term, df) SELECT term, COUNT(*) FROM postings GROUP BY term")
+        self._conn.commit()
+        self._refresh_stats()
+
+    def _refresh_stats(self):
+        count, avg_length = self._conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        self.doc_count = count
+        self.avg_length = avg_length or 0.0
+
+    def add_documents(self, documents, id_key="doc_id"):
+        """Index documents not yet in the index. Returns how many were added."""
+        with self._lock:
+            ids = [doc.metadata[id_key] for doc in documents]
+            existing = set()
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                existing.update(row[0] for row in self._conn.execute(
+                    f"SELECT doc_id FROM docs WHERE doc_id IN ({','.join('?' * len(batch))})", batch
+                ))
+
+            added = 0
+            df = Counter()
+            for doc_id, doc in zip(ids, documents):
+                if doc_id in existing:
+                    continue
+                existing.add(doc_id)
+                terms = Counter(tokenize(doc.page_content))
+                self._conn.execute(
+                    "INSERT INTO docs (doc_id, length, filename, content_type, page_number, last_page)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        doc_id,
+                        sum(terms.values()),
+                        doc.metadata.get("filename"),
+                        doc.metadata.get("content_type"),
+                        doc.metadata.get("page_number"),
+                        doc.metadata.get("last_page"),
+                    ),
+                )
+                self._conn.executemany(
+                    "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(term, doc_id, tf) for term, tf in terms.items()],
+                )
+                df.update(terms.keys())
+                added += 1
+
+            self._conn.executemany(
+                "INSERT INTO terms (term, df) VALUES (?, ?) ON CONFLICT (term) DO UPDATE SET df = df + excluded.df",
+                df.items(),
+            )
+            self._conn.commit()
+            self._refresh_stats()
+        return added
+
+    def delete(self, doc_ids):
+        """Remove documents from the index. Returns how many were removed."""
+        doc_ids = list(doc_ids)
+        removed = 0
+        with self._lock:
+            for i in range(0, len(doc_ids), 500):
+                batch = doc_ids[i:i + 500]
+                placeholders = ','.join('?' * len(batch))
+                self._conn.executemany("UPDATE terms SET df = df - ? WHERE term = ?", [
+                    (count, term) for term, count in self._conn.execute(
+                        f"SELECT term, COUNT(*) FROM postings WHERE doc_id IN ({placeholders}) GROUP BY term", batch
+                    ).fetchall()
+                ])
+                self._conn.execute(f"DELETE FROM postings WHERE doc_id IN ({placeholders})", batch)
+                removed += self._conn.execute(f"DELETE FROM docs WHERE doc_id IN ({placeholders})", batch).rowcount
+            self._conn.execute("DELETE FROM terms WHERE df <= 0")
+            self._conn.commit()
+            self._refresh_stats()
+        return removed
+
+    def update_pages(self, pages):
+        """Set the page number of already indexed documents ({doc_id: page_number}); their last page moves along"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE docs SET last_page = last_page + ? - page_number, page_number = ? WHERE doc_id = ?",
+                [(page, page, doc_id) for doc_id, page in pages.items()],
+            )
+            self._conn.commit()
+
+    def vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+            self._conn.close()
+
+    def _reader(self):
+        reader = getattr(self._local, "conn", None)
+        if reader is None:
+            reader = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            reader.execute("PRAGMA query_only = ON")
+            self._local.conn = reader
+            with self._lock:
+                self._readers.append(reader)
+        return reader
+
+    def _query_terms(self, terms, reader):
+        """[(term, idf)] for the query terms in the index, leaving out the too common ones"""
+        terms = list(terms)
+        if not terms:
+            return []
+        n = self.doc_count
+        rows = reader.execute(
+            f"SELECT term, df FROM terms WHERE term IN ({','.join('?' * len(terms))}) ORDER BY df", terms
+        ).fetchall()
+        # Si todos son comunes se conserva el más raro, para no quedarse sin resultados
+        rows = rows[:1] + [(term, df) for term, df in rows[1:] if df <= LEXICAL_MAX_DF_RATIO * n]
+        # N y df sobre todo el corpus: un doc puntúa igual con o sin filtros, que solo restringen
+        return [(term, math.log((n - df + 0.5) / (df + 0.5) + 1)) for term, df in rows]
+
+    def search(self, query, k=10, filters=None):
+        """Return [(doc_id, score)] sorted by BM25 score, restricted to docs matching `filters`"""
+        reader = self._reader()
+        weighted = self._query_terms(set(tokenize(query)), reader)
+        if not weighted:
+            return []
+        where, params = filter_sql(filters or {})
+        # El puntaje se calcula y ordena en SQLite: solo los k mejores llegan a Python
+        rows = reader.execute(
+            f"WITH q (term, idf) AS (VALUES {','.join(['(?, ?)'] * len(weighted))})"
+            " SELECT p.doc_id, SUM(q.idf * p.tf * ? / (p.tf + ? * (1 - ? + ? * d.length / ?))) AS score"
+            " FROM q CROSS JOIN postings p ON p.term = q.term JOIN docs d ON d.doc_id = p.doc_id"
+            f" WHERE 1{where} GROUP BY p.doc_id ORDER BY score DESC LIMIT ?",
+            (
+                *(value for pair in weighted for value in pair),
+                BM25_K1 + 1, BM25_K1, BM25_B, BM25_B, self.avg_length or 1.0,
+                *params, k,
+            ),
+        ).fetchall()
+        return [(doc_id, score) for doc_id, score in rows]
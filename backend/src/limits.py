@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+PREDICT_MAX_INFLIGHT = int(os.environ.get("PREDICT_MAX_INFLIGHT", 256))
+PREDICT_MAX_QUEUE = int(os.environ.get("PREDICT_MAX_QUEUE", 64))
+PREDICT_QUEUE_TIMEOUT = float(os.environ.get("PREDICT_QUEUE_TIMEOUT", 5))
+PREDICT_RETRY_AFTER = int(os.environ.get("PREDICT_RETRY_AFTER", 2))
+
+
+class OverloadedError(Exception):
+    """Raised when a request is shed instead of queued"""
+
+    def __init__(self, status_code, retry_after, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class ConcurrencyLimiter:
+    """Bounded in-flight limit with a short, bounded wait queue.
+
+    - free slot: the request runs right away
+    - no slot but room in the queue: waits up to `queue_timeout`, then 503
+    - queue full: 429 immediately
+    """
+
+    def __init__(self, max_inflight=PREDICT_MAX_INFLIGHT, max_queue=PREDICT_MAX_QUEUE,
+                 queue_timeout=PREDICT_QUEUE_TIMEOUT, retry_after=PREDICT_RETRY_AFTER):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.counters = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "peak_in_flight": 0,
+            "peak_waiting": 0,
+        }
+
+    async def acquire(self):
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.counters["rejected_queue_full"] += 1
+                raise OverloadedError(429, self.retry_after, "Too many requests in flight")
+
+            self.waiting += 1
+            self.counters["peak_waiting"] = max(self.counters["peak_waiting"], self.waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.counters["rejected_timeout"] += 1
+                raise OverloadedError(503, self.retry_after, "Server busy, try again later")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        self.in_flight += 1
+        self.counters["admitted"] += 1
+        self.counters["peak_in_flight"] = max(self.counters["peak_in_flight"], self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            **self.counters,
+        }
@@ -1,17 +1,32 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from src.models import *
-from src.from_parser import extraer_campos_formulario
-from fastapi import FastAPI, UploadFile, File, HTTPException,Request
-from src.pdf_parser import parse_pdf
-from contextlib import asynccontextmanager
+from src.from_parser import aextraer_formulario, FORM_WORKERS
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException,Request
+from src.documents import AmbiguousDocumentError
+from src.jobs import IngestionJobs, UploadTooLargeError, spool_to_disk, UPLOAD_MAX_BYTES, UPLOAD_MAX_REQUEST_BYTES
+from src.tenants import TenantRegistry, TenantLimitError, UnknownTenantError, TENANT_HEADER, DEFAULT_TENANT, valid_tenant_id
+from contextlib import asynccontextmanager, suppress
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import json
 import logging
-from langchain_openai import OpenAIEmbeddings
-from langchain_core.messages import HumanMessage
-from langchain_chroma import Chroma
+import multiprocessing
+from langchain_core.messages import HumanMessage, AIMessage
 import os
-from src.agent import make_retrieve_tool, get_graph
-from src.utils import to_langchain_messages, from_langchain_messages
+from src.agent import stream_graph, retrieval_options
+from src.retrieval import merge_filters
+from src.sessions import SessionStore, SessionTenantError
+from src.summarizer import BackgroundSummarizer
+from src.utils import to_langchain_messages, from_langchain_messages, sse_event
+from src.embeddings import CachedEmbeddings
+from src.providers import get_embeddings
+from src.limits import ConcurrencyLimiter, OverloadedError
+from src.answer_cache import ANSWER_CACHE_ENABLED, retrieved_doc_ids
+from src.metrics import tracing, start_trace, record, render, METRICS_ENABLED
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -27,93 +42,488 @@ origins = [
 async def lifespan(app: FastAPI):
     logger.info("Loading vectorstore and embeddings...")
 
-    embeddings = OpenAIEmbeddings(api_key=os.environ["OPENAI_API_KEY"])
+    embeddings = CachedEmbeddings(get_embeddings())
+    app.state.embeddings = embeddings
 
-    vectorstore = Chroma(
-        collection_name="multivector_chunks",
-        embedding_function=embeddings,
-        persist_directory="./chroma_langchain_db"
-    )
-    app.state.vectorstore = vectorstore
-    logger.info("Vectorstore ready.")
-
-    # Crear retrieve tool + grafo y guardarlo
-    retrieve_tool = make_retrieve_tool(vectorstore.as_retriever()) 
-    graph = get_graph(retrieve_tool)
-    app.state.graph = graph
+    # Cada tenant tiene sus colecciones, docstore, índice léxico, grafo y caché de respuestas
+    tenants = TenantRegistry(embeddings)
+    app.state.tenants = tenants
+    # El tenant por defecto se abre al arrancar (registra en el catálogo las colecciones previas)
+    tenants.release(await tenants.acquire(DEFAULT_TENANT))
+    compaction = asyncio.create_task(tenants.compact_periodically())
 
     logger.info("Agent graph loaded.")
 
+    app.state.predict_limiter = ConcurrencyLimiter()
+    app.state.sessions = SessionStore(default_tenant=DEFAULT_TENANT)
+    app.state.summarizer = BackgroundSummarizer(app.state.sessions)
+
+    app.state.jobs = IngestionJobs()
+    app.state.form_pool = ProcessPoolExecutor(max_workers=FORM_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    logger.info(f"Ingestion pool ready ({app.state.jobs.max_workers} workers).")
+
     yield
 
     logger.info("Shutting down app...")
+    compaction.cancel()
+    await app.state.summarizer.shutdown()
+    app.state.jobs.shutdown()
+    app.state.form_pool.shutdown(wait=False, cancel_futures=True)
+    tenants.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
 
-app.add_middleware(CORSMiddleware, allow_origins=origins, allow_methods=["POST"])
+app.add_middleware(CORSMiddleware, allow_origins=origins, allow_methods=["GET", "POST", "PUT", "DELETE"])
 
 
-@app.post("/predict", response_model=Response)
-def predict(request: PredictRequest, fastapi_request: Request):
-    graph = fastapi_request.app.state.graph
+@app.exception_handler(OverloadedError)
+async def overloaded_handler(request: Request, exc: OverloadedError):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+@app.exception_handler(UploadTooLargeError)
+async def upload_too_large_handler(request: Request, exc: UploadTooLargeError):
+    return JSONResponse(status_code=413, content={"detail": exc.detail})
+
+
+@app.exception_handler(SessionTenantError)
+async def session_tenant_handler(request: Request, exc: SessionTenantError):
+    # Igual que una sesión inexistente: no revela sesiones de otros tenants
+    return JSONResponse(status_code=404, content={"detail": "Session not found"})
+
+
+@app.exception_handler(UnknownTenantError)
+async def unknown_tenant_handler(request: Request, exc: UnknownTenantError):
+    return JSONResponse(status_code=404, content={"detail": "Tenant not found"})
+
+
+@app.exception_handler(TenantLimitError)
+async def tenant_limit_handler(request: Request, exc: TenantLimitError):
+    return JSONResponse(status_code=403, content={"detail": str(exc)})
+
+
+@app.middleware("http")
+async def upload_size_limit(request: Request, call_next):
+    # Rechazar uploads demasiado grandes antes de que se lea (y se copie a disco) el cuerpo
+    length = request.headers.get("content-length")
+    if request.method in ("POST", "PUT") and length and length.isdigit() and int(length) > UPLOAD_MAX_REQUEST_BYTES:
+        return JSONResponse(
+            status_code=413, content={"detail": f"Request too large (limit {UPLOAD_MAX_REQUEST_BYTES} bytes)"}
+        )
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def request_timing(request: Request, call_next):
+    if not METRICS_ENABLED:
+        return await call_next(request)
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    record("http", time.perf_counter() - start, method=request.method, path=route.path if route else "unmatched")
+    return response
+
+
+def tenant_id(request: Request, field: Optional[str] = None):
+    """Tenant of a request: the `tenant` field if given, else the tenant header, else the default one"""
+    tenant = field or request.headers.get(TENANT_HEADER) or DEFAULT_TENANT
+    if not valid_tenant_id(tenant):
+        raise HTTPException(status_code=400, detail="Invalid tenant id")
+    return tenant
+
+
+@app.post("/tenants", response_model=TenantInfo)
+async def create_tenant(tenant: TenantCreate, request: Request):
+    """Register a tenant so that it can be used (idempotent)"""
+    name = tenant_id(request, tenant.tenant)
+    return await asyncio.to_thread(request.app.state.tenants.create, name)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request):
+    """Prometheus text format: latency histograms, LLM counters and the /stats values as gauges
+    (per-tenant components are the ones of the request's tenant and carry a `tenant` label)"""
+    state = request.app.state
+    tenant_name = tenant_id(request)
+    async with state.tenants.use(tenant_name) as tenant:
+        return PlainTextResponse(
+            render({
+                "predict": state.predict_limiter.stats,
+                "embeddings": state.embeddings.stats,
+                "answer_cache": tenant.answer_cache.stats,
+                "summarizer": state.summarizer.stats,
+                "routing": tenant.router.stats,
+                "documents": tenant.documents.stats,
+                "tenants": state.tenants.stats,
+            }, labels={
+                component: {"tenant": tenant_name} for component in ("answer_cache", "routing", "documents")
+            }),
+            media_type="text/plain; version=0.0.4",
+        )
+
+
+@app.get("/stats")
+async def stats(request: Request):
+    state = request.app.state
+    async with state.tenants.use(tenant_id(request)) as tenant:
+        return {
+            "predict": state.predict_limiter.stats(),
+            "embeddings": state.embeddings.stats(),
+            "answer_cache": tenant.answer_cache.stats(),
+            "summarizer": state.summarizer.stats(),
+            "routing": tenant.router.stats(),
+            "documents": tenant.documents.stats(),
+            "tenants": state.tenants.stats()
+        }
+
+
+def build_config(request: PredictRequest, session):
+    """Per-request retrieval options for the retrieve tool (k, weights, filters + session scope)"""
+    retrieval = request.retrieval.model_dump(exclude_none=True) if request.retrieval else {}
+    filters = merge_filters(
+        request.filters.model_dump(mode="json", exclude_none=True) if request.filters else None,
+        session.scope() if session else None
+    )
+    if filters:
+        retrieval["filters"] = filters
+    return {"configurable": {"retrieval": retrieval}} if retrieval else None
+
+
+def build_state(request: PredictRequest, session):
+    if session is None:
+        messages = to_langchain_messages(request.chat_history or [])
+        messages.append(HumanMessage(content=request.question))
+        return {
+            "messages": messages,
+            "summary": request.summary
+        }
 
-    messages = to_langchain_messages(request.chat_history)
-    messages.append(HumanMessage(content=request.question))
+    # Sesión nueva: se puede sembrar con el historial que mande el cliente
+    if not session.messages and request.chat_history:
+        session.append(to_langchain_messages(request.chat_history))
+        session.summary = request.summary or ""
 
-    state = {
-        "messages": messages,
-        "summary": request.summary
+    return {
+        "messages": session.messages + [HumanMessage(content=request.question)],
+        "summary": session.summary,
+        "history_tokens": session.total_tokens
     }
 
-    final_state = graph.invoke(state)
-    updated_messages = final_state["messages"]
-    answer_msg = updated_messages[-1]
+
+async def get_session(app, request: PredictRequest, tenant_name):
+    if request.session_id is None:
+        return None
+    return await asyncio.to_thread(app.state.sessions.get, request.session_id, True, tenant_name)
+
+
+async def finish_turn(app, request: PredictRequest, session, final_messages, summary, trace=None, **extra):
+    """Build the response; in session mode, commit the turn and return only the delta"""
+    if session is None:
+        chat_history = from_langchain_messages(final_messages)
+    else:
+        delta = await asyncio.to_thread(app.state.sessions.commit_turn, session, final_messages, summary)
+        chat_history = from_langchain_messages(delta)
+        # El resumen corre después de responder y se usa en el próximo turno
+        app.state.summarizer.maybe_schedule(session)
 
     return Response(
-        answer=answer_msg.content,
+        answer=final_messages[-1].content,
         documents="",
-        chat_history=from_langchain_messages([msg for msg in updated_messages]),
-        summary=final_state.get("summary", "") 
+        chat_history=chat_history,
+        summary=summary,
+        session_id=request.session_id,
+        timings=trace.breakdown() if trace is not None and request.timings else None,
+        **extra
     )
 
 
-@app.post("/upload_pdfs")
-async def upload_pdfs(request: Request, files: List[UploadFile] = File(...)):
-    vectorstore = request.app.state.vectorstore
-    success_files = []
+async def lookup_answer(tenant, question, state, config):
+    """Return (cached entry or None, lookup context). A None context also skips store_answer."""
+    # La caché se valida contra la búsqueda sin filtros: no aplica a consultas filtradas
+    if not ANSWER_CACHE_ENABLED or retrieval_options(config).get("filters"):
+        return None, None
+    # La clave es solo la pregunta: con turnos previos ("¿y en la página 3?") depende de la conversación
+    if state["summary"] or len(state["messages"]) > 1:
+        return None, None
+    return await tenant.answer_cache.lookup(question, config)
+
+
+def store_answer(tenant, question, context, final_messages):
+    # Solo se cachean respuestas basadas en documentos recuperados, junto con los doc_id que usaron
+    doc_ids = retrieved_doc_ids(final_messages)
+    if context is not None and doc_ids:
+        tenant.answer_cache.store(question, context, final_messages[-1].content, doc_ids)
+
+
+@asynccontextmanager
+async def session_turn(session):
+    """One turn at a time per session"""
+    if session is None:
+        yield
+    else:
+        async with session.lock:
+            yield
+
+
+@app.post("/predict", response_model=Response)
+async def predict(request: PredictRequest, fastapi_request: Request):
+    app = fastapi_request.app
+    tenant_name = tenant_id(fastapi_request, request.tenant)
+    session = await get_session(app, request, tenant_name)
+
+    async with app.state.predict_limiter.slot(), app.state.tenants.use(tenant_name) as tenant, session_turn(session):
+        with tracing() as trace:
+            state = build_state(request, session)
+            config = build_config(request, session)
+
+            entry, context = await lookup_answer(tenant, request.question, state, config)
+            if entry is not None:
+                messages = state["messages"] + [AIMessage(content=entry.answer)]
+                return await finish_turn(app, request, session, messages, state["summary"], trace, cached=True)
+
+            final_state = await tenant.graph.ainvoke(state, config=config)
+            updated_messages = final_state["messages"]
+            store_answer(tenant, request.question, context, updated_messages)
+
+            return await finish_turn(
+                app, request, session, updated_messages, final_state.get("summary", ""), trace,
+                context_tokens=final_state.get("context_tokens")
+            )
+
+
+@app.post("/predict/stream")
+async def predict_stream(request: PredictRequest, fastapi_request: Request):
+    """Same as /predict but streams server-sent events while the graph runs"""
+    app = fastapi_request.app
+    tenants = app.state.tenants
+    tenant_name = tenant_id(fastapi_request, request.tenant)
+    limiter = app.state.predict_limiter
+    session = await get_session(app, request, tenant_name)
+
+    # Reservar el slot antes de empezar el stream para poder responder 429/503
+    await limiter.acquire()
+    try:
+        tenant = await tenants.acquire(tenant_name)
+    except BaseException:
+        limiter.release()
+        raise
+    released = False
 
-    for file in files:
-        if file.content_type != "application/pdf":
-            continue  # skip non-pdf files
+    def release():
+        # Se llama desde el generador y como background task (si el cliente corta antes de empezar)
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release()
+            tenants.release(tenant)
 
-        pdf_bytes = await file.read()
+    async def events():
         try:
-            logger.info(f"Processing {file.filename}")
-            parse_pdf(pdf_bytes, vectorstore=vectorstore)
-            success_files.append(file.filename)
+            # Sin reset: el generador puede cerrarse desde otro contexto; la tarea del stream es propia
+            trace = start_trace()
+            async with session_turn(session):
+                state = build_state(request, session)
+                config = build_config(request, session)
+
+                entry, context = await lookup_answer(tenant, request.question, state, config)
+                if entry is not None:
+                    yield sse_event("token", {"node": "cache", "text": entry.answer})
+                    messages = state["messages"] + [AIMessage(content=entry.answer)]
+                    response = await finish_turn(app, request, session, messages, state["summary"], trace, cached=True)
+                    yield sse_event("done", response.model_dump(mode="json", exclude={"documents"}))
+                    return
+
+                async for event, data in stream_graph(tenant.graph, state, config=config):
+                    if event == "final":
+                        messages = data["messages"]
+                        store_answer(tenant, request.question, context, messages)
+                        response = await finish_turn(
+                            app, request, session, messages, data.get("summary", ""), trace,
+                            context_tokens=data.get("context_tokens")
+                        )
+                        event, data = "done", response.model_dump(mode="json", exclude={"documents"})
+                    yield sse_event(event, data)
         except Exception as e:
-            logger.error(f"Error processing {file.filename}: {str(e)}")
+            logger.error(f"Error streaming answer: {str(e)}")
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            release()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release)
+    )
+
+
+@app.post("/sessions", response_model=SessionInfo)
+def create_session(request: Request):
+    sessions = request.app.state.sessions
+    session = sessions.get(sessions.new_id(), tenant=tenant_id(request))
+    return SessionInfo(session_id=session.session_id)
+
+
+@app.get("/sessions/{session_id}", response_model=SessionInfo)
+def get_session_info(session_id: str, request: Request):
+    """Full history of a session (e.g. to restore the chat after a page reload)"""
+    session = request.app.state.sessions.get(session_id, create=False, tenant=tenant_id(request))
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return SessionInfo(
+        session_id=session_id,
+        chat_history=from_langchain_messages(session.messages),
+        summary=session.summary,
+        total_tokens=session.total_tokens,
+        documents=session.documents
+    )
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str, request: Request):
+    request.app.state.sessions.delete(session_id, tenant=tenant_id(request))
+    return {"status": "deleted"}
+
+
+@app.put("/sessions/{session_id}/documents", response_model=DocumentScope)
+def set_session_documents(session_id: str, scope: DocumentScope, request: Request):
+    """Limit every retrieval of the session to these filenames"""
+    request.app.state.sessions.set_documents(session_id, scope.filenames, tenant=tenant_id(request))
+    return scope
+
+
+@app.get("/sessions/{session_id}/documents", response_model=DocumentScope)
+def get_session_documents(session_id: str, request: Request):
+    session = request.app.state.sessions.get(session_id, create=False, tenant=tenant_id(request))
+    if session is None or session.documents is None:
+        raise HTTPException(status_code=404, detail="Session has no document scope")
+    return DocumentScope(filenames=session.documents)
+
+
+@app.delete("/sessions/{session_id}/documents")
+def clear_session_documents(session_id: str, request: Request):
+    request.app.state.sessions.set_documents(session_id, None, tenant=tenant_id(request))
+    return {"status": "cleared"}
+
+
+async def spool_uploads(files):
+    """Copy the PDF uploads to disk in chunks (None for other files). If one goes over
+    UPLOAD_MAX_BYTES, the ones already copied are removed and the request fails with 413."""
+    paths = []
+    try:
+        for file in files:
+            if file.content_type != "application/pdf":
+                paths.append(None)
+                continue
+            paths.append(await asyncio.to_thread(spool_to_disk, file.file, UPLOAD_MAX_BYTES))
+    except UploadTooLargeError:
+        for path in paths:
+            if path is not None:
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+        raise
+    return paths
+
+
+async def submit_ingestion(request: Request, tenant_name, files):
+    """Queue (filename, pdf_path) files into the tenant's documents; the tenant stays open until the job ends"""
+    tenants = request.app.state.tenants
+    try:
+        tenant = await tenants.acquire(tenant_name)
+    except Exception:
+        # Tenant desconocido: los archivos ya copiados no se van a procesar
+        for _, pdf_path in files:
+            with suppress(FileNotFoundError):
+                os.remove(pdf_path)
+        raise
+    return request.app.state.jobs.submit(files, tenant.documents, on_done=lambda: tenants.release(tenant))
+
+
+@app.post("/upload_pdfs", response_model=UploadResponse)
+async def upload_pdfs(request: Request, files: List[UploadFile] = File(...), tenant: Optional[str] = Form(None)):
+    tenant_name = tenant_id(request, tenant)
+    # Los archivos no PDF se saltean
+    paths = await spool_uploads(files)
+    queued = [(file.filename, path) for file, path in zip(files, paths) if path is not None]
+
+    job_id = await submit_ingestion(request, tenant_name, queued) if queued else None
+
+    return UploadResponse(
+        status="queued" if queued else "empty",
+        job_id=job_id,
+        queued_files=[filename for filename, _ in queued],
+        skipped=len(files) - len(queued)
+    )
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+def get_job(job_id: str, request: Request):
+    job = request.app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/documents", response_model=DocumentList)
+async def list_documents(request: Request):
+    async with request.app.state.tenants.use(tenant_id(request)) as tenant:
+        return DocumentList(documents=await asyncio.to_thread(tenant.catalog.list))
+
+
+@app.put("/documents/{filename}", response_model=UploadResponse)
+async def upsert_document(filename: str, request: Request, file: UploadFile = File(...)):
+    """Replace the stored version of `filename`: only the pages that changed are re-processed"""
+    if file.content_type != "application/pdf":
+        raise HTTPException(status_code=415, detail="Only PDF files are supported")
+    tenant_name = tenant_id(request)
+    pdf_path = await asyncio.to_thread(spool_to_disk, file.file, UPLOAD_MAX_BYTES)
+    job_id = await submit_ingestion(request, tenant_name, [(filename, pdf_path)])
+    return UploadResponse(status="queued", job_id=job_id, queued_files=[filename], skipped=0)
+
+
+@app.delete("/documents")
+async def delete_document(request: Request, filename: Optional[str] = None, document_id: Optional[str] = None):
+    """Delete a document by filename or by document id (hash of its stored version)"""
+    if not filename and not document_id:
+        raise HTTPException(status_code=400, detail="filename or document_id is required")
+    async with request.app.state.tenants.use(tenant_id(request)) as tenant:
+        documents = tenant.documents
+        try:
+            resolved = await asyncio.to_thread(documents.catalog.resolve, filename, document_id)
+        except AmbiguousDocumentError as e:
+            raise HTTPException(status_code=409, detail=e.detail)
+        if resolved is None:
+            raise HTTPException(status_code=404, detail="Document not found")
+        async with documents.lock(resolved):
+            deleted = await asyncio.to_thread(documents.delete, resolved)
+    return {"status": "deleted", "filename": resolved, "chunks": deleted}
+
+
+@app.post("/documents/compact")
+async def compact_documents(request: Request):
+    async with request.app.state.tenants.use(tenant_id(request)) as tenant:
+        return await asyncio.to_thread(tenant.documents.compact)
 
-    return {
-        "status": "completed",
-        "processed_files": success_files,
-        "skipped": len(files) - len(success_files)
-    }
 
 @app.post("/upload_form")
 async def upload_form(file: UploadFile = File(...)):
     if file.content_type != "application/pdf":
         return {"error": "Solo se permiten archivos PDF"}
 
-    pdf_bytes = await file.read()
+    pdf_path = await asyncio.to_thread(spool_to_disk, file.file, UPLOAD_MAX_BYTES)
     try:
         logger.info(f"Procesando {file.filename}")
-        output = extraer_campos_formulario(pdf_bytes)
+        output, sources = await aextraer_formulario(pdf_path)
         return {
             "status": "success",
             "filename": file.filename,
-            "data": output
+            "data": output,
+            "sources": sources
         }
     except Exception as e:
         logger.error(f"Error procesando {file.filename}: {str(e)}")
@@ -121,4 +531,50 @@ async def upload_form(file: UploadFile = File(...)):
             "status": "error",
             "filename": file.filename,
             "error": str(e)
-        }
\ No newline at end of file
+        }
+    finally:
+        os.remove(pdf_path)
+
+
+@app.post("/upload_forms")
+async def upload_forms(request: Request, files: List[UploadFile] = File(...)):
+    """Extract many forms: one NDJSON line per form, in the order they finish"""
+    pool = request.app.state.form_pool
+    # Los uploads se cierran al salir del endpoint: copiarlos a disco antes de responder
+    uploads = list(zip([file.filename for file in files], await spool_uploads(files)))
+
+    # Formularios en vuelo acotados: el resto espera en disco
+    slots = asyncio.Semaphore(FORM_WORKERS * 2)
+
+    async def extract(filename, path):
+        if path is None:
+            return {"status": "skipped", "filename": filename, "error": "Solo se permiten archivos PDF"}
+        try:
+            async with slots:
+                data, sources = await aextraer_formulario(path, pool)
+            return {"status": "success", "filename": filename, "data": data, "sources": sources}
+        except Exception as e:
+            logger.error(f"Error procesando {filename}: {str(e)}")
+            return {"status": "error", "filename": filename, "error": str(e)}
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+    def cleanup():
+        # Archivos de formularios que no llegaron a procesarse (cliente desconectado)
+        for _, path in uploads:
+            if path is not None:
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+
+    async def lines():
+        tasks = [asyncio.create_task(extract(filename, path)) for filename, path in uploads]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task, ensure_ascii=False) + "\n"
+        finally:
+            # Cliente desconectado: cancelar lo pendiente
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", background=BackgroundTask(cleanup))
@@ -0,0 +1,316 @@
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+import bisect
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Apagado: los spans no hacen nada salvo en requests que piden su desglose de tiempos
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._series[key] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+# Spans: nombre -> histograma y la etiqueta que identifica el paso
+SPANS = {
+    "node": Histogram("rag_graph_node_seconds", "LangGraph node latency", ["node"]),
+    "retrieval": Histogram("rag_retrieval_step_seconds", "Retrieval step latency", ["step"]),
+    "ingest": Histogram("rag_ingest_stage_seconds", "PDF ingestion stage latency", ["stage"]),
+    "summarize": Histogram("rag_summarize_seconds", "Conversation summarization latency", ["mode"]),
+    "http": Histogram("rag_http_request_seconds", "HTTP request latency (until the response starts)", ["method", "path"]),
+}
+LLM_CALLS = Counter("rag_llm_calls_total", "LLM calls", ["model"])
+LLM_TOKENS = Counter("rag_llm_tokens_total", "LLM tokens", ["model", "type"])
+# Contadores y gauges con nombre corto, para poder reenviarlos desde los procesos de ingesta
+COUNTERS = {
+    "enrichment_requests": Counter(
+        "rag_enrichment_requests_total", "Enrichment LLM requests by outcome", ["task", "outcome"]),
+    "enrichment_items": Counter(
+        "rag_enrichment_items_total", "Enriched items by source (cache or generated)", ["task", "source"]),
+    "enrichment_throttled": Counter(
+        "rag_enrichment_throttled_seconds_total", "Time enrichment requests waited on the rate limiter", ["task"]),
+    "images": Counter(
+        "rag_images_total", "Document images by preprocessing outcome", ["outcome"]),
+    "form_fields": Counter(
+        "rag_form_fields_total", "Extracted form fields by source (acroform, clave_valor, llm, missing)", ["source"]),
+    "image_bytes_saved": Counter(
+        "rag_image_base64_bytes_saved_total", "Base64 bytes not sent to the vision model"),
+}
+GAUGES = {
+    "enrichment_concurrency": Gauge(
+        "rag_enrichment_concurrency", "Adaptive enrichment concurrency limit at the end of the last run"),
+    "enrichment_throughput": Gauge(
+        "rag_enrichment_items_per_second", "Generated items per second in the last enrichment run"),
+}
+
+
+class Trace:
+    """Spans and LLM usage recorded while handling one request (or one ingestion in a worker)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+
+    def breakdown(self):
+        """Per-request timing breakdown: milliseconds per span and LLM usage totals"""
+        spans = {}
+        llm = {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+        for event in self.events:
+            if event[0] == "span":
+                _, kind, labels, seconds = event
+                name = f"{kind}:{next(iter(labels.values()), '')}" if labels else kind
+                spans[name] = round(spans.get(name, 0.0) + seconds * 1000, 3)
+            elif event[0] == "llm":
+                _, _, input_tokens, output_tokens = event
+                llm["calls"] += 1
+                llm["input_tokens"] += input_tokens
+                llm["output_tokens"] += output_tokens
+        return {"total_ms": round((time.perf_counter() - self.started) * 1000, 3), "spans": spans, "llm": llm}
+
+
+_trace = ContextVar("rag_trace", default=None)
+
+
+def start_trace():
+    """Record into a new Trace for the rest of the current context"""
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+@contextmanager
+def tracing():
+    """Collect the spans of the enclosed code (and the tasks/threads it starts) in a Trace"""
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def detach():
+    """Stop recording into the current trace (e.g. background work started by a request)"""
+    _trace.set(None)
+
+
+def record(kind, seconds, **labels):
+    trace = _trace.get()
+    if trace is not None:
+        trace.events.append(("span", kind, labels, seconds))
+    if METRICS_ENABLED:
+        SPANS[kind].observe(seconds, **labels)
+
+
+@contextmanager
+def _span(kind, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, time.perf_counter() - start, **labels)
+
+
+def span(kind, **labels):
+    """Time a block into the `kind` histogram (and the current trace, if any)"""
+    if not METRICS_ENABLED and _trace.get() is None:
+        return nullcontext()
+    return _span(kind, labels)
+
+
+def record_llm(model, input_tokens, output_tokens):
+    trace = _trace.get()
+    if trace is not None:
+        trace.events.append(("llm", model, input_tokens, output_tokens))
+    if METRICS_ENABLED:
+        LLM_CALLS.inc(model=model)
+        LLM_TOKENS.inc(input_tokens, model=model, type="input")
+        LLM_TOKENS.inc(output_tokens, model=model, type="output")
+
+
+def count(name, value=1, **labels):
+    trace = _trace.get()
+    if trace is not None:
+        trace.events.append(("count", name, labels, value))
+    if METRICS_ENABLED:
+        COUNTERS[name].inc(value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    trace = _trace.get()
+    if trace is not None:
+        trace.events.append(("gauge", name, labels, value))
+    if METRICS_ENABLED:
+        GAUGES[name].set(value, **labels)
+
+
+def replay(events):
+    """Observe events recorded in another process (ingestion workers)"""
+    for event in events:
+        if event[0] == "span":
+            _, kind, labels, seconds = event
+            record(kind, seconds, **labels)
+        elif event[0] == "llm":
+            record_llm(*event[1:])
+        elif event[0] == "count":
+            _, name, labels, value = event
+            count(name, value, **labels)
+        elif event[0] == "gauge":
+            _, name, labels, value = event
+            set_gauge(name, value, **labels)
+
+
+def timed_node(name, node):
+    """Wrap a LangGraph node so each run is recorded as a `node` span"""
+    takes_config = "config" in inspect.signature(node).parameters
+
+    @functools.wraps(node)
+    async def wrapper(state, config):
+        with span("node", node=name):
+            return await (node(state, config) if takes_config else node(state))
+
+    # LangGraph inspecciona la firma para inyectar config
+    wrapper.__signature__ = inspect.Signature([
+        inspect.Parameter("state", inspect.Parameter.POSITIONAL_OR_KEYWORD),
+        inspect.Parameter("config", inspect.Parameter.POSITIONAL_OR_KEYWORD),
+    ])
+    return wrapper
+
+
+class LLMUsageCallback(BaseCallbackHandler):
+    """Counts LLM calls and token usage per model"""
+
+    run_inline = True
+
+    def on_llm_end(self, response, **kwargs):
+        if not METRICS_ENABLED and _trace.get() is None:
+            return
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or {}
+                metadata = getattr(message, "response_metadata", None) or {}
+                model = metadata.get("model_name") or (response.llm_output or {}).get("model_name") or "unknown"
+                record_llm(model, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+
+
+llm_usage_callback = LLMUsageCallback()
+
+
+def render(collectors=None, labels=None):
+    """Prometheus text format: spans, LLM counters and numeric values of `collectors` as gauges.
+
+    `collectors` maps a component name to a function returning a flat stats dict; `labels` maps a
+    component name to the labels of its gauges (e.g. the tenant of per-tenant components).
+    """
+    lines = []
+    for histogram in SPANS.values():
+        lines.extend(histogram.render())
+    lines.extend(LLM_CALLS.render())
+    lines.extend(LLM_TOKENS.render())
+    for metric in (*COUNTERS.values(), *GAUGES.values()):
+        lines.extend(metric.render())
+    for component, stats in (collectors or {}).items():
+        component_labels = (labels or {}).get(component, {})
+        suffix = _labels(list(component_labels), list(component_labels.values()))
+        for key, value in stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"rag_{component}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
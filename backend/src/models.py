@@ -11,10 +11,39 @@ class HistoryEntry(BaseModel):
     role: RoleEnum
     content: str
 
+class RetrievalOptions(BaseModel):
+    k: Optional[int] = None
+    dense_weight: Optional[float] = None
+    lexical_weight: Optional[float] = None
+    candidates: Optional[int] = None
+    mmr_lambda: Optional[float] = None
+    context_budget: Optional[int] = None
+
+class ContentTypeEnum(str, Enum):
+    text = "text"
+    table = "table"
+    image = "image"
+
+class RetrievalFilters(BaseModel):
+    filenames: Optional[List[str]] = None
+    content_types: Optional[List[ContentTypeEnum]] = None
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
+
+class DocumentScope(BaseModel):
+    filenames: List[str]
+
 class PredictRequest(BaseModel):
     question: str
-    chat_history: List[HistoryEntry]
+    chat_history: Optional[List[HistoryEntry]] = None
     summary: Optional[str] = ""
+    retrieval: Optional[RetrievalOptions] = None
+    filters: Optional[RetrievalFilters] = None
+    session_id: Optional[str] = None
+    # Tenant cuyas colecciones se consultan (si no viene, la cabecera X-Tenant-ID o el tenant por defecto)
+    tenant: Optional[str] = None
+    # Incluir en la respuesta el desglose de tiempos por nodo/paso y el uso del LLM
+    timings: bool = False
 
 class Document(BaseModel):
     page_content: str
@@ -25,4 +54,56 @@ class Response(BaseModel):
     answer: str
     documents: str # List[Document]
     chat_history: List[HistoryEntry]
-    summary: Optional[str] = ""
\ No newline at end of file
+    summary: Optional[str] = ""
+    cached: bool = False
+    context_tokens: Optional[int] = None
+    session_id: Optional[str] = None
+    timings: Optional[Dict] = None
+
+class TenantCreate(BaseModel):
+    tenant: str
+
+class TenantInfo(BaseModel):
+    tenant: str
+    shards: int
+
+class SessionInfo(BaseModel):
+    session_id: str
+    chat_history: List[HistoryEntry] = []
+    summary: Optional[str] = ""
+    total_tokens: int = 0
+    documents: Optional[List[str]] = None
+
+class JobFileStatus(BaseModel):
+    filename: str
+    stage: str
+    progress: float
+    error: Optional[str] = None
+    # Imágenes encontradas, llamadas de visión y bytes ahorrados por el preprocesamiento
+    images: Optional[Dict] = None
+    # Páginas del archivo, re-procesadas y conservadas de la versión anterior; chunks agregados y borrados
+    pages: Optional[Dict] = None
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str
+    created_at: float
+    progress: float
+    files: List[JobFileStatus]
+
+class DocumentInfo(BaseModel):
+    filename: str
+    document_id: str
+    pages: Optional[int] = None
+    chunks: int
+    created_at: float
+    updated_at: float
+
+class DocumentList(BaseModel):
+    documents: List[DocumentInfo]
+
+class UploadResponse(BaseModel):
+    status: str
+    job_id: Optional[str] = None
+    queued_files: List[str]
+    skipped: int
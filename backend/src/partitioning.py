@@ -0,0 +1,179 @@
+from unstructured.partition.pdf import partition_pdf
+from unstructured.documents.elements import PageBreak
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import multiprocessing
+import os
+import shutil
+import tempfile
+import logging
+import fitz  # PyMuPDF
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Particionado en paralelo por ventanas de páginas
+PDF_PARALLEL_PARTITION = os.environ.get("PDF_PARALLEL_PARTITION", "1") == "1"
+PDF_WINDOW_SIZE = int(os.environ.get("PDF_WINDOW_SIZE", 20))
+# Cantidad máxima de PDFs procesándose a la vez (un proceso por PDF, ver src.jobs).
+# Por defecto deja un core libre para el tráfico de chat.
+INGEST_MAX_WORKERS = int(os.environ.get("INGEST_MAX_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+# Cada proceso de ingesta abre su propio pool: por defecto se reparten los núcleos entre ellos
+# en vez de lanzar núcleos x núcleos procesos, cada uno con los modelos de Unstructured cargados
+PDF_PARTITION_WORKERS = int(os.environ.get(
+    "PDF_PARTITION_WORKERS", max(1, (os.cpu_count() or 1) // max(INGEST_MAX_WORKERS, 1))
+))
+
+# Selección de estrategia por página: hi_res solo donde hace falta análisis de layout
+PDF_PAGE_STRATEGY = os.environ.get("PDF_PAGE_STRATEGY", "1") == "1"
+PDF_MIN_TEXT_CHARS = int(os.environ.get("PDF_MIN_TEXT_CHARS", 50))
+PDF_MIN_IMAGE_AREA = float(os.environ.get("PDF_MIN_IMAGE_AREA", 0.02))  # fracción del área de la página
+
+HI_RES = "hi_res"
+FAST = "fast"
+
+PARTITION_KWARGS = {
+    HI_RES: dict(
+        strategy="hi_res",
+        extract_image_block_types=["Image", "Table"],
+        extract_image_block_to_payload=True,
+        infer_table_structure=True,
+        include_page_breaks=True,
+    ),
+    FAST: dict(
+        strategy="fast",
+        include_page_breaks=True,
+    ),
+}
+
+
+def classify_page(page):
+    """Decide the partition strategy for a single PyMuPDF page"""
+    if len(page.get_text("text").strip()) < PDF_MIN_TEXT_CHARS:
+        return HI_RES  # sin capa de texto: requiere OCR
+
+    page_area = abs(page.rect) or 1
+    for image in page.get_image_info():
+        if abs(fitz.Rect(image["bbox"])) / page_area >= PDF_MIN_IMAGE_AREA:
+            return HI_RES
+
+    if page.find_tables().tables:
+        return HI_RES
+
+    return FAST
+
+
+def classify_pages(pdf_path):
+    """Pre-scan the PDF and return one strategy per page"""
+    with fitz.open(pdf_path) as doc:
+        return [classify_page(page) for page in doc]
+
+
+def plan_segments(strategies, window_size):
+    """Group consecutive pages with the same strategy into (start, end, strategy) windows"""
+    segments = []
+    start = 0
+    for i in range(1, len(strategies) + 1):
+        if i == len(strategies) or strategies[i] != strategies[start] or i - start >= window_size:
+            segments.append((start, i - 1, strategies[start]))
+            start = i
+    return segments
+
+
+def _partition_window(window_path, page_offset, filename, strategy):
+    """Partition one page window and shift its page numbers back to the original document"""
+    elements = partition_pdf(window_path, metadata_filename=filename, **PARTITION_KWARGS[strategy])
+    for element in elements:
+        if element.metadata.page_number is not None:
+            element.metadata.page_number += page_offset
+    return elements
+
+
+def partition_segments(pdf_path, segments, filename=None, max_workers=PDF_PARTITION_WORKERS, executor=None):
+    """Partition each page segment (in parallel when possible) and merge the elements in order.
+
+    `executor` is a process pool to reuse across calls (e.g. every page window
+    of a large document); otherwise one is started for this call.
+    """
+    window_dir = tempfile.mkdtemp(prefix="pdf_windows_")
+    try:
+        window_paths = []
+        with fitz.open(pdf_path) as doc:
+            for start, end, _ in segments:
+                window_path = os.path.join(window_dir, f"{start:06d}.pdf")
+                with fitz.open() as window:
+                    window.insert_pdf(doc, from_page=start, to_page=end)
+                    window.save(window_path)
+                window_paths.append(window_path)
+
+        args = (
+            window_paths,
+            [start for start, _, _ in segments],
+            [filename] * len(segments),
+            [strategy for _, _, strategy in segments],
+        )
+
+        workers = min(max_workers, len(segments))
+        logger.info(f"Partitioning {len(segments)} page windows with {workers} workers...")
+        if executor is not None and workers > 1:
+            results = list(executor.map(_partition_window, *args))
+        elif workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results = list(pool.map(_partition_window, *args))
+        else:
+            results = list(map(_partition_window, *args))
+
+        # Unir ventanas en orden; cada ventana termina sin PageBreak, así que lo agregamos
+        elements = []
+        for i, window_elements in enumerate(results):
+            if i > 0:
+                elements.append(PageBreak(text=""))
+            elements.extend(window_elements)
+        return elements
+    finally:
+        shutil.rmtree(window_dir, ignore_errors=True)
+
+
+def partition_document(pdf_path, filename=None, executor=None):
+    """Partition a PDF choosing the strategy per page and splitting it into page windows"""
+    if PDF_PAGE_STRATEGY:
+        strategies = classify_pages(pdf_path)
+    else:
+        with fitz.open(pdf_path) as doc:
+            strategies = [HI_RES] * doc.page_count
+
+    stats = Counter(strategies)
+    logger.info(
+        f"Page strategies for {filename or pdf_path}: "
+        f"{stats[FAST]} fast | {stats[HI_RES]} hi_res ({len(strategies)} pages)"
+    )
+
+    window_size = PDF_WINDOW_SIZE if PDF_PARALLEL_PARTITION else max(len(strategies), 1)
+    segments = plan_segments(strategies, window_size)
+
+    if len(segments) == 1:
+        return partition_pdf(pdf_path, metadata_filename=filename, **PARTITION_KWARGS[segments[0][2]])
+
+    max_workers = PDF_PARTITION_WORKERS if PDF_PARALLEL_PARTITION else 1
+    return partition_segments(pdf_path, segments, filename=filename, max_workers=max_workers, executor=executor)
+
+
+def partition_pages(pdf_path, pages, filename=None, executor=None):
+    """Partition only the given 1-based `pages` of a PDF, keeping their original page numbers"""
+    pages = sorted(pages)
+    fd, subset_path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    try:
+        with fitz.open(pdf_path) as doc, fitz.open() as subset:
+            for page in pages:
+                subset.insert_pdf(doc, from_page=page - 1, to_page=page - 1)
+            subset.save(subset_path)
+        elements = partition_document(subset_path, filename=filename, executor=executor)
+    finally:
+        os.remove(subset_path)
+
+    # Página i del subconjunto -> página original
+    for element in elements:
+        if element.metadata.page_number is not None:
+            element.metadata.page_number = pages[element.metadata.page_number - 1]
+    return elements
@@ -1,11 +1,23 @@
-from unstructured.partition.pdf import partition_pdf
 from unstructured.chunking.title import chunk_by_title
+from unstructured.staging.base import elements_to_dicts, elements_from_dicts
 from src.chains import get_image_chain, get_text_chain
+from src.partitioning import partition_document, partition_pages, PDF_PARALLEL_PARTITION, PDF_PARTITION_WORKERS
+from src.cache import get_cache, content_hash, file_hash
+from src.enrichment import EnrichmentScheduler
+from src.images import ImageIndex, plan_images, IMAGE_PREPROCESS
+from src.metrics import span, count
 from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain.storage import InMemoryStore
 from langchain.schema import Document
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import asyncio
+import multiprocessing
 import uuid
 import os
+import re
+from collections import Counter
+import fitz  # PyMuPDF
+import tempfile
 import logging
 from dotenv import load_dotenv
 load_dotenv()
@@ -14,6 +26,15 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Páginas por ventana del pipeline de ingesta: cada ventana se particiona, enriquece y guarda
+# antes de leer la siguiente, así la memoria no crece con el tamaño del PDF. El último chunk de
+# texto de una ventana se vuelve a armar con la siguiente, así las secciones que cruzan el borde
+# quedan igual que procesando el archivo de una vez
+INGEST_WINDOW_PAGES = int(os.environ.get("INGEST_WINDOW_PAGES", 50))
+
+# Prefijo con la página que llevan los textos de tablas e imágenes
+PAGE_PREFIX_RE = re.compile(r"^(Table|Image) from page \S+?(?=[:. ]|$)")
+
 image_chain = get_image_chain()
 text_chain = get_text_chain()
 table_chain = get_text_chain()
@@ -44,6 +65,10 @@ def extract_and_categorize_content(elements):
     
     return text_elements, table_elements, image_elements
 
+def with_page(text, page):
+    """`text` with its "Table/Image from page N" prefix pointing to `page` (other texts unchanged)"""
+    return PAGE_PREFIX_RE.sub(lambda match: f"{match.group(1)} from page {page}", text, count=1)
+
 def create_rag_chunks(text_elements, table_elements, image_elements):
     """Create optimized chunks for different content types"""
 
@@ -95,38 +120,63 @@ def create_rag_chunks(text_elements, table_elements, image_elements):
     return all_chunks
 
 
-def enhance_chunks_with_summaries(chunks, text_chain=None, table_chain=None, image_chain=None):
-    """Add summaries/descriptions to existing chunks using batch processing"""
-    
-    # Separate chunks by type for batch processing
-    image_chunks = [chunk for chunk in chunks if chunk.metadata.content_type == "image"]
+def enhance_chunks_with_summaries(chunks, text_chain=None, table_chain=None, image_chain=None, on_progress=None,
+                                  stats=None, scheduler=None, runner=None, image_index=None):
+    """Add descriptions to image chunks and summaries to table chunks.
 
-    # Process image chunks
-    if image_chain and image_chunks:
-        # Extract image data for batch processing
-        image_data = []
-        for chunk in image_chunks:
-            if hasattr(chunk.metadata, 'image_base64'):
-                image_data.append(chunk.metadata.image_base64)
-            else:
-                image_data.append(chunk.text)  # Fallback to text
-        
-        image_descriptions = image_chain.batch(image_data)
-        
-        for chunk, description in zip(image_chunks, image_descriptions):
-            chunk.metadata.description = description
-            chunk.text = f"Image Description: {description}\n\n{chunk.text}"
-    
-    # Process table chunks
+    Images are filtered and deduplicated first (see src.images): decorative ones
+    are dropped and each group of near-duplicates is described once. Both tasks
+    run through one EnrichmentScheduler (rate limited, retried and checkpointed
+    in the ingestion cache). `on_progress(done, total)` reports items; the image
+    report is added to `stats["images"]` if given. Pass a `scheduler` and an
+    asyncio `runner` to share the rate limits and event loop between calls, and
+    an `image_index` (ImageIndex) to deduplicate images across calls.
+    """
+    image_chunks = [chunk for chunk in chunks if chunk.metadata.content_type == "image"]
     table_chunks = [chunk for chunk in chunks if chunk.metadata.content_type == "table"]
-    if table_chain and table_chunks:
-        table_contents = [chunk.text for chunk in table_chunks]
-        table_summaries = table_chain.batch(table_contents)
-        
-        for chunk, summary in zip(table_chunks, table_summaries):
-            # chunk.metadata.summary = summary
-            chunk.text = f"Table Summary: {summary}\n\n{chunk.text}"
-    
+
+    # Imagen en base64, o el texto si el elemento no la trae
+    image_data = [getattr(chunk.metadata, "image_base64", None) or chunk.text for chunk in image_chunks]
+    table_contents = [chunk.text for chunk in table_chunks]
+
+    plan, reused = None, {}
+    if IMAGE_PREPROCESS and image_chain and image_data:
+        plan = plan_images(image_data, index=image_index)
+        record_image_plan(plan, stats)
+        image_data, groups, reused = plan.payloads, plan.groups, plan.reused
+    else:
+        groups = list(range(len(image_data)))
+
+    scheduler = scheduler or EnrichmentScheduler()
+    scheduler.on_progress = on_progress
+    jobs = scheduler.run({
+        "image_description": (image_chain, image_data),
+        "table_summary": (table_chain, table_contents),
+    })
+    results = runner.run(jobs) if runner else asyncio.run(jobs)
+
+    descriptions = results.get("image_description")
+    if plan is not None and image_index is not None and descriptions:
+        image_index.add(plan, descriptions)
+    dropped = set()
+    for i, (chunk, group) in enumerate(zip(image_chunks, groups)):
+        if i in reused:
+            # Misma imagen que una ya descrita en otra ventana del documento
+            description = reused[i]
+        elif group is None:
+            dropped.add(id(chunk))
+            continue
+        elif descriptions:
+            description = descriptions[group]
+        else:
+            continue
+        chunk.metadata.description = description
+        chunk.text = f"Image Description: {description}\n\n{chunk.text}"
+
+    for chunk, summary in zip(table_chunks, results.get("table_summary", [])):
+        chunk.metadata.summary = summary
+        chunk.text = f"Table Summary: {summary}\n\n{chunk.text}"
+
     # # Process text chunks
     # text_chunks = [chunk for chunk in chunks if chunk.metadata.content_type == "text"]
     # if text_chain and text_chunks:
@@ -136,94 +186,277 @@ def enhance_chunks_with_summaries(chunks, text_chain=None, table_chain=None, ima
     #     for chunk, summary in zip(text_chunks, text_summaries):
     #         chunk.metadata.summary = summary
     #         # chunk.text = f"Summary: {summary}\n\nFull Content:\n{chunk.text}"
-    
-    return chunks
 
+    return [chunk for chunk in chunks if id(chunk) not in dropped]
 
-def save_to_multivectorstore(enhanced_chunks, vectorstore):
-    store = InMemoryStore()
 
-    retriever = MultiVectorRetriever(
-        vectorstore=vectorstore,
-        docstore=store,
-        id_key="doc_id"
+def record_image_plan(plan, stats=None):
+    """Log and export how many vision calls and base64 bytes the image preprocessing saved"""
+    report = plan.report()
+    logger.info(
+        f"Images: {report['images']} found | {report['vision_calls']} to describe | "
+        f"{report['duplicates']} duplicates | {report['skipped_small']} small | "
+        f"{report['skipped_low_entropy']} low entropy | "
+        f"{report['base64_bytes_saved'] / 1024:.0f} KiB of base64 saved"
     )
-
-    summary_docs = []
-    full_docs = []
-    doc_ids = []
-
+    for outcome, key in (("described", "vision_calls"), ("duplicate", "duplicates"),
+                         ("small", "skipped_small"), ("low_entropy", "skipped_low_entropy")):
+        count("images", report[key], outcome=outcome)
+    count("image_bytes_saved", report["base64_bytes_saved"])
+    if stats is not None:
+        # Con varias ventanas de páginas el reporte se acumula
+        previous = stats.get("images") or {}
+        stats["images"] = {key: previous.get(key, 0) + value for key, value in report.items()}
+
+
+def chunks_to_documents(enhanced_chunks, file_digest):
+    """Convert enhanced chunks into (children, parents) LangChain documents.
+
+    Children are the compact texts that get embedded (table summaries, image
+    descriptions, text chunks); parents hold the full content and payloads and
+    go to the docstore under the same `doc_id`.
+
+    Ids are derived from the filename, the file hash and the chunk content, so
+    re-ingesting the same PDF produces the same ids and never duplicates vectors,
+    while the same PDF stored under another filename gets its own chunks.
+    """
+
+    children = []
+    parents = []
+    occurrences = Counter()
     for chunk in enhanced_chunks:
-        doc_id = str(uuid.uuid4())
-        doc_ids.append(doc_id)
-
         content_type = getattr(chunk.metadata, "content_type", "unknown").lower()
         page_number = getattr(chunk.metadata, "page_number", -1)
         filename = getattr(chunk.metadata, "filename", "unknown")
-
-        doc = Document(
-            page_content=chunk.text,
-            metadata={
-                "doc_id": doc_id,
-                "content_type": content_type,
-                "page_number": page_number,
-                "filename": filename
-            }
-        )
-
-        summary_docs.append(doc)
-        full_docs.append(doc)
-
-    retriever.vectorstore.add_documents(summary_docs)
-    retriever.docstore.mset(list(zip(doc_ids, full_docs)))
-
+        # Con multipage_sections un chunk de texto puede seguir en las páginas siguientes
+        pages = [getattr(element.metadata, "page_number", None)
+                 for element in getattr(chunk.metadata, "orig_elements", None) or []]
+        last_page = max([page for page in pages + [page_number] if isinstance(page, int)], default=-1)
+
+        chunk_hash = content_hash(f"{content_type}\x00{page_number}\x00{chunk.text}")
+        occurrences[chunk_hash] += 1
+        # El nombre es la clave del documento: sin él, dos nombres del mismo PDF compartirían chunks
+        doc_id = str(uuid.uuid5(
+            uuid.NAMESPACE_URL, f"{filename}:{file_digest}:{chunk_hash}:{occurrences[chunk_hash]}"
+        ))
+
+        metadata = {
+            "doc_id": doc_id,
+            "content_type": content_type,
+            "page_number": page_number,
+            "last_page": last_page,
+            "filename": filename,
+            "file_hash": file_digest,
+            "chunk_hash": chunk_hash
+        }
+        parent_metadata = dict(metadata)
+
+        child_text = chunk.text
+        if content_type == "table" and getattr(chunk.metadata, "summary", None):
+            # Solo el resumen se embebe; el HTML completo queda en el padre
+            child_text = f"Table from page {page_number}. Table Summary: {chunk.metadata.summary}"
+        elif content_type == "image":
+            parent_metadata["image_base64"] = getattr(chunk.metadata, "image_base64", None) or ""
+
+        children.append(Document(page_content=child_text, metadata=metadata))
+        parents.append(Document(page_content=chunk.text, metadata=parent_metadata))
+
+    return children, parents
+
+
+def make_multivector_retriever(vectorstore, docstore, **search_kwargs):
+    return MultiVectorRetriever(
+        vectorstore=vectorstore,
+        docstore=docstore,
+        id_key="doc_id",
+        search_kwargs=search_kwargs
+    )
 
 
-def parse_pdf(pdf_bytes, vectorstore):
+def save_to_multivectorstore(children, parents, retriever, lexical_index=None):
+    doc_ids = [doc.metadata["doc_id"] for doc in children]
+
+    # Solo embeber chunks que todavía no están en la colección
+    existing = set(retriever.vectorstore.get(ids=doc_ids, include=[])["ids"]) if doc_ids else set()
+    new_children = [doc for doc in children if doc.metadata["doc_id"] not in existing]
+    logger.info(f"{len(existing)} chunks already stored | {len(new_children)} new")
+
+    if new_children:
+        with span("ingest", stage="vector_write"):
+            retriever.vectorstore.add_documents(new_children, ids=[doc.metadata["doc_id"] for doc in new_children])
+    with span("ingest", stage="docstore_write"):
+        retriever.docstore.mset(list(zip(doc_ids, parents)))
+
+    # El índice léxico usa el contenido completo (celdas de tablas, códigos...)
+    if lexical_index is not None:
+        with span("ingest", stage="lexical_write"):
+            lexical_index.add_documents(parents)
+    return len(new_children)
+
+
+def page_windows(pages, window_pages=INGEST_WINDOW_PAGES):
+    """Split sorted page numbers into consecutive windows of at most `window_pages` pages"""
+    window_pages = max(window_pages, 1)
+    return [pages[i:i + window_pages] for i in range(0, len(pages), window_pages)]
+
+
+def hold_open_chunk(chunks):
+    """Remove the last text chunk from `chunks` and return the elements it was built from.
+
+    Chunked again at the start of the next window, a section that runs past the
+    window boundary gives the same chunks as a single pass (chunk_by_title fills
+    chunks greedily from the start of each section).
+    """
+    for i in range(len(chunks) - 1, -1, -1):
+        if chunks[i].metadata.content_type == "text":
+            return list(getattr(chunks.pop(i).metadata, "orig_elements", None) or [])
+    return []
+
+
+def partition_window(pdf_path, file_digest, pages, page_count, filename=None, executor=None):
+    """Elements of the given 1-based `pages` of a PDF, from the ingestion cache or Unstructured"""
+    cache = get_cache()
+    whole = len(pages) == page_count
+    # La partición del archivo completo se cachea por su hash; la de un subconjunto de páginas, aparte
+    partition_key = file_digest if whole else f"{file_digest}:{content_hash(','.join(map(str, pages)))}"
+
+    cached_elements = cache.get("partitions", partition_key)
+    if cached_elements is not None:
+        logger.info(f"Reusing cached partition for {filename or pdf_path} ({file_digest[:12]}, {len(pages)} pages)")
+        elements = elements_from_dicts(cached_elements)
+        if filename:
+            for element in elements:
+                element.metadata.filename = filename
+        return elements
+
+    logger.info(f"Partitioning {len(pages)} pages of {pdf_path}...")
+    if whole:
+        elements = partition_document(pdf_path, filename=filename, executor=executor)
+    else:
+        elements = partition_pages(pdf_path, pages, filename=filename, executor=executor)
+    cache.set("partitions", partition_key, elements_to_dicts(elements))
+    return elements
+
+
+def iter_pdf_windows(pdf_path, filename=None, on_progress=None, stats=None, pages=None,
+                     window_pages=INGEST_WINDOW_PAGES):
+    """Stream a PDF on disk through the ingestion pipeline one page window at a time.
+
+    Each window of `window_pages` pages is partitioned, categorized, chunked and
+    enriched, and its (children, parents) documents are yielded before the next
+    window is read: memory is bounded by the window, not by the file. The
+    partition pool, the event loop and the enrichment rate limits are shared by
+    every window. Arguments as in process_pdf.
+    """
+    def report(stage, progress):
+        if on_progress:
+            on_progress(stage, progress)
+
+    file_digest = file_hash(pdf_path)
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    pages = sorted(pages) if pages is not None else list(range(1, page_count + 1))
+    windows = page_windows(pages, window_pages)
+    logger.info(f"Ingesting {len(pages)} pages of {filename or pdf_path} in {len(windows)} windows")
+
+    scheduler = EnrichmentScheduler()
+    # Imágenes ya descritas en ventanas anteriores: un logo repetido en todo el archivo se describe una vez
+    image_index = ImageIndex()
+    # Un solo pool para particionar todas las ventanas (arrancar procesos spawn por ventana es caro)
+    pool = None
+    if PDF_PARALLEL_PARTITION and len(windows) > 1:
+        pool = ProcessPoolExecutor(max_workers=PDF_PARTITION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+    # Elementos del último chunk de texto de la ventana anterior (sección que puede seguir)
+    carry = []
+    with asyncio.Runner() as runner, pool or nullcontext():
+        for index, window in enumerate(windows):
+            # Progreso global: 0.1 a 0.9 repartido entre las ventanas
+            def window_progress(stage, fraction, index=index):
+                report(stage, 0.1 + 0.8 * (index + fraction) / len(windows))
+
+            # Extraer elementos con Unstructured (o reutilizar la partición cacheada)
+            window_progress("partitioning", 0.0)
+            with span("ingest", stage="partitioning"):
+                elements = partition_window(pdf_path, file_digest, window, page_count, filename, pool)
+            logger.info(f"Partitioned {len(elements)} elements (pages {window[0]}-{window[-1]}).")
+
+            # Clasificar
+            window_progress("categorizing", 0.4)
+            with span("ingest", stage="categorizing"):
+                text_elements, table_elements, image_elements = extract_and_categorize_content(elements)
+                text_elements = carry + text_elements
+            logger.info(
+                f"Extracted: {len(text_elements)} text | {len(table_elements)} tables | {len(image_elements)} images"
+            )
+
+            # Chunking
+            window_progress("chunking", 0.5)
+            with span("ingest", stage="chunking"):
+                rag_chunks = create_rag_chunks(text_elements, table_elements, image_elements)
+                # Solo si la ventana siguiente continúa en la página de al lado (en un upsert parcial puede no ser así)
+                contiguous = index + 1 < len(windows) and windows[index + 1][0] == window[-1] + 1
+                carry = hold_open_chunk(rag_chunks) if contiguous else []
+            logger.info(f"Created {len(rag_chunks)} RAG chunks")
+
+            # Enriquecimiento con resumen/descripciones
+            window_progress("enriching", 0.6)
+            with span("ingest", stage="enriching"):
+                enhanced_chunks = enhance_chunks_with_summaries(
+                    rag_chunks,
+                    text_chain=text_chain,
+                    table_chain=table_chain,
+                    image_chain=image_chain,
+                    on_progress=lambda done, total: window_progress("enriching", 0.6 + 0.4 * done / total),
+                    stats=stats,
+                    scheduler=scheduler,
+                    runner=runner,
+                    image_index=image_index,
+                )
+
+            children, parents = chunks_to_documents(enhanced_chunks, file_digest)
+            # Soltar los elementos de la ventana antes de pasar a la siguiente
+            del elements, text_elements, table_elements, image_elements, rag_chunks, enhanced_chunks
+            yield children, parents
+
+    report("enriched", 0.9)
+
+
+def process_pdf(pdf_path, filename=None, on_progress=None, stats=None, pages=None, window_pages=INGEST_WINDOW_PAGES):
+    """Partition, chunk and enrich a PDF on disk. Returns the (children, parents) documents to store.
+
+    `on_progress(stage, progress)` is called as the pipeline advances so callers
+    running this in a worker process can report status back. Per-document
+    reports (e.g. the image preprocessing savings) are added to `stats`.
+    With `pages` (1-based), only those pages are processed (incremental upserts).
+    Collects every window of iter_pdf_windows; iterate that instead to store
+    large files window by window.
+    """
+    children, parents = [], []
+    for window_children, window_parents in iter_pdf_windows(
+        pdf_path, filename=filename, on_progress=on_progress, stats=stats, pages=pages, window_pages=window_pages
+    ):
+        children.extend(window_children)
+        parents.extend(window_parents)
+    return children, parents
+
+
+def parse_pdf(pdf_bytes, retriever, lexical_index=None, filename=None):
     logger.info("Starting PDF parsing process...")
 
-    # Guardar archivo temporal
-    with open("temp.pdf", "wb") as f:
+    # Guardar archivo temporal (uno por llamada, para no pisar uploads concurrentes)
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
         f.write(pdf_bytes)
-    logger.debug("PDF saved to temp.pdf")
+    logger.debug(f"PDF saved to {pdf_path}")
     try:
-        # Extraer elementos con Unstructured
-        logger.info("Partitioning PDF content...")
-        elements = partition_pdf(
-            "temp.pdf",
-            strategy="hi_res",
-            extract_image_block_types=["Image", "Table"],
-            extract_image_block_to_payload=True,
-            infer_table_structure=True,
-            include_page_breaks=True,
-        )
-        logger.info(f"Partitioned {len(elements)} elements.")
-
-        # Clasificar
-        text_elements, table_elements, image_elements = extract_and_categorize_content(elements)
-        logger.info(
-            f"Extracted: {len(text_elements)} text | {len(table_elements)} tables | {len(image_elements)} images"
-        )
-
-        # Chunking
-        rag_chunks = create_rag_chunks(text_elements, table_elements, image_elements)
-        logger.info(f"Created {len(rag_chunks)} RAG chunks")
-
-        # Enriquecimiento con resumen/descripciones
-        logger.info("Enhancing chunks with summaries/descriptions...")
-        enhanced_chunks = enhance_chunks_with_summaries(
-            rag_chunks,
-            text_chain=text_chain,
-            table_chain=table_chain,
-            image_chain=image_chain,
-        )
-        logger.info("Chunks enhanced.")
-
-        # Guardar en vectorstore
+        children, parents = process_pdf(pdf_path, filename=filename)
+
+        # Guardar en vectorstore + docstore
         logger.info("Saving chunks to vectorstore...")
-        save_to_multivectorstore(enhanced_chunks, vectorstore=vectorstore)
+        save_to_multivectorstore(children, parents, retriever=retriever, lexical_index=lexical_index)
         logger.info("Chunks saved successfully.")
     finally:
-        if os.path.exists("temp.pdf"):
-            os.remove("temp.pdf")
-            logger.debug("Temporary file temp.pdf removed.")
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+            logger.debug(f"Temporary file {pdf_path} removed.")
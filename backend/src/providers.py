@@ -0,0 +1,164 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from src.lexical import tokenize
+from src.metrics import llm_usage_callback
+from dotenv import load_dotenv
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+load_dotenv()
+
+# "openai" (por defecto) o "fake": embedder por hash y LLM eco, deterministas y sin red
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "openai")
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", LLM_PROVIDER)
+# Latencia simulada de los fakes, en milisegundos
+FAKE_LLM_LATENCY_MS = float(os.environ.get("FAKE_LLM_LATENCY_MS", 0))
+FAKE_EMBEDDING_LATENCY_MS = float(os.environ.get("FAKE_EMBEDDING_LATENCY_MS", 0))
+FAKE_EMBEDDING_DIM = int(os.environ.get("FAKE_EMBEDDING_DIM", 256))
+
+
+def _message_text(message):
+    """Text of a message whose content may be a list of parts (e.g. text + image)"""
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic embeddings by feature hashing of the tokens.
+
+    Texts sharing words get similar vectors, so retrieval behaves plausibly
+    without a provider. `latency_ms` is slept once per request.
+    """
+
+    def __init__(self, dim=FAKE_EMBEDDING_DIM, latency_ms=FAKE_EMBEDDING_LATENCY_MS):
+        self.dim = dim
+        self.latency_ms = latency_ms
+        self.model = f"hash-{dim}"
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for token in tokenize(text):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class EchoChatModel(BaseChatModel):
+    """Canned chat model for offline runs and benchmarks.
+
+    - with a `retrieve` tool bound and a fresh user question: calls retrieve(query=question)
+    - prompts asking for JSON: answers "{}"
+    - otherwise: echoes the last user message
+    """
+
+    model_name: str = "echo"
+    latency_ms: float = FAKE_LLM_LATENCY_MS
+
+    @property
+    def _llm_type(self):
+        return "echo"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _reply(self, messages, tools=None):
+        last = messages[-1]
+        question = next((_message_text(m) for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+        tool_names = {t["function"]["name"] for t in tools or []}
+
+        if "retrieve" in tool_names and not isinstance(last, ToolMessage) and question:
+            call = {"name": "retrieve", "args": {"query": question}, "id": f"call_{uuid.uuid4().hex[:24]}"}
+            content, tool_calls = "", [call]
+        elif "JSON" in question:
+            content, tool_calls = "{}", []
+        else:
+            content, tool_calls = f"Echo: {question[:500]}", []
+
+        input_tokens = sum(len(_message_text(m)) for m in messages) // 4
+        usage = {"input_tokens": input_tokens, "output_tokens": len(content) // 4 + 1,
+                 "total_tokens": input_tokens + len(content) // 4 + 1}
+        return AIMessage(content=content, tool_calls=tool_calls, usage_metadata=usage,
+                         response_metadata={"model_name": self.model_name})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages, kwargs.get("tools")))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages, kwargs.get("tools")))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        message = self._reply(messages, kwargs.get("tools"))
+        if message.tool_calls:
+            chunk = AIMessageChunk(content="", tool_call_chunks=[
+                {"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": 0}
+                for c in message.tool_calls
+            ], usage_metadata=message.usage_metadata, response_metadata=message.response_metadata)
+            yield ChatGenerationChunk(message=chunk)
+            return
+        words = message.content.split(" ")
+        for i, word in enumerate(words):
+            last = i == len(words) - 1
+            chunk = AIMessageChunk(
+                content=word if i == 0 else f" {word}",
+                usage_metadata=message.usage_metadata if last else None,
+                response_metadata=message.response_metadata if last else {},
+            )
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.content, chunk=chunk)
+            yield ChatGenerationChunk(message=chunk)
+
+
+def get_chat_model(model=None, **kwargs):
+    """Chat model of the configured provider. `kwargs` go to ChatOpenAI (temperature, max_tokens...)"""
+    # Contador de llamadas y tokens por modelo (/metrics)
+    callbacks = [llm_usage_callback]
+    if LLM_PROVIDER == "fake":
+        return EchoChatModel(callbacks=callbacks)
+    from langchain_openai import ChatOpenAI
+    if model is not None:
+        kwargs["model"] = model
+    return ChatOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), callbacks=callbacks, stream_usage=True, **kwargs)
+
+
+def get_embeddings():
+    """Embeddings of the configured provider (wrap with CachedEmbeddings for caching/batching)"""
+    if EMBEDDING_PROVIDER == "fake":
+        return HashEmbeddings()
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(api_key=os.environ.get("OPENAI_API_KEY"))
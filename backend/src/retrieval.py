@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import os
+import numpy as np
+from src.lexical import is_exact_query, tokenize
+from src.metrics import span
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_K = 4
+# Candidatos que trae cada buscador antes de fusionar
+RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", 20))
+RRF_K = int(os.environ.get("RRF_K", 60))
+DENSE_WEIGHT = float(os.environ.get("DENSE_WEIGHT", 1.0))
+LEXICAL_WEIGHT = float(os.environ.get("LEXICAL_WEIGHT", 1.0))
+LEXICAL_SHORT_CIRCUIT = os.environ.get("LEXICAL_SHORT_CIRCUIT", "1") == "1"
+# Diversificación (MMR) y supresión de casi-duplicados
+MMR_ENABLED = os.environ.get("MMR_ENABLED", "1") == "1"
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", 0.7))
+DEDUP_EMBEDDING_THRESHOLD = float(os.environ.get("DEDUP_EMBEDDING_THRESHOLD", 0.95))
+DEDUP_SHINGLE_THRESHOLD = float(os.environ.get("DEDUP_SHINGLE_THRESHOLD", 0.8))
+SHINGLE_SIZE = 5
+
+
+def merge_filters(*filters):
+    """Intersect several filter dicts (request, session scope, tool call).
+
+    Keys: `filenames`, `content_types` (lists) and `page_from`/`page_to` (ints).
+    """
+    merged = {}
+    for f in filters:
+        if not f:
+            continue
+        for key in ("filenames", "content_types"):
+            if f.get(key) is not None:
+                values = list(f[key])
+                merged[key] = [v for v in merged[key] if v in values] if key in merged else values
+        if f.get("page_from") is not None:
+            merged["page_from"] = max(merged.get("page_from", f["page_from"]), f["page_from"])
+        if f.get("page_to") is not None:
+            merged["page_to"] = min(merged.get("page_to", f["page_to"]), f["page_to"])
+    return merged
+
+
+def is_empty_scope(filters):
+    """True when the filters can't match anything (e.g. disjoint document sets)"""
+    return (
+        any(filters.get(key) == [] for key in ("filenames", "content_types"))
+        or filters.get("page_from", 0) > filters.get("page_to", float("inf"))
+    )
+
+
+def chroma_where(filters):
+    """Translate filters into a Chroma `where` clause so they are applied inside the search"""
+    clauses = []
+    if filters.get("filenames") is not None:
+        clauses.append({"filename": {"$in": filters["filenames"]}})
+    if filters.get("content_types") is not None:
+        clauses.append({"content_type": {"$in": filters["content_types"]}})
+    # Un chunk entra en el rango si alguna de sus páginas cae adentro (puede empezar antes de page_from).
+    # Los chunks guardados antes de registrar last_page no lo tienen: para ellos vale page_number
+    if filters.get("page_from") is not None:
+        clauses.append({"$or": [
+            {"last_page": {"$gte": filters["page_from"]}},
+            {"page_number": {"$gte": filters["page_from"]}},
+        ]})
+    if filters.get("page_to") is not None:
+        clauses.append({"page_number": {"$lte": filters["page_to"]}})
+
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+async def aresolve_ids(retriever, ids, children=None):
+    """Resolve doc_ids to their parent documents with a single docstore lookup.
+
+    Ids without a parent (e.g. data ingested before the docstore existed) fall
+    back to the child document when one is given, otherwise they are dropped.
+    """
+    children = children or {}
+    ids = list(dict.fromkeys(ids))
+    with span("retrieval", step="docstore"):
+        parents = await retriever.docstore.amget(ids)
+
+    resolved = []
+    for doc_id, parent in zip(ids, parents):
+        doc = parent or children.get(doc_id)
+        if doc is not None:
+            resolved.append(doc)
+    return resolved
+
+
+async def aresolve_parents(retriever, children):
+    by_id = {child.metadata.get(retriever.id_key): child for child in reversed(children)}
+    return await aresolve_ids(retriever, [child.metadata.get(retriever.id_key) for child in children], by_id)
+
+
+def needs_query_vector(query, dense_weight=DENSE_WEIGHT, lexical_weight=LEXICAL_WEIGHT):
+    """Whether ahybrid_search will embed this query (not for lexical short-circuits)"""
+    if dense_weight <= 0:
+        return False
+    return not (LEXICAL_SHORT_CIRCUIT and lexical_weight > 0 and is_exact_query(query))
+
+
+async def aembed_queries(retriever, queries):
+    """Embed several queries with one batched request when the embeddings support it"""
+    embeddings = retriever.vectorstore.embeddings
+    with span("retrieval", step="embed_batch"):
+        if hasattr(embeddings, "aembed_queries"):
+            return await embeddings.aembed_queries(queries)
+        return await asyncio.gather(*(embeddings.aembed_query(query) for query in queries))
+
+
+async def adense_children(retriever, query, k, filters=None, query_vector=None):
+    """Return (query vector, child hits); `query_vector` skips embedding the query"""
+    vectorstore = retriever.vectorstore
+    vector = query_vector
+    if vector is None:
+        with span("retrieval", step="embed_query"):
+            vector = await vectorstore.embeddings.aembed_query(query)
+    # El cliente de Chroma es sincrónico: la búsqueda corre en el threadpool
+    with span("retrieval", step="vector_search"):
+        children = await asyncio.to_thread(
+            vectorstore.similarity_search_by_vector, vector, k=k, filter=chroma_where(filters or {})
+        )
+    return vector, children
+
+
+async def alexical_search(lexical_index, query, k, filters=None):
+    with span("retrieval", step="lexical_search"):
+        return await asyncio.to_thread(lexical_index.search, query, k, filters)
+
+
+async def asearch(retriever, query, k=DEFAULT_K, filters=None):
+    """Async dense search: async query embedding, Chroma search off the event loop, bulk parent lookup"""
+    _, children = await adense_children(retriever, query, k, filters)
+    return await aresolve_parents(retriever, children)
+
+
+def reciprocal_rank_fusion(rankings, weights, rrf_k=RRF_K):
+    """Merge ranked doc_id lists: score(d) = sum(w / (rrf_k + rank)). Returns [(doc_id, score)]."""
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def mmr_order(relevance, embeddings, lambda_mult=MMR_LAMBDA, dup_threshold=DEDUP_EMBEDDING_THRESHOLD):
+    """Vectorized maximal marginal relevance.
+
+    Returns candidate indices in MMR order, dropping candidates whose cosine
+    similarity to an already selected one is >= `dup_threshold`. Candidates
+    without an embedding (zero rows) never count as similar to anything.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    unit = embeddings / np.where(norms == 0, 1, norms)
+    similarity = unit @ unit.T
+
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    remaining = np.ones(len(relevance), dtype=bool)
+    order = []
+    while remaining.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        remaining[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+        remaining &= similarity[best] < dup_threshold
+    return order
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    words = tokenize(text)
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def drop_near_duplicates(docs, k, threshold=DEDUP_SHINGLE_THRESHOLD):
+    """Keep up to k docs, skipping those whose shingle Jaccard with a kept doc is >= threshold"""
+    kept, kept_shingles = [], []
+    for doc in docs:
+        current = shingles(doc.page_content)
+        if any(len(current & other) / (len(current | other) or 1) >= threshold for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(current)
+        if len(kept) == k:
+            break
+    return kept
+
+
+async def adiversify(retriever, query_vector, fused, lambda_mult=MMR_LAMBDA):
+    """MMR over the fused candidate pool using the embeddings stored in Chroma"""
+    ids = [doc_id for doc_id, _ in fused]
+    with span("retrieval", step="fetch_embeddings"):
+        stored = await asyncio.to_thread(retriever.vectorstore.get, ids=ids, include=["embeddings"])
+    by_id = dict(zip(stored["ids"], stored["embeddings"]))
+    dim = len(query_vector)
+    embeddings = np.stack([
+        np.asarray(by_id[doc_id], dtype=np.float32) if doc_id in by_id else np.zeros(dim, dtype=np.float32)
+        for doc_id in ids
+    ])
+
+    # Relevancia = score RRF normalizado a [0, 1]
+    scores = np.array([score for _, score in fused], dtype=np.float32)
+    spread = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+
+    with span("retrieval", step="mmr"):
+        return [ids[i] for i in mmr_order(relevance, embeddings, lambda_mult)]
+
+
+async def ahybrid_search(retriever, lexical_index, query, k=DEFAULT_K, dense_weight=DENSE_WEIGHT,
+                         lexical_weight=LEXICAL_WEIGHT, candidates=RETRIEVAL_CANDIDATES, filters=None,
+                         mmr_lambda=MMR_LAMBDA, query_vector=None):
+    """Dense + BM25 search run concurrently and merged with reciprocal rank fusion.
+
+    `filters` are pushed down into both searches (Chroma `where` / SQL on the lexical index).
+    The fused pool of `candidates` is then diversified with MMR and near-duplicates
+    are dropped before keeping the final `k`. A precomputed `query_vector`
+    (e.g. from a batched embedding request) skips the query embedding.
+    """
+    filters = filters or {}
+    if is_empty_scope(filters):
+        return []
+    candidates = max(candidates, k)
+
+    # Códigos de pieza / error: si el índice léxico los encuentra no hace falta embedding
+    if LEXICAL_SHORT_CIRCUIT and lexical_weight > 0 and is_exact_query(query):
+        hits = await alexical_search(lexical_index, query, k, filters)
+        if hits:
+            logger.info(f"Lexical short-circuit for {query!r}")
+            return await aresolve_ids(retriever, [doc_id for doc_id, _ in hits])
+
+    dense_task = adense_children(retriever, query, candidates, filters, query_vector) if dense_weight > 0 else asyncio.sleep(0, (None, []))
+    lexical_task = alexical_search(lexical_index, query, candidates, filters) if lexical_weight > 0 else asyncio.sleep(0, [])
+    (query_vector, children), hits = await asyncio.gather(dense_task, lexical_task)
+
+    dense_ids = [child.metadata.get(retriever.id_key) for child in children]
+    lexical_ids = [doc_id for doc_id, _ in hits]
+    fused = reciprocal_rank_fusion([dense_ids, lexical_ids], [dense_weight, lexical_weight])[:candidates]
+
+    if MMR_ENABLED and query_vector is not None and len(fused) > k:
+        ranked = await adiversify(retriever, query_vector, fused, mmr_lambda)
+    else:
+        ranked = [doc_id for doc_id, _ in fused]
+
+    by_id = {child.metadata.get(retriever.id_key): child for child in children}
+    docs = await aresolve_ids(retriever, ranked, by_id)
+    return drop_near_duplicates(docs, k)
+
+
+def dedupe_across(results, id_key="doc_id"):
+    """Drop documents repeated across several result lists.
+
+    Each doc_id stays only in the list where it ranks best (earliest list on ties).
+    """
+    best = {}
+    for i, docs in enumerate(results):
+        for rank, doc in enumerate(docs):
+            doc_id = doc.metadata.get(id_key)
+            if doc_id is not None and (doc_id not in best or rank < best[doc_id][0]):
+                best[doc_id] = (rank, i)
+    return [
+        [doc for doc in docs if doc.metadata.get(id_key) is None or best[doc.metadata.get(id_key)][1] == i]
+        for i, docs in enumerate(results)
+    ]
@@ -0,0 +1,140 @@
+from src.lexical import tokenize, is_code
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Recuperación especulativa: buscar la pregunta mientras el LLM decide si llamar a retrieve
+SPECULATIVE_RETRIEVAL = os.environ.get("SPECULATIVE_RETRIEVAL", "0") == "1"
+# Similitud (Jaccard de tokens) mínima entre la pregunta y la query del LLM para reusar el resultado
+SPECULATIVE_MATCH_THRESHOLD = float(os.environ.get("SPECULATIVE_MATCH_THRESHOLD", 0.8))
+# Router local: preguntas obvias sobre documentos van directo a retrieve sin la llamada de ruteo
+LOCAL_ROUTER = os.environ.get("LOCAL_ROUTER", "0") == "1"
+# Especulaciones no reclamadas se descartan pasado este tiempo
+SPECULATION_TTL = 60
+
+# Palabras ya normalizadas con tokenize (minúsculas, sin tildes)
+DOCUMENT_HINTS = {
+    "documento", "documentos", "manual", "pdf", "archivo", "pagina", "paginas", "seccion", "capitulo",
+    "tabla", "figura", "imagen", "segun", "especificacion", "norma", "procedimiento",
+    "document", "page", "section", "chapter", "table", "figure", "image", "according", "specification",
+}
+TOOL_HINTS = {"calcula", "calcular", "python", "codigo", "grafico", "calculate", "compute", "code", "plot"}
+SMALL_TALK = {"hola", "gracias", "chau", "adios", "buenas", "hi", "hello", "thanks", "bye", "ok"}
+# Referencias a la conversación: el LLM tiene que reescribir la consulta
+FOLLOW_UP_HINTS = {"eso", "esto", "ese", "esa", "anterior", "antes", "dijiste", "that", "it", "those", "previous", "above"}
+
+
+def query_similarity(a, b):
+    a, b = set(tokenize(a)), set(tokenize(b))
+    return len(a & b) / (len(a | b) or 1)
+
+
+def local_route(question, has_history=False):
+    """True when the question clearly asks about the documents and can go straight to retrieve"""
+    tokens = set(tokenize(question))
+    if len(tokens) < 3 or tokens & (TOOL_HINTS | SMALL_TALK):
+        return False
+    if has_history and tokens & FOLLOW_UP_HINTS:
+        return False
+    return bool(tokens & DOCUMENT_HINTS) or any(is_code(token) for token in tokens)
+
+
+class Speculation:
+    """A retrieval for the raw question started before the routing call returns"""
+
+    def __init__(self, question, task):
+        self.question = question
+        self.task = task
+        self.started = time.perf_counter()
+        self.finished = None
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.finished = time.perf_counter()
+        # Marcar el error como visto: si nadie reclama la tarea no debe quedar un warning
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Speculative retrieval failed: {task.exception()}")
+
+    def elapsed_ms(self):
+        return ((self.finished or time.perf_counter()) - self.started) * 1000
+
+
+class Router:
+    """Local routing and speculative retrieval around the tool-routing LLM call.
+
+    `search(query, config)` is the same search the retrieve tool runs. A
+    speculation matched to a retrieve call is parked under its tool_call_id
+    until the tool claims it; an unmatched one is cancelled.
+    """
+
+    def __init__(self, search, speculative=SPECULATIVE_RETRIEVAL, local=LOCAL_ROUTER,
+                 threshold=SPECULATIVE_MATCH_THRESHOLD):
+        self.search = search
+        self.speculative = speculative
+        self.local = local
+        self.threshold = threshold
+        self._pending = {}
+        # Latencia media (EMA) de la llamada de ruteo: lo que ahorra el router local
+        self.routing_ms = None
+        self.counters = {
+            "llm_routes": 0, "local_routes": 0,
+            "speculative_hits": 0, "speculative_misses": 0,
+            "saved_ms": 0.0,
+        }
+
+    def _saved(self, kind, saved_ms):
+        self.counters[kind] += 1
+        self.counters["saved_ms"] += saved_ms
+        logger.info(f"Routing: {kind.rstrip('s')} (saved {saved_ms:.0f} ms this turn)")
+
+    def route_locally(self, question, has_history=False):
+        if not self.local or not local_route(question, has_history):
+            return False
+        self._saved("local_routes", self.routing_ms or 0.0)
+        return True
+
+    def speculate(self, question, config):
+        if not self.speculative or not question:
+            return None
+        self._purge()
+        return Speculation(question, asyncio.create_task(self.search(question, config)))
+
+    def observe_routing(self, elapsed_ms):
+        self.counters["llm_routes"] += 1
+        self.routing_ms = elapsed_ms if self.routing_ms is None else 0.8 * self.routing_ms + 0.2 * elapsed_ms
+
+    def resolve(self, speculation, tool_calls, tool_name, routing_ms):
+        """Hand the speculation to the matching retrieve call, or cancel it"""
+        if speculation is None:
+            return
+        for call in tool_calls or []:
+            args = call.get("args") or {}
+            # Solo llamadas sin filtros extra: la especulación corre con los del request
+            if call["name"] != tool_name or any(v is not None for key, v in args.items() if key != "query"):
+                continue
+            if query_similarity(args.get("query", ""), speculation.question) >= self.threshold:
+                self._pending[call["id"]] = speculation
+                # Ahorro: la parte de la búsqueda que corrió en paralelo con el ruteo
+                self._saved("speculative_hits", min(routing_ms, speculation.elapsed_ms()))
+                return
+        speculation.task.cancel()
+        self.counters["speculative_misses"] += 1
+
+    def take(self, tool_call_id):
+        """The speculative task bound to this tool call, or None"""
+        speculation = self._pending.pop(tool_call_id, None)
+        return speculation.task if speculation is not None else None
+
+    def _purge(self):
+        now = time.perf_counter()
+        for call_id, speculation in list(self._pending.items()):
+            if now - speculation.started > SPECULATION_TTL:
+                speculation.task.cancel()
+                self._pending.pop(call_id, None)
+
+    def stats(self):
+        return {"pending": len(self._pending), "routing_ms": self.routing_ms, **self.counters}
@@ -0,0 +1,251 @@
+from collections import OrderedDict
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from src.utils import to_langchain_messages, from_langchain_messages
+from src.models import HistoryEntry
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", 10000))
+# Vacío: sesiones solo en memoria. Con una ruta, se persisten en SQLite.
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "")
+
+
+class SessionTenantError(Exception):
+    """Raised when a session is used under a tenant other than the one that created it"""
+
+    def __init__(self, session_id):
+        super().__init__(f"Session {session_id} belongs to another tenant")
+        self.session_id = session_id
+
+
+def conversation_messages(messages):
+    """Messages worth keeping in the history: user, system and final assistant answers"""
+    return [
+        msg for msg in messages
+        if isinstance(msg, (HumanMessage, SystemMessage)) or (isinstance(msg, AIMessage) and not msg.tool_calls)
+    ]
+
+
+class Session:
+    """Server-side conversation of one tenant: history with per-message token counts, summary and document scope"""
+
+    def __init__(self, session_id, summary="", documents=None, tenant=None):
+        self.session_id = session_id
+        self.tenant = tenant
+        self.messages = []
+        self.token_counts = []
+        self.total_tokens = 0
+        self.summary = summary
+        self.documents = documents
+        self.updated_at = time.time()
+        # Cambia cada vez que se reemplaza o recorta el historial (no al agregar)
+        self.version = 0
+        # Un turno a la vez por sesión
+        self.lock = asyncio.Lock()
+
+    def append(self, messages, token_counts=None):
+        # Cada mensaje se cuenta una sola vez, al agregarlo
+        token_counts = token_counts or [count_tokens_approximately([msg]) for msg in messages]
+        self.messages.extend(messages)
+        self.token_counts.extend(token_counts)
+        self.total_tokens += sum(token_counts)
+        self.updated_at = time.time()
+
+    def replace(self, messages):
+        self.messages, self.token_counts, self.total_tokens = [], [], 0
+        self.append(messages)
+        self.version += 1
+
+    def trim(self, count):
+        """Drop the first `count` messages (already folded into the summary)"""
+        self.messages = self.messages[count:]
+        self.token_counts = self.token_counts[count:]
+        self.total_tokens = sum(self.token_counts)
+        self.version += 1
+
+    def scope(self):
+        """Active documents as retrieval filters, or None"""
+        return {"filenames": list(self.documents)} if self.documents is not None else None
+
+
+class SessionStore:
+    """In-memory LRU of sessions, optionally persisted to a local SQLite file.
+
+    With persistence, sessions evicted from memory are reloaded on demand;
+    without it they are simply dropped. A session belongs to the tenant that
+    created it: passing another `tenant` raises SessionTenantError.
+    """
+
+    def __init__(self, max_size=SESSION_MAX_SESSIONS, path=SESSION_DB_PATH, default_tenant=None):
+        self.max_size = max_size
+        self.path = path or None
+        # Tenant de las sesiones guardadas antes de que existieran los tenants
+        self.default_tenant = default_tenant
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if self.path:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY,"
+                " summary TEXT NOT NULL,"
+                " documents TEXT,"
+                " updated_at REAL NOT NULL,"
+                " tenant TEXT)"
+            )
+            # Migración de bases creadas antes de guardar el tenant de cada sesión
+            if "tenant" not in {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}:
+                self._conn.execute("ALTER TABLE sessions ADD COLUMN tenant TEXT")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " session_id TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " role TEXT NOT NULL,"
+                " content TEXT NOT NULL,"
+                " tokens INTEGER NOT NULL,"
+                " PRIMARY KEY (session_id, seq))"
+            )
+            self._conn.commit()
+
+    def _load(self, session_id):
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            "SELECT summary, documents, tenant FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        session = Session(session_id, summary=row[0], documents=json.loads(row[1]) if row[1] else None,
+                          tenant=row[2] or self.default_tenant)
+        rows = self._conn.execute(
+            "SELECT role, content, tokens FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+        ).fetchall()
+        entries = [HistoryEntry(role=role, content=content) for role, content, _ in rows]
+        session.append(to_langchain_messages(entries), [tokens for _, _, tokens in rows])
+        return session
+
+    def _remember(self, session):
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def get(self, session_id, create=True, tenant=None):
+        """Session `session_id` (created for `tenant` if missing and `create`). With a `tenant`,
+        raises SessionTenantError if the session belongs to another one."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._load(session_id)
+                if session is None:
+                    if not create:
+                        return None
+                    session = Session(session_id, tenant=tenant or self.default_tenant)
+                    self._save_header(session)
+            if tenant is not None and session.tenant != tenant:
+                raise SessionTenantError(session_id)
+            self._remember(session)
+            return session
+
+    def _save_header(self, session):
+        if self._conn is None:
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, summary, documents, updated_at, tenant)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                session.session_id,
+                session.summary,
+                json.dumps(session.documents) if session.documents is not None else None,
+                session.updated_at,
+                session.tenant,
+            ),
+        )
+        self._conn.commit()
+
+    def commit_turn(self, session, final_messages, summary):
+        """Apply a finished turn to the session and return the new messages (the delta).
+
+        If the turn summarized the conversation the history is replaced by what the
+        graph kept; otherwise only the new messages are appended.
+        """
+        final_messages = conversation_messages(final_messages)
+        with self._lock:
+            if summary != session.summary:
+                session.summary = summary
+                session.replace(final_messages)
+                start = 0
+            else:
+                start = len(session.messages)
+                # Mensajes nuevos: lo que el grafo agregó después del historial previo
+                session.append(final_messages[start:])
+            # Delta: desde la última pregunta del usuario
+            last_question = max(
+                (i for i, msg in enumerate(session.messages) if isinstance(msg, HumanMessage)), default=0
+            )
+            delta = session.messages[last_question:]
+
+            self._save_messages(session, start)
+        return delta
+
+    def _save_messages(self, session, start):
+        """Persist session.messages[start:]; start == 0 rewrites the whole history"""
+        if self._conn is None:
+            return
+        if start == 0:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session.session_id,))
+        entries = from_langchain_messages(session.messages[start:])
+        self._conn.executemany(
+            "INSERT INTO messages (session_id, seq, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+            [
+                (session.session_id, start + i, entry.role.value, entry.content, tokens)
+                for i, (entry, tokens) in enumerate(zip(entries, session.token_counts[start:]))
+            ],
+        )
+        self._save_header(session)
+
+    def apply_summary(self, session, version, count, summary):
+        """Fold the first `count` messages into `summary`, computed from the history at `version`.
+
+        Returns False (and changes nothing) if the history was replaced in the
+        meantime or the session is no longer the live one.
+        """
+        with self._lock:
+            if session.version != version or self._sessions.get(session.session_id) is not session:
+                return False
+            session.summary = summary
+            session.trim(count)
+            self._save_messages(session, 0)
+        return True
+
+    def set_documents(self, session_id, filenames, tenant=None):
+        session = self.get(session_id, tenant=tenant)
+        with self._lock:
+            session.documents = list(filenames) if filenames is not None else None
+            self._save_header(session)
+        return session
+
+    def delete(self, session_id, tenant=None):
+        # Valida el tenant antes de borrar (una sesión inexistente no es un error)
+        self.get(session_id, create=False, tenant=tenant)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._conn.commit()
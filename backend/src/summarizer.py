@@ -0,0 +1,71 @@
+from src.agent import summarize_messages, MAX_TOKENS, SUMMARY_KEEP_LAST
+from src.metrics import span, detach
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class BackgroundSummarizer:
+    """Summarizes session histories after the response has been sent.
+
+    When a session goes over `max_tokens` a task folds the messages not yet
+    summarized into the running summary; the next turn picks it up. At most
+    one task runs per session, and a result computed from a history that was
+    replaced meanwhile (inline fallback) is discarded.
+    """
+
+    def __init__(self, sessions, max_tokens=None, keep_last=SUMMARY_KEEP_LAST):
+        self.sessions = sessions
+        self.max_tokens = int(max_tokens or MAX_TOKENS)
+        self.keep_last = keep_last
+        self._tasks = {}
+        self.counters = {"scheduled": 0, "applied": 0, "discarded": 0, "failed": 0}
+
+    def maybe_schedule(self, session):
+        """Start a background summary if the session is over budget. Never waits."""
+        session_id = session.session_id
+        if session.total_tokens <= self.max_tokens or session_id in self._tasks:
+            return False
+        if len(session.messages) <= self.keep_last:
+            return False
+
+        task = asyncio.create_task(self._run(session))
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session_id, None))
+        self.counters["scheduled"] += 1
+        return True
+
+    async def _run(self, session):
+        # Foto del historial: lo que llegue después queda para el próximo resumen
+        version = session.version
+        count = len(session.messages) - self.keep_last
+        pending = session.messages[:count]
+
+        # Corre después de la respuesta: no cuenta en el desglose del request que la lanzó
+        detach()
+        try:
+            with span("summarize", mode="background"):
+                summary = await summarize_messages(session.summary, pending)
+        except Exception as e:
+            self.counters["failed"] += 1
+            logger.error(f"Background summary failed for session {session.session_id}: {str(e)}")
+            return
+
+        # Aplicar entre turnos, nunca en medio de uno
+        async with session.lock:
+            applied = await asyncio.to_thread(self.sessions.apply_summary, session, version, count, summary)
+
+        self.counters["applied" if applied else "discarded"] += 1
+        if applied:
+            logger.info(f"Session {session.session_id}: summarized {count} messages in background")
+
+    def stats(self):
+        return {"running": len(self._tasks), **self.counters}
+
+    async def shutdown(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,430 @@
+from langchain_chroma import Chroma
+from langchain_core.vectorstores import VectorStore
+from langchain.schema import Document
+from chromadb.api.shared_system_client import SharedSystemClient
+from src.agent import make_search, make_retrieve_tool, get_graph
+from src.answer_cache import AnswerCache
+from src.docstore import SQLiteDocStore
+from src.documents import DocumentCatalog, DocumentManager, COMPACT_INTERVAL
+from src.lexical import BM25Index
+from src.pdf_parser import make_multivector_retriever
+from src.routing import Router
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import chromadb
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+CHROMA_PERSIST_DIR = os.environ.get("CHROMA_PERSIST_DIR", "./chroma_langchain_db")
+# Stores del tenant por defecto (mismas rutas que antes de haber tenants)
+DOCSTORE_PATH = os.environ.get("DOCSTORE_PATH", os.path.join(CHROMA_PERSIST_DIR, "docstore.sqlite"))
+LEXICAL_INDEX_PATH = os.environ.get("LEXICAL_INDEX_PATH", os.path.join(CHROMA_PERSIST_DIR, "lexical.sqlite"))
+DOCUMENTS_DB_PATH = os.environ.get("DOCUMENTS_DB_PATH", os.path.join(CHROMA_PERSIST_DIR, "documents.sqlite"))
+DEFAULT_COLLECTION = "multivector_chunks"
+
+# Cabecera que elige el tenant (en /predict y /upload_pdfs también vale el campo `tenant`)
+TENANT_HEADER = os.environ.get("TENANT_HEADER", "X-Tenant-ID")
+DEFAULT_TENANT = os.environ.get("DEFAULT_TENANT", "default")
+# Colecciones de Chroma, docstore, índice léxico y catálogo de cada tenant (un directorio por tenant)
+TENANTS_DIR = os.environ.get("TENANTS_DIR", os.path.join(CHROMA_PERSIST_DIR, "tenants"))
+# Tenants con sus stores abiertos a la vez; los inactivos se cierran por LRU
+TENANT_MAX_OPEN = int(os.environ.get("TENANT_MAX_OPEN", 32))
+# Colecciones de Chroma de cada tenant nuevo, consultadas en paralelo (se fija al crear el tenant)
+TENANT_SHARDS = int(os.environ.get("TENANT_SHARDS", 1))
+TENANT_SHARD_THREADS = int(os.environ.get("TENANT_SHARD_THREADS", 16))
+
+# Tenants que se crean solos al primer uso (separados por coma); el resto se crea con POST /tenants
+TENANT_ALLOWLIST = {name.strip() for name in os.environ.get("TENANT_ALLOWLIST", "").split(",") if name.strip()}
+# Máximo de tenants registrados
+TENANT_MAX_COUNT = int(os.environ.get("TENANT_MAX_COUNT", 1000))
+
+# Se usa en nombres de colecciones y directorios
+TENANT_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,39}$")
+
+
+def valid_tenant_id(tenant_id):
+    return bool(TENANT_ID_RE.match(tenant_id or ""))
+
+
+def shard_of(doc_id, shards):
+    """Shard holding `doc_id`: a stable hash, so every write and lookup of an id goes to the same one"""
+    return int.from_bytes(hashlib.blake2b(doc_id.encode(), digest_size=8).digest(), "little") % shards
+
+
+def close_client(client):
+    """Stop a Chroma client's system, releasing its collections and loaded HNSW segments.
+
+    Chroma keeps one system per path for the life of the process and has no public
+    way to drop it; after this a new PersistentClient on the same path reopens it
+    from disk. Relies on `SharedSystemClient` internals of the chromadb version
+    pinned in requirements.txt: if they are missing the client is left open (the
+    tenant's vectors stay in memory) and a warning is logged. Returns whether it
+    was stopped.
+    """
+    systems = getattr(SharedSystemClient, "_identifier_to_system", None)
+    identifier = getattr(client, "_identifier", None)
+    if not isinstance(systems, dict) or identifier is None:
+        logger.warning(f"Can't release the Chroma client with chromadb {chromadb.__version__}: its vectors stay loaded")
+        return False
+    system = systems.pop(identifier, None)
+    if system is not None:
+        system.stop()
+    return True
+
+
+def merge_results(parts, include=None):
+    """Concatenate Chroma get() results from several collections"""
+    # Sin partes (tenant vacío) igual devuelve las claves pedidas
+    merged = {"ids": [], **{key: [] for key in include or ("metadatas", "documents")}}
+    for part in parts:
+        for key, value in part.items():
+            if key == "included":
+                merged[key] = value
+            elif value is None:
+                merged.setdefault(key, None)
+            else:
+                merged[key] = (merged.get(key) or []) + list(value)
+    return merged
+
+
+class ShardedCollection:
+    """The raw-collection calls the app makes (counts), routed to each shard"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def count(self):
+        return sum(shard._collection.count() for shard in self.store.shards)
+
+
+class ShardedVectorStore(VectorStore):
+    """A tenant's vectors split by doc_id hash across several Chroma collections.
+
+    Implements the part of the Chroma vectorstore API the app uses. Similarity
+    searches run on every shard in parallel and the hits are merged by distance,
+    so the result is the same as searching one collection with all the vectors.
+    """
+
+    def __init__(self, shards, executor):
+        self.shards = shards
+        self._executor = executor
+        self._collection = ShardedCollection(self)
+
+    @property
+    def embeddings(self):
+        return self.shards[0].embeddings
+
+    def split(self, ids):
+        """{shard: [ids]}"""
+        groups = {}
+        for doc_id in ids:
+            groups.setdefault(shard_of(doc_id, len(self.shards)), []).append(doc_id)
+        return groups
+
+    @classmethod
+    def from_collections(cls, client, names, embedding, executor):
+        """Sharded store over the Chroma collections `names` of `client` (created if missing)"""
+        return cls([Chroma(collection_name=name, embedding_function=embedding, client=client) for name in names],
+                   executor)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, *, client=None, collection_names=None, shards=2,
+                   executor=None, ids=None, **kwargs):
+        """Sharded store over `collection_names` (default `shard_0`...) of a Chroma `client`, with `texts` added"""
+        client = client or chromadb.EphemeralClient()
+        names = collection_names or [f"shard_{shard}" for shard in range(shards)]
+        store = cls.from_collections(client, names, embedding, executor or ThreadPoolExecutor(TENANT_SHARD_THREADS))
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def add_texts(self, texts, metadatas=None, *, ids=None, **kwargs):
+        metadatas = metadatas or [{} for _ in texts]
+        return self.add_documents(
+            [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)], ids=ids
+        )
+
+    def add_documents(self, documents, ids=None, **kwargs):
+        # El shard sale del id: sin ids se generan como en Chroma
+        ids = ids or [getattr(doc, "id", None) or str(uuid.uuid4()) for doc in documents]
+        groups = {}
+        for doc, doc_id in zip(documents, ids):
+            docs, doc_ids = groups.setdefault(shard_of(doc_id, len(self.shards)), ([], []))
+            docs.append(doc)
+            doc_ids.append(doc_id)
+        list(self._executor.map(
+            lambda item: self.shards[item[0]].add_documents(item[1][0], ids=item[1][1]), groups.items()
+        ))
+        return list(ids)
+
+    def get(self, ids=None, include=None, limit=None, offset=None):
+        if ids is not None:
+            return merge_results(self._executor.map(
+                lambda item: self.shards[item[0]].get(ids=item[1], include=include), self.split(ids).items()
+            ), include)
+
+        # Paginado sobre las colecciones una detrás de otra
+        parts, skip, remaining = [], offset or 0, limit
+        for shard in self.shards:
+            if remaining is not None and remaining <= 0:
+                break
+            size = shard._collection.count()
+            if skip >= size:
+                skip -= size
+                continue
+            part = shard.get(include=include, limit=remaining, offset=skip)
+            skip = 0
+            if remaining is not None:
+                remaining -= len(part["ids"])
+            parts.append(part)
+        return merge_results(parts, include)
+
+    def update_documents(self, ids, documents):
+        by_id = dict(zip(ids, documents))
+        for shard, doc_ids in self.split(ids).items():
+            self.shards[shard].update_documents(doc_ids, [by_id[doc_id] for doc_id in doc_ids])
+
+    def delete(self, ids=None, **kwargs):
+        for shard, doc_ids in self.split(ids).items():
+            self.shards[shard].delete(ids=doc_ids)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        hits = self._executor.map(
+            lambda shard: shard.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=filter),
+            self.shards,
+        )
+        # Los scores son distancias (menor = más parecido), comparables entre colecciones
+        merged = sorted((hit for shard_hits in hits for hit in shard_hits), key=lambda hit: hit[1])
+        return [doc for doc, _ in merged[:k]]
+
+
+class UnknownTenantError(Exception):
+    """Raised when a tenant that was never created is requested"""
+
+    def __init__(self, tenant_id):
+        super().__init__(f"Unknown tenant {tenant_id}")
+        self.tenant_id = tenant_id
+
+
+class TenantLimitError(Exception):
+    """Raised when creating a tenant would go over TENANT_MAX_COUNT"""
+
+    def __init__(self, limit):
+        super().__init__(f"Tenant limit reached ({limit})")
+        self.limit = limit
+
+
+class Tenant:
+    """Everything that reads or writes one tenant's corpus: its Chroma client and
+    vectorstore, docstore, lexical index and document catalog, plus the router,
+    agent graph and answer cache built on them. `in_use` counts the requests and
+    jobs holding it."""
+
+    def __init__(self, tenant_id, client, vectorstore, docstore_path, lexical_path, documents_path):
+        self.tenant_id = tenant_id
+        self.client = client
+        self.vectorstore = vectorstore
+        self.docstore = SQLiteDocStore(docstore_path)
+        self.retriever = make_multivector_retriever(vectorstore, self.docstore)
+        self.lexical_index = BM25Index(lexical_path)
+
+        self.router = Router(make_search(self.retriever, self.lexical_index))
+        self.graph = get_graph(make_retrieve_tool(self.router), self.router, self.retriever)
+        self.answer_cache = AnswerCache(self.router.search, vectorstore.embeddings)
+
+        self.catalog = DocumentCatalog(documents_path)
+        self.catalog.backfill(vectorstore)
+        # Cualquier cambio en los chunks guardados invalida la caché de respuestas
+        self.documents = DocumentManager(
+            self.retriever, self.lexical_index, self.catalog, on_changed=self.answer_cache.clear
+        )
+        self.in_use = 0
+
+    def close(self):
+        self.docstore.close()
+        self.lexical_index.close()
+        self.catalog.close()
+        # Sin esto Chroma mantiene cargados los segmentos HNSW del tenant aunque se lo desaloje
+        close_client(self.client)
+
+
+class TenantRegistry:
+    """Opens tenants on demand and keeps at most `max_open` of them open (LRU).
+
+    Only registered tenants are opened: the default one and those in `allowlist`
+    are registered on first use, any other must be created with create() first.
+
+    Every tenant gets its own directory with a Chroma database (one collection
+    per shard) and its SQLite stores, opened with its own client so that
+    closing a tenant frees its vectors too; the default tenant keeps the paths
+    and collection used before tenants existed. The shard count is fixed when a tenant is first created and
+    recorded in `tenants.sqlite`. Tenants held by a request or an ingestion job
+    are never evicted.
+    """
+
+    def __init__(self, embeddings, persist_dir=CHROMA_PERSIST_DIR, tenants_dir=TENANTS_DIR,
+                 max_open=TENANT_MAX_OPEN, shards=TENANT_SHARDS, allowlist=TENANT_ALLOWLIST,
+                 max_count=TENANT_MAX_COUNT):
+        os.makedirs(tenants_dir, exist_ok=True)
+        self.embeddings = embeddings
+        self.persist_dir = persist_dir
+        self.tenants_dir = tenants_dir
+        self.max_open = max_open
+        self.shards = max(shards, 1)
+        self.allowlist = {DEFAULT_TENANT, *allowlist}
+        self.max_count = max_count
+        self._executor = ThreadPoolExecutor(max_workers=TENANT_SHARD_THREADS, thread_name_prefix="shard")
+        self._open = OrderedDict()
+        # tenant_id -> apertura en curso
+        self._opening = {}
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(tenants_dir, "tenants.sqlite"), timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tenants ("
+            " tenant_id TEXT PRIMARY KEY,"
+            " shards INTEGER NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.counters = {"opened": 0, "reused": 0, "evicted": 0}
+
+    def _register(self, tenant_id, create=False):
+        """Shard count of a tenant. Unknown tenants are created only with `create` or when allowlisted."""
+        with self._db_lock:
+            row = self._conn.execute("SELECT shards FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            if row:
+                return row[0]
+            if not create and tenant_id not in self.allowlist:
+                raise UnknownTenantError(tenant_id)
+            if self._conn.execute("SELECT COUNT(*) FROM tenants").fetchone()[0] >= self.max_count:
+                raise TenantLimitError(self.max_count)
+            shards = 1 if tenant_id == DEFAULT_TENANT else self.shards
+            self._conn.execute(
+                "INSERT INTO tenants (tenant_id, shards, created_at) VALUES (?, ?, ?)", (tenant_id, shards, time.time())
+            )
+            self._conn.commit()
+        logger.info(f"Created tenant {tenant_id} ({shards} shards)")
+        return shards
+
+    def create(self, tenant_id):
+        """Register a tenant (no-op if it exists). Its stores are created when it is first opened."""
+        return {"tenant": tenant_id, "shards": self._register(tenant_id, create=True)}
+
+    def _load(self, tenant_id):
+        shards = self._register(tenant_id)
+        if tenant_id == DEFAULT_TENANT:
+            directory = self.persist_dir
+            paths = (DOCSTORE_PATH, LEXICAL_INDEX_PATH, DOCUMENTS_DB_PATH)
+            names = [DEFAULT_COLLECTION]
+        else:
+            directory = os.path.join(self.tenants_dir, tenant_id)
+            paths = tuple(os.path.join(directory, name) for name in ("docstore.sqlite", "lexical.sqlite", "documents.sqlite"))
+            names = [f"tenant_{tenant_id}_{shard}" for shard in range(shards)]
+
+        client = chromadb.PersistentClient(path=directory)
+        try:
+            if len(names) == 1:
+                vectorstore = Chroma(collection_name=names[0], embedding_function=self.embeddings, client=client)
+            else:
+                vectorstore = ShardedVectorStore.from_collections(client, names, self.embeddings, self._executor)
+            tenant = Tenant(tenant_id, client, vectorstore, *paths)
+        except Exception:
+            close_client(client)
+            raise
+        logger.info(f"Opened tenant {tenant_id} ({shards} shards, {tenant.lexical_index.doc_count} indexed chunks)")
+        return tenant
+
+    async def acquire(self, tenant_id):
+        """Open (or reuse) a tenant and hold it until release()"""
+        # Todo lo que toca los dicts corre en el event loop sin awaits de por medio: no hace falta lock
+        while True:
+            tenant = self._open.get(tenant_id)
+            if tenant is not None:
+                self.counters["reused"] += 1
+                break
+            # Un tenant frío se abre en un hilo: los pedidos al mismo tenant esperan esa apertura,
+            # los de los demás tenants siguen sin esperar
+            opening = self._opening.get(tenant_id)
+            if opening is None:
+                opening = self._opening[tenant_id] = asyncio.ensure_future(asyncio.to_thread(self._load, tenant_id))
+            try:
+                loaded = await asyncio.shield(opening)
+            except BaseException:
+                if opening.done() and self._opening.get(tenant_id) is opening:
+                    del self._opening[tenant_id]
+                raise
+            if self._opening.get(tenant_id) is opening:
+                # El primero en volver lo registra; el resto lo encuentra abierto al volver a mirar
+                del self._opening[tenant_id]
+                self._open[tenant_id] = tenant = loaded
+                self.counters["opened"] += 1
+                break
+        self._open.move_to_end(tenant_id)
+        tenant.in_use += 1
+        self._evict()
+        return tenant
+
+    def release(self, tenant):
+        tenant.in_use -= 1
+        self._evict()
+
+    @asynccontextmanager
+    async def use(self, tenant_id):
+        tenant = await self.acquire(tenant_id)
+        try:
+            yield tenant
+        finally:
+            self.release(tenant)
+
+    def _evict(self):
+        # Del menos usado recientemente al más reciente, salteando los que están en uso
+        idle = [tenant for tenant in self._open.values() if tenant.in_use == 0]
+        while len(self._open) > self.max_open and idle:
+            tenant = idle.pop(0)
+            del self._open[tenant.tenant_id]
+            tenant.close()
+            self.counters["evicted"] += 1
+            logger.info(f"Closed idle tenant {tenant.tenant_id}")
+
+    async def compact_periodically(self, interval=COMPACT_INTERVAL):
+        """Background loop: compact the open tenants with deletions, at most once per `interval` seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            for tenant in [t for t in self._open.values() if t.documents.deleted_since_compaction]:
+                tenant.in_use += 1
+                try:
+                    await asyncio.to_thread(tenant.documents.compact)
+                except Exception as e:
+                    logger.error(f"Compaction of tenant {tenant.tenant_id} failed: {str(e)}")
+                finally:
+                    self.release(tenant)
+
+    def stats(self):
+        with self._db_lock:
+            registered = self._conn.execute("SELECT COUNT(*) FROM tenants").fetchone()[0]
+        return {
+            "registered": registered,
+            "open": len(self._open),
+            "max_open": self.max_open,
+            "in_use": sum(1 for tenant in self._open.values() if tenant.in_use),
+            **self.counters,
+        }
+
+    def shutdown(self):
+        for tenant in self._open.values():
+            tenant.close()
+        self._open.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,5 +1,6 @@
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 from src.models import HistoryEntry, RoleEnum
+import json
 
 def to_langchain_messages(chat_history: list[HistoryEntry]):
     lc_messages = []
@@ -21,4 +22,8 @@ def from_langchain_messages(messages: list[BaseMessage]) -> list[HistoryEntry]:
             entries.append(HistoryEntry(role=RoleEnum.ai, content=msg.content))
         elif isinstance(msg, SystemMessage):
             entries.append(HistoryEntry(role=RoleEnum.system, content=msg.content))
-    return entries
\ No newline at end of file
+    return entries
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+# Modelos falsos (sin API key) y archivos en un directorio temporal: se fija antes de importar src
+_TMP_DIR = tempfile.mkdtemp(prefix="rag_tests_")
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("INGEST_CACHE_PATH", os.path.join(_TMP_DIR, "ingest_cache.sqlite"))
+os.environ.setdefault("CHROMA_PERSIST_DIR", os.path.join(_TMP_DIR, "chroma"))
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from langchain.schema import Document
+
+
+def make_chunks(tag, pages, per_page=2, filename="manual.pdf"):
+    """(children, parents) with deterministic ids, `per_page` chunks on each page"""
+    children = [
+        Document(
+            page_content=f"{tag} manual page {page} chunk {i} about valves",
+            metadata={"doc_id": f"{tag}-{page}-{i}", "page_number": page, "last_page": page,
+                      "filename": filename, "content_type": "text"},
+        )
+        for page in pages for i in range(per_page)
+    ]
+    parents = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in children]
+    return children, parents
+
+
+@pytest.fixture
+def embeddings():
+    from src.providers import get_embeddings
+    return get_embeddings()
@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from langchain.schema import Document
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.tools import tool
+
+from src.agent import make_retrieve_tool, make_tools_node, tool_error
+
+
+class FakeRouter:
+    """Search by query with an optional delay; no speculative retrievals"""
+
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.searches = []
+
+    def take(self, tool_call_id):
+        return None
+
+    async def search(self, query, config, tool_filters=None, query_vector=None):
+        self.searches.append((query, query_vector is not None))
+        await asyncio.sleep(self.delays.get(query, 0))
+        return [Document(page_content=f"{query} {i}", metadata={"doc_id": f"{query}-{i}"}) for i in range(2)]
+
+
+@tool
+async def slow_tool(seconds: float) -> str:
+    """Sleep and answer"""
+    await asyncio.sleep(seconds)
+    return "done"
+
+
+@pytest.fixture
+def tools_node(embeddings):
+    def build(router):
+        retriever = SimpleNamespace(vectorstore=SimpleNamespace(embeddings=embeddings))
+        retrieve = make_retrieve_tool(router)
+        return make_tools_node(retrieve, [retrieve, slow_tool], router, retriever)
+    return build
+
+
+def run(node, *calls):
+    state = {"messages": [AIMessage(content="", tool_calls=[
+        {"name": name, "args": args, "id": f"call_{i}"} for i, (name, args) in enumerate(calls)
+    ])]}
+    return asyncio.run(node(state, None))["messages"]
+
+
+def test_tool_error_message():
+    message = tool_error({"name": "retrieve", "id": "call_1"}, "boom")
+    assert isinstance(message, ToolMessage)
+    assert (message.status, message.tool_call_id, message.name) == ("error", "call_1", "retrieve")
+    assert message.content.startswith("Error: boom")
+
+
+def test_retrieve_calls_share_one_embedding_batch(tools_node):
+    router = FakeRouter()
+    messages = run(tools_node(router), ("retrieve", {"query": "valve"}), ("retrieve", {"query": "pump"}))
+
+    assert [msg.tool_call_id for msg in messages] == ["call_0", "call_1"]
+    assert [len(msg.artifact) for msg in messages] == [2, 2]
+    assert sorted(router.searches) == [("pump", True), ("valve", True)]
+
+
+def test_missing_query_fails_only_its_call(tools_node):
+    messages = run(tools_node(FakeRouter()), ("retrieve", {"filenames": ["a.pdf"]}), ("retrieve", {"query": "valve"}))
+
+    assert messages[0].status == "error" and "query" in messages[0].content
+    assert messages[1].status == "success" and len(messages[1].artifact) == 2
+
+
+def test_timeouts_and_unknown_tools_become_tool_errors(tools_node, monkeypatch):
+    monkeypatch.setattr("src.agent.TOOL_TIMEOUTS", {"retrieve": 0.05, "slow_tool": 0.05})
+    router = FakeRouter(delays={"slow": 1})
+    messages = run(
+        tools_node(router),
+        ("retrieve", {"query": "slow"}),
+        ("retrieve", {"query": "fast"}),
+        ("slow_tool", {"seconds": 1}),
+        ("missing_tool", {}),
+    )
+
+    assert [msg.status for msg in messages] == ["error", "success", "error", "error"]
+    assert "timed out" in messages[0].content and "timed out" in messages[2].content
+    assert "not a valid tool" in messages[3].content
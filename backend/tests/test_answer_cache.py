@@ -0,0 +1,92 @@
+import asyncio
+
+from langchain.schema import Document
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from src.answer_cache import AnswerCache, normalize_question, retrieved_doc_ids
+
+
+class FakeSearch:
+    """Stands in for the retrieve tool's search: returns the chunks in `doc_ids`"""
+
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self.calls = []
+
+    async def __call__(self, query, config, tool_filters=None, query_vector=None):
+        self.calls.append((query, query_vector is not None))
+        return [Document(page_content=doc_id, metadata={"doc_id": doc_id}) for doc_id in self.doc_ids]
+
+
+def ask(cache, question):
+    return asyncio.run(cache.lookup(question))
+
+
+def answer(cache, question, doc_ids):
+    entry, context = ask(cache, question)
+    assert entry is None
+    cache.store(question, context, f"answer to {question}", doc_ids)
+
+
+def test_normalize_question():
+    assert normalize_question("  ¿Cómo  cambio la VÁLVULA? ") == "como cambio la valvula"
+
+
+def test_only_candidates_are_validated(embeddings):
+    search = FakeSearch(["a", "b"])
+    cache = AnswerCache(search, embeddings)
+
+    entry, _ = ask(cache, "how do I replace the valve seal?")
+    assert entry is None and search.calls == []
+
+    answer(cache, "how do I replace the valve seal?", {"a"})
+    entry, _ = ask(cache, "How do I replace the valve seal")
+    assert entry.answer == "answer to how do I replace the valve seal?"
+    # La validación reutiliza el embedding de la pregunta
+    assert search.calls == [("How do I replace the valve seal", True)]
+    assert cache.stats()["hits"] == 1 and cache.stats()["validations"] == 1
+
+
+def test_hit_is_rejected_when_the_used_chunks_are_no_longer_retrieved(embeddings):
+    search = FakeSearch(["a", "b"])
+    cache = AnswerCache(search, embeddings)
+    answer(cache, "pump pressure limits", {"a", "b"})
+
+    search.doc_ids = ["a", "c", "d"]
+    entry, _ = ask(cache, "pump pressure limits")
+    assert entry is None and cache.stats()["misses"] == 2
+
+    # Chunks extra en la búsqueda no invalidan: alcanza con que estén los que usó la respuesta
+    search.doc_ids = ["c", "b", "a"]
+    entry, _ = ask(cache, "pump pressure limits")
+    assert entry is not None
+
+
+def test_answers_without_retrieved_chunks_are_not_stored(embeddings):
+    cache = AnswerCache(FakeSearch(["a"]), embeddings)
+    answer(cache, "hello there", set())
+    assert cache.stats()["size"] == 0
+
+
+def test_clear_and_expiry(embeddings):
+    cache = AnswerCache(FakeSearch(["a"]), embeddings, ttl=0)
+    answer(cache, "boiler startup", {"a"})
+    assert ask(cache, "boiler startup")[0] is None
+    assert cache.stats()["size"] == 0
+
+    cache.ttl = 60
+    answer(cache, "boiler startup", {"a"})
+    cache.clear()
+    assert cache.stats()["size"] == 0 and cache.stats()["invalidations"] == 1
+
+
+def test_retrieved_doc_ids_only_counts_the_last_turn():
+    def retrieve(doc_id, call_id):
+        return ToolMessage(content="", name="retrieve", tool_call_id=call_id,
+                           artifact=[Document(page_content="", metadata={"doc_id": doc_id})])
+
+    messages = [
+        HumanMessage(content="first"), retrieve("old", "1"), AIMessage(content="..."),
+        HumanMessage(content="second"), retrieve("a", "2"), retrieve("b", "3"), AIMessage(content="..."),
+    ]
+    assert retrieved_doc_ids(messages) == {"a", "b"}
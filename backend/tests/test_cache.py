@@ -0,0 +1,42 @@
+import sqlite3
+import time
+
+from src.cache import IngestionCache
+
+
+def test_limited_namespaces_evict_least_recently_used(tmp_path):
+    cache = IngestionCache(str(tmp_path / "cache.sqlite"), limits={"partitions": (250, 3600)})
+    for key in ("a", "b"):
+        cache.set("partitions", key, "x" * 100)
+    # Leer "a" lo vuelve el más reciente: el que se descarta al pasarse es "b"
+    time.sleep(0.01)
+    assert cache.get("partitions", "a") == "x" * 100
+    cache.set("partitions", "c", "x" * 100)
+
+    assert set(cache.get_many("partitions", ["a", "b", "c"])) == {"a", "c"}
+
+
+def test_expired_entries_are_pruned_and_other_namespaces_kept(tmp_path):
+    cache = IngestionCache(str(tmp_path / "cache.sqlite"), limits={"partitions": (10 ** 6, 0.01)})
+    cache.set("partitions", "old", [1, 2])
+    cache.set("image_descriptions", "old", "a pump")
+    time.sleep(0.02)
+    cache.set("partitions", "new", [3])
+
+    assert cache.get("partitions", "old") is None
+    assert cache.get("partitions", "new") == [3]
+    assert cache.get("image_descriptions", "old") == "a pump"
+
+
+def test_caches_without_size_columns_are_migrated(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                 " PRIMARY KEY (namespace, key))")
+    conn.execute("INSERT INTO cache VALUES ('partitions', 'digest', '[1]')")
+    conn.commit()
+    conn.close()
+
+    cache = IngestionCache(path, limits={"partitions": (10 ** 6, 3600)})
+    cache.set("partitions", "other", [2])
+    assert cache.get("partitions", "digest") == [1]
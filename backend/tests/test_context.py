@@ -0,0 +1,45 @@
+from langchain.schema import Document
+from langchain_core.messages import ToolMessage
+
+from src.context import compact_table_html, pack_context
+
+
+def chunk(doc_id, text, page=1, content_type="text"):
+    return Document(page_content=text, metadata={"doc_id": doc_id, "filename": "manual.pdf", "page_number": page,
+                                                 "content_type": content_type})
+
+
+def retrieve(call_id, *docs):
+    return ToolMessage(content="", name="retrieve", tool_call_id=call_id, artifact=list(docs))
+
+
+def test_same_page_chunks_merge_and_calls_interleave():
+    messages = [
+        retrieve("1", chunk("a", "valve seal", page=1), chunk("b", "pump motor", page=2)),
+        retrieve("2", chunk("c", "valve torque", page=1), chunk("a", "valve seal", page=1)),
+        ToolMessage(content="42", name="python_repl", tool_call_id="3"),
+    ]
+    context, usage = pack_context(messages, budget=1000)
+
+    assert context == ("[manual.pdf p.1 text]\nvalve seal\nvalve torque\n\n"
+                       "[manual.pdf p.2 text]\npump motor\n\n"
+                       "[python_repl output]\n42")
+    assert (usage["blocks"], usage["dropped"]) == (3, 0)
+
+
+def test_budget_cuts_the_last_block_and_drops_the_rest():
+    messages = [retrieve("1", *(chunk(str(page), "x" * 400, page=page) for page in range(1, 5)))]
+    context, usage = pack_context(messages, budget=250)
+
+    # Dos bloques enteros (107 tokens cada uno); lo que queda no alcanza para recortar el tercero
+    assert usage["tokens"] <= 250
+    assert (usage["blocks"], usage["dropped"]) == (2, 2)
+    # Con más lugar el tercero entra recortado
+    context, usage = pack_context(messages, budget=290)
+    assert (usage["blocks"], usage["dropped"]) == (3, 1)
+    assert context.endswith("…") and usage["tokens"] <= 290
+
+
+def test_tables_are_compacted():
+    html = "<table><tr><th>Part</th><th>Torque</th></tr><tr><td>Valve</td><td>12 &amp; 14 Nm</td></tr></table>"
+    assert compact_table_html(html) == "Part | Torque\nValve | 12 & 14 Nm"
@@ -0,0 +1,185 @@
+import asyncio
+from types import SimpleNamespace
+
+import chromadb
+import pytest
+from langchain_chroma import Chroma
+
+from conftest import make_chunks
+from src.docstore import SQLiteDocStore
+from src.documents import AmbiguousDocumentError, DocumentCatalog, DocumentManager, diff_pages
+from src.lexical import BM25Index
+from src.pdf_parser import chunks_to_documents, make_multivector_retriever
+
+
+@pytest.fixture
+def manager(tmp_path, embeddings):
+    client = chromadb.PersistentClient(path=str(tmp_path / "chroma"))
+    vectorstore = Chroma(collection_name="test_chunks", embedding_function=embeddings, client=client)
+    retriever = make_multivector_retriever(vectorstore, SQLiteDocStore(str(tmp_path / "docstore.sqlite")))
+    catalog = DocumentCatalog(str(tmp_path / "documents.sqlite"))
+    changes = []
+    manager = DocumentManager(
+        retriever, BM25Index(str(tmp_path / "lexical.sqlite")), catalog, on_changed=lambda: changes.append(1)
+    )
+    manager.changes = changes
+    return manager
+
+
+def version(document_id, pages, keep=None, changed=None):
+    keep = keep or {}
+    return {"document_id": document_id, "hashes": [f"h{page}" for page in range(1, pages + 1)],
+            "keep": keep, "changed": changed if changed is not None else list(range(1, pages + 1))}
+
+
+def stored_ids(manager):
+    return set(manager.retriever.vectorstore.get(include=[])["ids"])
+
+
+def test_apply_stores_a_new_document(manager):
+    children, parents = make_chunks("v1", range(1, 4))
+    report = manager.apply("manual.pdf", children, parents, version("d1", 3))
+
+    assert report["chunks_added"] == 6 and report["chunks_removed"] == 0
+    assert stored_ids(manager) == {doc.metadata["doc_id"] for doc in children}
+    assert manager.lexical_index.doc_count == 6
+    [document] = manager.catalog.list()
+    assert (document["filename"], document["document_id"], document["chunks"]) == ("manual.pdf", "d1", 6)
+    assert manager.changes
+
+
+def test_upsert_keeps_unchanged_pages_and_relabels_moved_ones(manager):
+    manager.apply("manual.pdf", *make_chunks("v1", range(1, 4)), version("d1", 3))
+    # v2: página nueva al principio y la vieja página 2 modificada
+    keep = {1: 2, 3: 4}
+    children, parents = make_chunks("v2", [1, 3])
+    report = manager.apply("manual.pdf", children, parents, version("d2", 4, keep=keep, changed=[1, 3]))
+
+    assert report["kept"] == 2 and report["moved"] == 2
+    assert report["chunks_added"] == 4 and report["chunks_removed"] == 2
+    assert stored_ids(manager) == {"v1-1-0", "v1-1-1", "v1-3-0", "v1-3-1", "v2-1-0", "v2-1-1", "v2-3-0", "v2-3-1"}
+    moved = manager.retriever.vectorstore.get(ids=["v1-3-0"], include=["metadatas"])["metadatas"][0]
+    assert (moved["page_number"], moved["last_page"]) == (4, 4)
+    assert manager.retriever.docstore.mget(["v1-1-0"])[0].metadata["page_number"] == 2
+    assert dict(manager.catalog.chunks("manual.pdf"))["v1-3-1"] == 4
+
+
+def test_moved_tables_get_their_page_prefix_rewritten(manager):
+    children, parents = make_chunks("v1", [2], per_page=1)
+    children[0].page_content = "Table from page 2. Table Summary: pressure limits"
+    parents[0].page_content = "Table from page 2:\n<table><tr><td>PN16</td></tr></table>"
+    for doc in children + parents:
+        doc.metadata["content_type"] = "table"
+    manager.apply("manual.pdf", children, parents, version("d1", 2, changed=[1, 2]))
+
+    # v2: una página nueva al principio corre la tabla a la página 3
+    manager.apply("manual.pdf", [], [], version("d2", 3, keep={2: 3}, changed=[1]))
+
+    child = manager.retriever.vectorstore.get(ids=["v1-2-0"], include=["documents", "metadatas"])
+    assert child["documents"][0] == "Table from page 3. Table Summary: pressure limits"
+    assert child["metadatas"][0]["page_number"] == 3
+    parent = manager.retriever.docstore.mget(["v1-2-0"])[0]
+    assert parent.page_content.startswith("Table from page 3:\n")
+    assert [doc_id for doc_id, _ in manager.lexical_index.search("PN16", filters={"page_from": 3})] == ["v1-2-0"]
+
+
+def test_document_locks_are_dropped_when_released(manager):
+    order = []
+
+    async def write(name):
+        async with manager.lock("manual.pdf"):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    async def scenario():
+        first = asyncio.create_task(write("first"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(write("second"))
+        await asyncio.sleep(0)
+        # Uno adentro y otro esperando comparten el mismo lock
+        assert manager._locks["manual.pdf"][1] == 2
+        await asyncio.gather(first, second)
+
+    asyncio.run(scenario())
+    assert order == ["first start", "first end", "second start", "second end"]
+    assert manager._locks == {}
+
+
+def test_document_id_shared_by_two_filenames_is_ambiguous(manager):
+    manager.apply("a.pdf", *make_chunks("a", [1], filename="a.pdf"), version("same", 1))
+    manager.apply("b.pdf", *make_chunks("b", [1], filename="b.pdf"), version("same", 1))
+
+    assert manager.catalog.resolve(filename="a.pdf") == "a.pdf"
+    with pytest.raises(AmbiguousDocumentError) as error:
+        manager.catalog.resolve(document_id="same")
+    assert error.value.filenames == ["a.pdf", "b.pdf"]
+
+
+def test_delete_removes_every_store(manager):
+    manager.apply("manual.pdf", *make_chunks("v1", range(1, 3)), version("d1", 2))
+    manager.apply("other.pdf", *make_chunks("o1", [1], filename="other.pdf"), version("o1", 1))
+
+    assert manager.delete(manager.catalog.resolve(document_id="d1")) == 4
+    assert stored_ids(manager) == {"o1-1-0", "o1-1-1"}
+    assert manager.lexical_index.doc_count == 2
+    assert manager.retriever.docstore.mget(["v1-1-0"]) == [None]
+    assert [doc["filename"] for doc in manager.catalog.list()] == ["other.pdf"]
+
+
+def test_failed_commit_rolls_back_to_the_previous_version(manager):
+    manager.apply("manual.pdf", *make_chunks("v1", range(1, 3)), version("d1", 2))
+    before = stored_ids(manager)
+
+    with pytest.raises(KeyError):
+        # Sin "keep": commit() falla después de escribir los chunks nuevos
+        manager.apply("manual.pdf", *make_chunks("v2", range(1, 3)), {"document_id": "d2", "hashes": []})
+
+    assert stored_ids(manager) == before
+    assert manager.lexical_index.doc_count == len(before)
+    assert {doc_id for doc_id, _ in manager.catalog.chunks("manual.pdf")} == before
+    assert manager.catalog.list()[0]["document_id"] == "d1"
+
+
+def test_rollback_of_a_partial_window_stream(manager):
+    manager.apply("manual.pdf", *make_chunks("v1", range(1, 3)), version("d1", 2))
+    writer = manager.writer("manual.pdf")
+    writer.write(*make_chunks("v2", [1]))
+    writer.write(*make_chunks("v2", [2]))
+    writer.rollback()
+
+    assert stored_ids(manager) == {"v1-1-0", "v1-1-1", "v1-2-0", "v1-2-1"}
+
+
+def test_compact_reports_only_owned_stores(manager):
+    manager.apply("manual.pdf", *make_chunks("v1", range(1, 20)), version("d1", 19))
+    manager.delete("manual.pdf")
+    result = manager.compact()
+
+    assert result["bytes_reclaimed"] == result["bytes_before"] - result["bytes_after"] >= 0
+    assert manager.deleted_since_compaction == 0
+
+
+def test_diff_pages_matches_by_hash_and_widens_multipage_chunks():
+    old = {page: f"h{page}" for page in range(1, 7)}
+    new = ["h1", "h2", "changed", "h4", "h5", "h6"]
+
+    assert diff_pages(old, new) == ({1: 1, 2: 2, 4: 4, 5: 5, 6: 6}, [3])
+    # El chunk de las páginas 2-3 tiene texto viejo: la página 2 se vuelve a procesar
+    assert diff_pages(old, new, [(2, 3), (5, 6)]) == ({1: 1, 4: 4, 5: 5, 6: 6}, [2, 3])
+    # Un chunk cuyas páginas dejan de ser contiguas también se rearma
+    inserted = ["h1", "h2", "new", "h3", "h4", "h5", "h6"]
+    assert diff_pages(old, inserted, [(2, 3)]) == ({1: 1, 4: 5, 5: 6, 6: 7}, [2, 3, 4])
+
+
+def test_same_pdf_under_two_filenames_gets_separate_chunk_ids():
+    def chunks(filename):
+        metadata = SimpleNamespace(content_type="Text", page_number=1, filename=filename)
+        return [SimpleNamespace(text="same text", metadata=metadata)]
+
+    first, _ = chunks_to_documents(chunks("a.pdf"), "digest")
+    second, _ = chunks_to_documents(chunks("b.pdf"), "digest")
+    again, _ = chunks_to_documents(chunks("a.pdf"), "digest")
+
+    assert first[0].metadata["doc_id"] != second[0].metadata["doc_id"]
+    assert first[0].metadata["doc_id"] == again[0].metadata["doc_id"]
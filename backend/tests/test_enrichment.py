@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import pytest
+
+from src.enrichment import AdaptiveLimiter, TokenBucket
+
+
+def test_token_bucket_allows_a_burst_then_paces():
+    async def scenario():
+        bucket = TokenBucket(rate=50, capacity=3)
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(2):
+            await bucket.acquire()
+        return burst, time.monotonic() - started
+
+    burst, total = asyncio.run(scenario())
+    # La ráfaga no espera; los dos siguientes esperan ~1/50 s cada uno
+    assert burst < 0.01 and total >= 0.035
+
+
+def test_token_bucket_drain_drops_the_burst():
+    async def scenario():
+        bucket = TokenBucket(rate=50, capacity=10)
+        bucket.drain()
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.015
+
+
+def test_limiter_grows_additively_and_halves_once_per_burst_of_429s():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=8)
+        # Una ventana de éxitos (tantos como el límite) suma 1
+        for _ in range(4):
+            await limiter.release(await limiter.acquire())
+        grown = limiter.limit
+
+        # Dos requests que arrancaron antes del primer 429 bajan el límite una sola vez
+        first, second = await limiter.acquire(), await limiter.acquire()
+        await limiter.release(first, rate_limited=True)
+        await limiter.release(second, rate_limited=True)
+        halved = limiter.limit
+
+        later = await limiter.acquire()
+        await limiter.release(later, rate_limited=True)
+        return grown, halved, limiter.limit, limiter.active
+
+    grown, halved, again, active = asyncio.run(scenario())
+    assert grown == pytest.approx(5, abs=0.1)
+    assert halved == pytest.approx(grown / 2)
+    assert again == pytest.approx(grown / 4) and active == 0
+
+
+def test_limiter_caps_concurrency_and_pauses_after_429():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=2)
+        held = [await limiter.acquire(), await limiter.acquire()]
+        third = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        blocked = not third.done()
+
+        # El 429 baja el límite a 1 y pausa a todos: el tercero espera la pausa y a que se libere un lugar
+        paused_at = time.monotonic()
+        await limiter.release(held[0], rate_limited=True, pause=0.05)
+        limit = int(limiter.limit)
+        await limiter.release(held[1])
+        await third
+        return blocked, time.monotonic() - paused_at, limit
+
+    blocked, waited, limit = asyncio.run(scenario())
+    assert blocked and waited >= 0.05 and limit == 1
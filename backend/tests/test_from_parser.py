@@ -0,0 +1,82 @@
+import asyncio
+
+import fitz
+
+from src import from_parser
+from src.from_parser import aextraer_formulario, analizar_pdf, normalizar_etiqueta, normalizar_fecha
+
+
+def form_pdf(widgets=(), lines=()):
+    """PDF bytes with AcroForm text fields {name: value} and plain text lines"""
+    doc = fitz.open()
+    page = doc.new_page()
+    for i, (name, value) in enumerate(dict(widgets).items()):
+        widget = fitz.Widget()
+        widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+        widget.field_name = name
+        widget.field_value = value
+        widget.rect = fitz.Rect(300, 50 + 30 * i, 500, 70 + 30 * i)
+        page.add_widget(widget)
+    for i, line in enumerate(lines):
+        page.insert_text((50, 400 + 20 * i), line)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+class FakeChain:
+    def __init__(self, output):
+        self.output = output
+        self.requests = []
+
+    async def ainvoke(self, inputs):
+        self.requests.append(inputs["campos"])
+        return self.output
+
+
+def extract(pdf, chain, monkeypatch):
+    monkeypatch.setattr(from_parser, "get_extraction_chain", lambda: chain)
+    return asyncio.run(aextraer_formulario(pdf))
+
+
+def test_labels_and_dates_are_normalized():
+    assert normalizar_etiqueta("txtFechaNacimiento") == "fecha nacimiento"
+    assert normalizar_etiqueta("Teléfono 2") == "telefono"
+    assert normalizar_fecha("07/03/1990") == "1990-03-07"
+    assert normalizar_fecha("1990.3.7") == "1990-03-07"
+    assert normalizar_fecha("31/02/1990") is None and normalizar_fecha("marzo 1990") is None
+
+
+def test_acroform_fields_win_over_text():
+    pdf = form_pdf({"txtNombre": "Ana", "fld_apellidos": "Pérez"}, ["Nombre: Otra", "Teléfono: 555-1234"])
+    campos, fuentes, _ = analizar_pdf(pdf)
+
+    assert (campos["nombre"], fuentes["nombre"]) == ("Ana", "acroform")
+    assert (campos["apellidos"], fuentes["apellidos"]) == ("Pérez", "acroform")
+    assert (campos["telefono"], fuentes["telefono"]) == ("555-1234", "clave_valor")
+
+
+def test_llm_is_asked_only_for_missing_fields(monkeypatch):
+    pdf = form_pdf({"Name": "Ana"}, [
+        "Apellidos: Pérez", "Fecha de nacimiento: 07/03/1990", "Domicilio: Calle 1", "Tel: 555-1234",
+    ])
+    chain = FakeChain({})
+    data, fuentes = extract(pdf, chain, monkeypatch)
+
+    assert chain.requests == []
+    assert data == {"nombre": "Ana", "apellidos": "Pérez", "fecha_nacimiento": "1990-03-07",
+                    "direccion": "Calle 1", "telefono": "555-1234"}
+    assert fuentes["nombre"] == "acroform" and fuentes["telefono"] == "clave_valor"
+
+
+def test_llm_fills_what_the_other_tiers_missed(monkeypatch):
+    # La fecha no se reconoce como fecha: queda para el LLM, igual que la dirección
+    pdf = form_pdf(lines=["Nombre: Ana", "Apellidos: Pérez", "Nacimiento: siete de marzo de 1990",
+                          "Tel: 555-1234", "Vive en la Calle 1"])
+    chain = FakeChain({"fecha_nacimiento": "1990-03-07", "direccion": None, "nombre": "ignorado"})
+    data, fuentes = extract(pdf, chain, monkeypatch)
+
+    assert chain.requests == ["fecha_nacimiento, direccion"]
+    assert (data["nombre"], fuentes["nombre"]) == ("Ana", "clave_valor")
+    assert (data["fecha_nacimiento"], fuentes["fecha_nacimiento"]) == ("1990-03-07", "llm")
+    assert (data["direccion"], fuentes["direccion"]) == (None, None)
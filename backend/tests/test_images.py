@@ -0,0 +1,83 @@
+import base64
+import io
+import random
+from types import SimpleNamespace
+
+from PIL import Image
+
+from src.cache import IngestionCache
+from src.enrichment import EnrichmentScheduler
+from src.images import ImageIndex, dhash, decode, plan_images
+from src.pdf_parser import enhance_chunks_with_summaries
+
+
+def noise(size, seed):
+    rng = random.Random(seed)
+    image = Image.new("L", (16, 16))
+    image.putdata([rng.randrange(256) for _ in range(16 * 16)])
+    return image.resize(size, Image.NEAREST)
+
+
+def encode(image, fmt="PNG"):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+DIAGRAM = noise((256, 256), seed=1)
+DIAGRAM_SMALL = encode(DIAGRAM.resize((128, 128), Image.LANCZOS), "JPEG")
+OTHER = encode(noise((200, 200), seed=2))
+ICON = encode(noise((20, 20), seed=3))
+FLAT = encode(Image.new("L", (300, 100), 255))
+
+
+def test_plan_filters_decorative_images_and_groups_duplicates():
+    plan = plan_images([encode(DIAGRAM), ICON, DIAGRAM_SMALL, FLAT, OTHER, "not an image"])
+
+    assert plan.skipped == {1: "small", 3: "low_entropy"}
+    # La copia reducida cae en el grupo del original, que se describe con la versión grande
+    assert plan.groups == [0, None, 0, None, 1, 2]
+    assert decode(plan.payloads[0]).size == (256, 256)
+    assert plan.payloads[2] == "not an image"
+    report = plan.report()
+    assert (report["vision_calls"], report["duplicates"], report["vision_calls_saved"]) == (3, 1, 3)
+
+
+def test_index_reuses_descriptions_from_earlier_windows():
+    index = ImageIndex()
+    first = plan_images([encode(DIAGRAM)], index=index)
+    index.add(first, ["a wiring diagram"])
+
+    second = plan_images([DIAGRAM_SMALL, OTHER], index=index)
+    assert second.reused == {0: "a wiring diagram"}
+    assert second.groups == [None, 0] and len(second.payloads) == 1
+    assert second.report()["duplicates_of_earlier_pages"] == 1
+    assert index.find(dhash(noise((64, 64), seed=2))) is None
+
+
+def test_windows_of_one_document_describe_each_image_once(tmp_path):
+    class VisionChain:
+        calls = 0
+
+        async def ainvoke(self, payload):
+            VisionChain.calls += 1
+            return f"description {VisionChain.calls}"
+
+    def image_chunk(payload):
+        return SimpleNamespace(text="Image from page 1", metadata=SimpleNamespace(content_type="image",
+                                                                                  image_base64=payload))
+
+    scheduler = EnrichmentScheduler(cache=IngestionCache(str(tmp_path / "cache.sqlite")))
+    index, stats = ImageIndex(), {}
+    windows = [[image_chunk(encode(DIAGRAM))], [image_chunk(DIAGRAM_SMALL), image_chunk(ICON)]]
+    enhanced = [
+        enhance_chunks_with_summaries(window, image_chain=VisionChain(), scheduler=scheduler, stats=stats,
+                                      image_index=index)
+        for window in windows
+    ]
+
+    assert VisionChain.calls == 1
+    assert [len(chunks) for chunks in enhanced] == [1, 1]
+    assert enhanced[1][0].metadata.description == "description 1"
+    assert enhanced[1][0].text.startswith("Image Description: description 1")
+    assert stats["images"]["duplicates_of_earlier_pages"] == 1 and stats["images"]["skipped_small"] == 1
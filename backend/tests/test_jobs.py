@@ -0,0 +1,85 @@
+import asyncio
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.jobs import UploadTooLargeError, _next_batch, spool_to_disk
+
+
+class LateQueue(queue.Queue):
+    """Queue whose first blocking get() times out even though items are there: the worker
+    put its last windows right after the timeout"""
+
+    def __init__(self):
+        super().__init__()
+        self.timed_out = False
+
+    def get(self, block=True, timeout=None):
+        if block and not self.timed_out:
+            self.timed_out = True
+            raise queue.Empty
+        return super().get(block, timeout)
+
+
+def finished_future():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(None)
+    return future
+
+
+async def drain(batches):
+    future = finished_future()
+    received = []
+    while (batch := await _next_batch(batches, future)) is not None:
+        received.append(batch)
+    return received
+
+
+def test_last_windows_are_read_after_the_worker_finished():
+    batches = LateQueue()
+    for item in ("window-1", "window-2", None):
+        batches.put(item)
+
+    assert asyncio.run(drain(batches)) == ["window-1", "window-2"]
+
+
+def test_dead_worker_without_sentinel_ends_the_stream():
+    assert asyncio.run(drain(queue.Queue())) == []
+
+
+def test_windows_are_read_on_the_given_executor():
+    class RecordingQueue(queue.Queue):
+        def get(self, block=True, timeout=None):
+            readers.add(threading.current_thread().name)
+            return super().get(block, timeout)
+
+    readers = set()
+    batches = RecordingQueue()
+    for item in ("window-1", None):
+        batches.put(item)
+
+    async def scenario(executor):
+        future = finished_future()
+        received = []
+        while (batch := await _next_batch(batches, future, executor)) is not None:
+            received.append(batch)
+        return received
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-poller") as pollers:
+        assert asyncio.run(scenario(pollers)) == ["window-1"]
+    assert readers and all(name.startswith("ingest-poller") for name in readers)
+
+
+def test_spool_to_disk_rejects_large_uploads_without_leftovers(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.jobs.INGEST_TMP_DIR", str(tmp_path))
+    with pytest.raises(UploadTooLargeError):
+        spool_to_disk(io.BytesIO(b"x" * 100), max_bytes=10)
+    assert os.listdir(tmp_path) == []
+
+    path = spool_to_disk(io.BytesIO(b"%PDF-1.4"), max_bytes=10)
+    with open(path, "rb") as f:
+        assert f.read() == b"%PDF-1.4"
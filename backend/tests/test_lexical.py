@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain.schema import Document
+
+from src.lexical import BM25Index, is_exact_query, tokenize
+from src.retrieval import reciprocal_rank_fusion
+
+
+def doc(doc_id, text, page=1, filename="manual.pdf"):
+    return Document(page_content=text, metadata={"doc_id": doc_id, "filename": filename, "page_number": page,
+                                                 "content_type": "text"})
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = BM25Index(str(tmp_path / "lexical.sqlite"))
+    index.add_documents([
+        doc("valve", "replace the valve seal on the pump valve", page=1),
+        doc("pump", "the pump motor drives the pump", page=2),
+        doc("error", "error E-042 means the valve is stuck", page=3),
+        doc("other", "the motor of the other pump", page=1, filename="other.pdf"),
+    ])
+    yield index
+    index.close()
+
+
+def test_tokenize_keeps_codes_and_strips_accents():
+    assert tokenize("Código E-042 en la válvula v2/3") == ["codigo", "e-042", "en", "la", "valvula", "v2/3"]
+    assert is_exact_query("E-042") and not is_exact_query("what is E-042")
+
+
+def test_bm25_ranks_rare_terms_and_term_frequency(index):
+    assert [doc_id for doc_id, _ in index.search("E-042")] == ["error"]
+    ranked = [doc_id for doc_id, _ in index.search("valve")]
+    # "valve" aparece dos veces en el primer chunk
+    assert ranked == ["valve", "error"]
+    scores = [score for _, score in index.search("pump valve seal", k=2)]
+    assert len(scores) == 2 and scores[0] > scores[1]
+
+
+def test_filters_restrict_without_changing_scores(index):
+    unfiltered = dict(index.search("motor pump"))
+    filtered = index.search("motor pump", filters={"filenames": ["other.pdf"]})
+    assert [doc_id for doc_id, _ in filtered] == ["other"]
+    assert filtered[0][1] == pytest.approx(unfiltered["other"])
+    assert index.search("pump", filters={"page_from": 2, "page_to": 2})[0][0] == "pump"
+
+
+def test_page_range_matches_chunks_spanning_into_it(index):
+    section = doc("section", "boiler startup procedure", page=5)
+    section.metadata["last_page"] = 7
+    index.add_documents([section])
+
+    for page_from, page_to in ((6, 6), (7, 9), (3, 5)):
+        assert index.search("boiler", filters={"page_from": page_from, "page_to": page_to})[0][0] == "section"
+    assert index.search("boiler", filters={"page_from": 8}) == []
+    assert index.search("boiler", filters={"page_to": 4}) == []
+
+    index.update_pages({"section": 6})
+    assert index.search("boiler", filters={"page_from": 8})[0][0] == "section"
+
+
+def test_common_terms_are_skipped_unless_alone(index):
+    # "the" está en todos los chunks: no suma a ningún puntaje
+    assert dict(index.search("the E-042")) == pytest.approx(dict(index.search("E-042")))
+    assert len(index.search("the", k=10)) == 4
+
+
+def test_delete_updates_document_frequencies(index, tmp_path):
+    before = dict(index.search("E-042"))["error"]
+    assert index.delete(["valve", "pump"]) == 2
+    assert index.search("seal") == []
+    assert index.doc_count == 2
+    reopened = BM25Index(str(tmp_path / "lexical.sqlite"))
+    # Con menos chunks el término pesa distinto, pero el índice reabierto coincide
+    assert dict(reopened.search("E-042"))["error"] == pytest.approx(dict(index.search("E-042"))["error"]) != before
+    reopened.close()
+
+
+def test_concurrent_searches(index):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: index.search("valve"), range(32)))
+    assert all(result == results[0] for result in results)
+
+
+def test_reciprocal_rank_fusion_weights_and_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "b"]], [1.0, 1.0], rrf_k=60)
+    # "b" y "c" aparecen en las dos listas y superan a "a"
+    assert [doc_id for doc_id, _ in fused] == ["c", "b", "a"]
+    assert fused[0][1] == pytest.approx(1 / 63 + 1 / 61)
+
+    lexical_only = reciprocal_rank_fusion([["a", "b"], ["b", "a"]], [0.0, 1.0])
+    assert [doc_id for doc_id, _ in lexical_only] == ["b", "a"]
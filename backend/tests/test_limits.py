@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from src.limits import ConcurrencyLimiter, OverloadedError
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        limiter = ConcurrencyLimiter(max_inflight=1, max_queue=1, queue_timeout=5)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError) as error:
+            await limiter.acquire()
+        limiter.release()
+        await waiting
+        limiter.release()
+        return limiter, error.value
+
+    limiter, error = asyncio.run(scenario())
+    assert (error.status_code, error.retry_after) == (429, limiter.retry_after)
+    assert limiter.counters["rejected_queue_full"] == 1
+    assert limiter.counters["admitted"] == 2 and limiter.in_flight == 0
+
+
+def test_queue_timeout_is_rejected_with_503():
+    async def scenario():
+        limiter = ConcurrencyLimiter(max_inflight=1, max_queue=4, queue_timeout=0.05)
+        async with limiter.slot():
+            with pytest.raises(OverloadedError) as error:
+                await limiter.acquire()
+        return limiter, error.value
+
+    limiter, error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert limiter.counters["rejected_timeout"] == 1
+    assert limiter.waiting == 0 and limiter.in_flight == 0
@@ -0,0 +1,10 @@
+from src.metrics import render
+
+
+def test_per_component_labels():
+    text = render({"routing": lambda: {"local": 3, "mode": "auto"}, "tenants": lambda: {"open": 1}},
+                  labels={"routing": {"tenant": 'acme "eu"'}})
+
+    assert 'rag_routing_local{tenant="acme \\"eu\\""} 3' in text.splitlines()
+    assert "rag_tenants_open 1" in text.splitlines()
+    assert "rag_routing_mode" not in text
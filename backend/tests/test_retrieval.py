@@ -0,0 +1,62 @@
+import chromadb
+import numpy as np
+from langchain.schema import Document
+from langchain_chroma import Chroma
+
+from src.retrieval import chroma_where, drop_near_duplicates, is_empty_scope, merge_filters, mmr_order
+
+
+def test_merge_filters_intersects_scopes():
+    merged = merge_filters({"filenames": ["a.pdf", "b.pdf"], "page_from": 2},
+                           {"filenames": ["b.pdf", "c.pdf"], "page_from": 5, "page_to": 9}, None)
+    assert merged == {"filenames": ["b.pdf"], "page_from": 5, "page_to": 9}
+    assert is_empty_scope(merge_filters({"filenames": ["a.pdf"]}, {"filenames": ["b.pdf"]}))
+    assert is_empty_scope({"page_from": 4, "page_to": 3})
+
+
+def test_page_range_matches_chunks_spanning_into_it(tmp_path, embeddings):
+    client = chromadb.PersistentClient(path=str(tmp_path / "chroma"))
+    store = Chroma(collection_name="test_pages", embedding_function=embeddings, client=client)
+    store.add_texts(
+        ["section over pages 5-7", "page 8", "old chunk on page 6"],
+        metadatas=[{"page_number": 5, "last_page": 7}, {"page_number": 8, "last_page": 8}, {"page_number": 6}],
+        ids=["section", "page8", "old"],
+    )
+
+    def pages(page_from=None, page_to=None):
+        where = chroma_where({"page_from": page_from, "page_to": page_to})
+        return sorted(store.get(where=where)["ids"]) if where else sorted(store.get()["ids"])
+
+    assert pages(6, 6) == ["old", "section"]
+    assert pages(7, 9) == ["page8", "section"]
+    assert pages(page_to=5) == ["section"]
+    assert pages(8) == ["page8"]
+
+
+def test_mmr_prefers_diverse_candidates_and_drops_duplicates():
+    embeddings = np.array([
+        [1.0, 0.0, 0.0],
+        [0.999, 0.045, 0.0],   # casi idéntico al primero
+        [0.9, 0.43, 0.0],      # parecido pero no duplicado
+        [0.0, 0.0, 1.0],       # distinto
+        [0.0, 0.0, 0.0],       # sin embedding
+    ], dtype=np.float32)
+    relevance = [1.0, 0.95, 0.9, 0.5, 0.1]
+
+    # El parecido al primero queda penalizado por debajo de los candidatos distintos
+    assert mmr_order(relevance, embeddings, lambda_mult=0.5, dup_threshold=0.99) == [0, 3, 4, 2]
+    # Con lambda 1 solo cuenta la relevancia, pero el duplicado se sigue descartando
+    assert mmr_order(relevance, embeddings, lambda_mult=1.0, dup_threshold=0.99) == [0, 2, 3, 4]
+
+
+def test_drop_near_duplicates_keeps_first_of_each_group():
+    docs = [Document(page_content=text) for text in (
+        "replace the valve seal before starting the pump motor",
+        "replace the valve seal before starting the pump motor again",
+        "the boiler needs a pressure check every week",
+        "drain the tank after each shift",
+    )]
+
+    kept = drop_near_duplicates(docs, k=3, threshold=0.7)
+    assert [doc.page_content for doc in kept] == [docs[0].page_content, docs[2].page_content, docs[3].page_content]
+    assert len(drop_near_duplicates(docs, k=1)) == 1
@@ -0,0 +1,80 @@
+import asyncio
+
+from src.routing import Router, local_route
+
+
+class FakeSearch:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.queries = []
+
+    async def __call__(self, query, config):
+        self.queries.append(query)
+        await asyncio.sleep(self.delay)
+        return [f"chunk for {query}"]
+
+
+def retrieve_call(query, call_id="call_1", **filters):
+    return {"name": "retrieve", "args": {"query": query, **filters}, "id": call_id}
+
+
+def test_local_route():
+    assert local_route("¿Qué dice el manual sobre la válvula?")
+    assert local_route("what does error E-042 mean")
+    assert not local_route("hola, ¿cómo estás hoy?")
+    assert not local_route("calcula el promedio de la tabla 3")
+    assert not local_route("page 4?")
+    # Con historial, una referencia a la conversación necesita que el LLM reescriba la consulta
+    assert local_route("what does that table show", has_history=False)
+    assert not local_route("what does that table show", has_history=True)
+
+
+def test_route_locally_only_when_enabled():
+    disabled = Router(FakeSearch(), local=False)
+    assert not disabled.route_locally("what does the manual say about valves")
+
+    router = Router(FakeSearch(), local=True)
+    router.observe_routing(400.0)
+    assert router.route_locally("what does the manual say about valves")
+    assert not router.route_locally("thanks a lot friend")
+    assert (router.counters["local_routes"], router.counters["saved_ms"]) == (1, 400.0)
+
+
+def test_matching_speculation_is_handed_to_the_retrieve_call():
+    async def scenario():
+        search = FakeSearch()
+        router = Router(search, speculative=True)
+        speculation = router.speculate("valve seal replacement steps", config=None)
+        router.resolve(speculation, [retrieve_call("valve seal replacement steps")], "retrieve", routing_ms=300.0)
+        docs = await router.take("call_1")
+        return router, search, docs
+
+    router, search, docs = asyncio.run(scenario())
+    assert docs == ["chunk for valve seal replacement steps"] and search.queries == ["valve seal replacement steps"]
+    assert router.counters["speculative_hits"] == 1 and router.take("call_1") is None
+
+
+def test_unmatched_speculation_is_cancelled():
+    async def scenario():
+        router = Router(FakeSearch(delay=1), speculative=True)
+        calls = [
+            # Otra consulta, y la misma consulta pero con filtros que la especulación no usó
+            retrieve_call("pump motor wiring", "call_1"),
+            retrieve_call("valve seal replacement", "call_2", filenames=["a.pdf"]),
+        ]
+        speculation = router.speculate("valve seal replacement", config=None)
+        router.resolve(speculation, calls, "retrieve", routing_ms=300.0)
+        await asyncio.sleep(0)
+        return router, speculation
+
+    router, speculation = asyncio.run(scenario())
+    assert speculation.task.cancelled()
+    assert router.counters["speculative_misses"] == 1 and router.stats()["pending"] == 0
+    assert router.take("call_1") is None and router.take("call_2") is None
+
+
+def test_speculation_disabled():
+    async def scenario():
+        return Router(FakeSearch(), speculative=False).speculate("valve seal", config=None)
+
+    assert asyncio.run(scenario()) is None
@@ -0,0 +1,84 @@
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from src.sessions import SessionStore
+
+
+def turn(history, question, answer):
+    """Final graph messages of one turn: history, question, a tool round trip and the answer"""
+    return [
+        *history,
+        HumanMessage(content=question),
+        AIMessage(content="", tool_calls=[{"name": "retrieve", "args": {"query": question}, "id": "call_1"}]),
+        ToolMessage(content="chunks", tool_call_id="call_1"),
+        AIMessage(content=answer),
+    ]
+
+
+def test_commit_turn_returns_only_the_new_turn(tmp_path):
+    store = SessionStore(path=str(tmp_path / "sessions.sqlite"))
+    session = store.get("s1")
+
+    first = store.commit_turn(session, turn([], "what is E-042?", "a stuck valve"), summary="")
+    second = store.commit_turn(session, turn(session.messages, "how do I fix it?", "replace the seal"), summary="")
+
+    assert [msg.content for msg in first] == ["what is E-042?", "a stuck valve"]
+    # Las llamadas a herramientas no quedan en el historial
+    assert [msg.content for msg in second] == ["how do I fix it?", "replace the seal"]
+    assert len(session.messages) == 4 and session.total_tokens == sum(session.token_counts)
+
+
+def test_sessions_reload_from_sqlite(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    store = SessionStore(path=path, max_size=1)
+    session = store.get("s1", tenant="acme")
+    store.commit_turn(session, turn([], "what is E-042?", "a stuck valve"), summary="")
+    store.set_documents("s1", ["manual.pdf"], tenant="acme")
+    # Con max_size=1 la segunda sesión desaloja a la primera de memoria
+    store.get("s2", tenant="acme")
+
+    for reloaded in (store.get("s1", create=False), SessionStore(path=path).get("s1", create=False)):
+        assert [msg.content for msg in reloaded.messages] == ["what is E-042?", "a stuck valve"]
+        assert reloaded.token_counts == session.token_counts
+        assert (reloaded.tenant, reloaded.scope()) == ("acme", {"filenames": ["manual.pdf"]})
+
+
+def test_background_summary_is_discarded_if_the_history_was_replaced(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    store = SessionStore(path=path)
+    session = store.get("s1")
+    store.commit_turn(session, turn([], "q1", "a1"), summary="")
+    version, count = session.version, 2
+
+    # Un turno que resume inline reemplaza el historial: el resumen en segundo plano ya no aplica
+    store.commit_turn(session, turn([], "q2", "a2"), summary="inline summary")
+    assert not store.apply_summary(session, version, count, "background summary")
+    assert (session.summary, [msg.content for msg in session.messages]) == ("inline summary", ["q2", "a2"])
+
+
+def test_background_summary_keeps_messages_added_meanwhile(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    store = SessionStore(path=path)
+    session = store.get("s1")
+    store.commit_turn(session, turn([], "q1", "a1"), summary="")
+    version, count = session.version, 2
+
+    # Agregar mensajes no cambia la versión: el resumen de los dos primeros sigue siendo válido
+    store.commit_turn(session, turn(session.messages, "q2", "a2"), summary="")
+    assert store.apply_summary(session, version, count, "q1 was answered")
+    assert [msg.content for msg in session.messages] == ["q2", "a2"]
+    assert session.version == version + 1
+    assert not store.apply_summary(session, version, count, "stale")
+
+    reloaded = SessionStore(path=path).get("s1", create=False)
+    assert reloaded.summary == "q1 was answered"
+    assert [msg.content for msg in reloaded.messages] == ["q2", "a2"]
+
+
+def test_background_summary_is_discarded_for_evicted_sessions():
+    store = SessionStore(max_size=1)
+    session = store.get("s1")
+    store.commit_turn(session, turn([], "q1", "a1"), summary="")
+    store.get("s2")
+
+    assert not store.apply_summary(session, session.version, 2, "summary")
+    assert session.summary == "" and len(session.messages) == 2
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+
+import pytest
+from langchain.schema import Document
+
+from conftest import make_chunks
+from src.pdf_parser import save_to_multivectorstore
+from src.tenants import ShardedVectorStore, TenantLimitError, TenantRegistry, UnknownTenantError
+
+
+@pytest.fixture
+def registry(tmp_path, embeddings):
+    registry = TenantRegistry(embeddings, persist_dir=str(tmp_path), tenants_dir=str(tmp_path / "tenants"),
+                              max_open=2, shards=3, allowlist={"globex"}, max_count=10)
+    for name in ("acme", "initech", "a1", "b2", "c3", "warm", "cold"):
+        registry.create(name)
+    yield registry
+    registry.shutdown()
+
+
+def seed(tenant, tag):
+    children, parents = make_chunks(tag, range(1, 4), filename=f"{tag}.pdf")
+    save_to_multivectorstore(children, parents, tenant.retriever, tenant.lexical_index)
+    return {doc.metadata["doc_id"] for doc in children}
+
+
+def test_idle_tenants_are_evicted_lru_and_reopened_from_disk(registry):
+    async def scenario():
+        acme = await registry.acquire("acme")
+        ids = seed(acme, "acme")
+        registry.release(acme)
+        registry.release(await registry.acquire("globex"))
+        # Un tercer tenant desaloja al menos usado recientemente (acme)
+        registry.release(await registry.acquire("initech"))
+        assert set(registry._open) == {"globex", "initech"}
+
+        reopened = await registry.acquire("acme")
+        registry.release(reopened)
+        return acme, reopened, ids
+
+    acme, reopened, ids = asyncio.run(scenario())
+    assert reopened is not acme
+    assert set(reopened.vectorstore.get(include=[])["ids"]) == ids
+    assert registry.stats()["evicted"] == 2
+
+
+def test_tenants_in_use_are_not_evicted(registry):
+    async def scenario():
+        held = [await registry.acquire(name) for name in ("a1", "b2", "c3")]
+        open_while_held = set(registry._open)
+        for tenant in held:
+            registry.release(tenant)
+        return open_while_held
+
+    assert asyncio.run(scenario()) == {"a1", "b2", "c3"}
+    assert len(registry._open) == 2
+
+
+def test_tenants_get_their_own_sharded_collections(registry):
+    async def scenario():
+        async with registry.use("acme") as acme:
+            seed(acme, "acme")
+        async with registry.use("globex") as globex:
+            seed(globex, "globex")
+            return globex
+
+    globex = asyncio.run(scenario())
+    assert isinstance(globex.vectorstore, ShardedVectorStore)
+    assert len(globex.vectorstore.shards) == 3
+    docs = globex.vectorstore.similarity_search("globex manual page 2", k=6)
+    assert len(docs) == 6 and all(doc.metadata["filename"] == "globex.pdf" for doc in docs)
+
+
+def test_cold_open_does_not_block_other_tenants(registry):
+    load = registry._load
+
+    def slow_load(tenant_id):
+        if tenant_id == "cold":
+            time.sleep(1.0)
+        return load(tenant_id)
+
+    async def scenario():
+        registry.release(await registry.acquire("warm"))
+        registry._load = slow_load
+        cold = asyncio.gather(registry.acquire("cold"), registry.acquire("cold"))
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        registry.release(await registry.acquire("warm"))
+        waited = time.perf_counter() - started
+        first, second = await cold
+        registry.release(first)
+        registry.release(second)
+        return waited, first, second
+
+    waited, first, second = asyncio.run(scenario())
+    assert waited < 0.5
+    assert first is second
+
+
+def test_unknown_tenants_are_not_created(registry, tmp_path):
+    async def scenario():
+        with pytest.raises(UnknownTenantError):
+            await registry.acquire("stranger")
+        # Los de la allowlist se crean al primer uso
+        registry.release(await registry.acquire("globex"))
+
+    asyncio.run(scenario())
+    assert not os.path.exists(tmp_path / "tenants" / "stranger")
+    assert registry.stats()["registered"] == 8
+
+    assert registry.create("stranger") == {"tenant": "stranger", "shards": 3}
+    registry.create("stranger")
+    registry.create("other")
+    with pytest.raises(TenantLimitError):
+        registry.create("one-too-many")
+
+
+def test_sharded_store_from_texts(embeddings):
+    store = ShardedVectorStore.from_texts(["valve seal", "pump motor", "valve body"], embeddings, shards=2,
+                                          ids=["a", "b", "c"])
+    assert store._collection.count() == 3
+    assert {doc.page_content for doc in store.similarity_search("valve", k=3)} == {"valve seal", "pump motor", "valve body"}
+
+    store.update_documents(["a", "c"], [Document(page_content="valve seal", metadata={"page_number": 2}),
+                                        Document(page_content="valve cap", metadata={"page_number": 3})])
+    updated = store.get(ids=["a", "c"], include=["documents", "metadatas"])
+    assert sorted(zip(updated["ids"], updated["documents"], [m["page_number"] for m in updated["metadatas"]])) == [
+        ("a", "valve seal", 2), ("c", "valve cap", 3)]
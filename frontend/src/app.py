@@ -3,18 +3,21 @@ import logging
 import requests
 import json
 import io
+import uuid
+import time
 
 BACKEND_URL = "http://backend:8000"
+# Tiempo máximo (segundos) esperando que termine una ingesta
+JOB_WAIT_TIMEOUT = 30 * 60
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('chatbot')
 
-def call_bot(input, session_messages):
+def call_bot(input):
     data = {
         "question": input,
-        "chat_history": session_messages,
-        "summary": st.session_state.summary 
+        "session_id": st.session_state.session_id
     }
     payload = json.dumps(data)
     logger.info(f"Making POST request to {BACKEND_URL} with data: {data}")
@@ -34,6 +37,72 @@ def call_bot(input, session_messages):
         return {"answer": f"Failed to fetch data from backend. Status code: {response.status_code}", 
                 "documents": [], "summary": ""}
 
+def iter_sse(response):
+    """Parse a server-sent events response into (event, data) pairs"""
+    event, data = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+        elif not line and event:
+            yield event, json.loads("\n".join(data))
+            event, data = None, []
+
+def stream_bot(input):
+    """Yield answer tokens from /predict/stream as they arrive.
+
+    The history lives in the backend session: only the new question is sent.
+    """
+    data = {
+        "question": input,
+        "session_id": st.session_state.session_id
+    }
+    logger.info(f"Making streaming POST request to {BACKEND_URL} with data: {data}")
+    with requests.post(f"{BACKEND_URL}/predict/stream", data=json.dumps(data), stream=True) as response:
+        if response.status_code != 200:
+            logger.error(f"Failed to fetch data from backend. Status code: {response.status_code}")
+            yield f"Failed to fetch data from backend. Status code: {response.status_code}"
+            return
+
+        for event, payload in iter_sse(response):
+            if event == "token":
+                yield payload["text"]
+            elif event == "node":
+                logger.info(f"Node finished: {payload['node']}")
+            elif event == "sources":
+                logger.info(f"Sources: {payload['sources']}")
+            elif event == "done":
+                # Guarda el nuevo resumen en la sesión
+                st.session_state.summary = payload.get("summary", "")
+            elif event == "error":
+                yield f"\n\nError: {payload['error']}"
+
+def wait_for_job(job_id, poll_interval=1.0, timeout=JOB_WAIT_TIMEOUT):
+    """Poll the ingestion job until every file is done, showing progress.
+    Returns None if the job disappears (e.g. backend restart) or takes longer than `timeout`."""
+    progress_bar = st.progress(0.0, text="Procesando PDFs...")
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            response = requests.get(f"{BACKEND_URL}/jobs/{job_id}")
+            if response.status_code == 404:
+                logger.warning(f"Job {job_id} not found")
+                return None
+            response.raise_for_status()
+            job = response.json()
+
+            stages = ", ".join(f"{f['filename']}: {f['stage']}" for f in job["files"])
+            progress_bar.progress(min(job["progress"], 1.0), text=stages)
+
+            if job["status"] in ("completed", "failed"):
+                return job
+            time.sleep(poll_interval)
+        logger.warning(f"Gave up waiting for job {job_id} after {timeout}s")
+        return None
+    finally:
+        progress_bar.empty()
+
 def main():
     st.set_page_config(page_title=" RAG Bot")
 
@@ -46,6 +115,9 @@ def main():
     if "summary" not in st.session_state:
         st.session_state.summary = ""
 
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
     if "pdfs_uploaded" not in st.session_state:
         st.session_state.pdfs_uploaded = False
 
@@ -64,15 +136,28 @@ def main():
                 ]
                 response = requests.post(f"{BACKEND_URL}/upload_pdfs", files=files)
 
-                if response.status_code == 200:
-                    st.success("PDFs procesados exitosamente.")
-                    st.session_state.pdfs_uploaded = True
+                if response.status_code == 200 and response.json().get("job_id"):
+                    job = wait_for_job(response.json()["job_id"])
+                    if job is None:
+                        st.error("No se pudo seguir el procesamiento de los PDFs (el trabajo ya no existe o tardó demasiado).")
+                    else:
+                        failed = [f for f in job["files"] if f["stage"] == "error"]
+                        for f in failed:
+                            st.error(f"Error al procesar {f['filename']}: {f['error']}")
+                        if job["status"] != "failed":
+                            st.success("PDFs procesados exitosamente.")
+                            st.session_state.pdfs_uploaded = True
+                elif response.status_code == 200:
+                    st.warning("No se recibieron PDFs válidos.")
                 else:
                     st.error(f"Error al procesar PDFs: {response.status_code}")
         else:
             st.success("PDFs ya fueron cargados. Puedes comenzar a chatear.")
 
         if st.button("Limpiar historial"):
+            requests.delete(f"{BACKEND_URL}/sessions/{st.session_state.session_id}")
+            st.session_state.session_id = uuid.uuid4().hex
+            st.session_state.summary = ""
             st.session_state.messages = [{
                 "role": "assistant",
                 "content": "Hola! ¿Cómo puedo ayudarte hoy?"
@@ -98,14 +183,13 @@ def main():
     # Respuesta del asistente
     if st.session_state.messages[-1]["role"] != "assistant":
         with st.chat_message("assistant"):
-            with st.spinner("Pensando..."):
-                response = call_bot(prompt, st.session_state.messages)['answer']
-                placeholder = st.empty()
-                full_response = ""
-                for chunk in response:
-                    full_response += chunk
-                    placeholder.markdown(full_response)
+            placeholder = st.empty()
+            placeholder.markdown("_Pensando..._")
+            full_response = ""
+            for token in stream_bot(prompt):
+                full_response += token
                 placeholder.markdown(full_response)
+            placeholder.markdown(full_response)
 
         st.session_state.messages.append({"role": "assistant", "content": full_response})
 